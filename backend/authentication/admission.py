@@ -0,0 +1,304 @@
+"""
+Admission control for the expensive stages of register/verify.
+
+Two limiters bound how many requests run a stage at once:
+
+    encode    face encoding (CPU bound; default FACE_ENCODE_WORKERS)
+    chain     registerUser transaction submission
+
+A request that finds a limiter full waits in a bounded FIFO queue. When the
+queue is full, or the wait exceeds ADMISSION_QUEUE_TIMEOUT, it is rejected
+at once with 503 + Retry-After, instead of piling up until worker timeouts.
+Before that, each client (by IP) is held to a token-bucket rate
+(ADMISSION_CLIENT_RATE per second, burst ADMISSION_CLIENT_BURST); excess
+requests get 429 + Retry-After.
+
+Views run the cheap checks (missing fields, unknown user, wrong password)
+first and only then call ``check_client_rate`` and enter ``slot(...)``.
+Verify may start its encode before its ledger lookups instead, but only if
+an encode slot is free at once (``Limiter.try_enter``). That slot is held
+until the encode finishes, even when a failed lookup abandons it.
+Limiters are per process and serve sync (thread) and async (event loop)
+views alike.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .metrics import ADMISSION_REJECTED, observe_stage
+
+ENCODE = 'encode'
+CHAIN = 'chain'
+
+
+class AdmissionError(Exception):
+    """Request shed by admission control; carries the HTTP status and Retry-After seconds"""
+
+    def __init__(self, message, status=503, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def admission_response(error):
+    response = JsonResponse({'error': str(error)}, status=error.status)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+class _ThreadWaiter:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def grant(self):
+        self.event.set()
+
+
+class _AsyncWaiter:
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def grant(self):
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Limiter:
+    """
+    Concurrency limit with a bounded FIFO wait queue
+
+    A finished request hands its slots directly to the oldest waiter, so
+    waiters are served in arrival order and newcomers cannot overtake them.
+    A request may hold several slots (a batch using several encode workers);
+    it waits until that many are free, at most `limit`.
+    """
+
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        # Smoothed seconds per slot, used to estimate Retry-After
+        self._hold_seconds = 1.0
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _try_enter(self, waiter_factory, count):
+        """Take `count` free slots (returns None) or queue a waiter (returns it)"""
+        with self._lock:
+            if self.in_flight + count <= self.limit and not self._waiters:
+                self.in_flight += count
+                return None
+            if len(self._waiters) >= self.max_queue:
+                raise self._rejected('queue_full')
+            waiter = waiter_factory()
+            waiter.count = count
+            self._waiters.append(waiter)
+            return waiter
+
+    def try_enter(self):
+        """Take a slot only if one is free and nobody is queued; pair with release()"""
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self, held_seconds=0.0):
+        """Give back a slot taken with try_enter, possibly from another thread"""
+        self._release(held_seconds)
+
+    def _abandon(self, waiter):
+        """Timed-out waiter leaves the queue; True if it was granted its slots meanwhile"""
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return True
+            # A large waiter at the head may have held back smaller ones
+            self._grant_waiters()
+            return False
+
+    def _grant_waiters(self):
+        # Slots pass to the oldest waiters, as long as the head's count fits
+        while self._waiters and self.in_flight + self._waiters[0].count <= self.limit:
+            waiter = self._waiters.popleft()
+            self.in_flight += waiter.count
+            waiter.grant()
+
+    def _release(self, held_seconds, count=1):
+        with self._lock:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held_seconds
+            self.in_flight -= count
+            self._grant_waiters()
+
+    def _retry_after(self):
+        # Time for the current queue plus one batch to drain, at least 1 s
+        batches = (len(self._waiters) + self.limit) / self.limit
+        return max(1, math.ceil(batches * self._hold_seconds))
+
+    def _rejected(self, reason):
+        ADMISSION_REJECTED.inc(limiter=self.name, reason=reason)
+        return AdmissionError(
+            f'Server busy ({self.name} capacity reached), please retry', status=503,
+            retry_after=self._retry_after()
+        )
+
+    def _timed_out(self):
+        with self._lock:
+            return self._rejected('queue_timeout')
+
+    @contextmanager
+    def slot(self, count=1):
+        """Hold `count` slots (capped at the limit) for the enclosed block (blocking wait; sync views)"""
+        count = max(1, min(count, self.limit))
+        start = time.perf_counter()
+        waiter = self._try_enter(_ThreadWaiter, count)
+        if waiter is not None:
+            if not waiter.event.wait(self.queue_timeout) and not self._abandon(waiter):
+                raise self._timed_out()
+            observe_stage(f'{self.name}_queue', time.perf_counter() - start)
+        entered = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - entered, count)
+
+    @asynccontextmanager
+    async def aslot(self, count=1):
+        """Hold `count` slots (capped at the limit) for the enclosed block (waits on the event loop; async views)"""
+        count = max(1, min(count, self.limit))
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        waiter = self._try_enter(lambda: _AsyncWaiter(loop), count)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if self._abandon(waiter):
+                    # Granted while timing out: pass the slots on
+                    self._release(0.0, count)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise self._timed_out()
+            observe_stage(f'{self.name}_queue', time.perf_counter() - start)
+        entered = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - entered, count)
+
+
+class ClientRateLimiter:
+    """Token bucket per client key: `rate` requests per second, bursts of `burst`"""
+
+    # Buckets are pruned once there are this many clients
+    MAX_CLIENTS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def check(self, client, cost=1):
+        """
+        Take `cost` tokens for `client` or raise AdmissionError (429)
+
+        A cost above the burst is admitted from a full bucket and leaves it in
+        debt, so large batches are slowed down rather than refused forever.
+        """
+        if self.rate <= 0:
+            return
+        needed = min(float(cost), self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < needed:
+                self._buckets[client] = (tokens, now)
+                ADMISSION_REJECTED.inc(limiter='client_rate', reason='rate_limited')
+                raise AdmissionError(
+                    'Too many requests from this client, please retry later', status=429,
+                    retry_after=max(1, math.ceil((needed - tokens) / self.rate))
+                )
+            self._buckets[client] = (tokens - cost, now)
+            if len(self._buckets) > self.MAX_CLIENTS:
+                self._prune(now)
+
+    def _prune(self, now):
+        """Drop buckets that have refilled completely (equivalent to a new client)"""
+        self._buckets = {
+            client: (tokens, updated) for client, (tokens, updated) in self._buckets.items()
+            if now - updated < (self.burst - tokens) / self.rate
+        }
+
+
+_limiters = {}
+_rate_limiter = None
+_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Process-wide limiter for `name` (ENCODE or CHAIN), built from settings"""
+    with _lock:
+        if name not in _limiters:
+            limits = {
+                ENCODE: settings.ADMISSION_ENCODE_CONCURRENCY,
+                CHAIN: settings.ADMISSION_CHAIN_CONCURRENCY,
+            }
+            if name not in limits:
+                raise ValueError(f"Unknown limiter: {name}. Use one of: {', '.join(limits)}")
+            _limiters[name] = Limiter(
+                name, limits[name], settings.ADMISSION_QUEUE_SIZE, settings.ADMISSION_QUEUE_TIMEOUT
+            )
+        return _limiters[name]
+
+
+def slot(name, count=1):
+    return get_limiter(name).slot(count)
+
+
+def aslot(name, count=1):
+    return get_limiter(name).aslot(count)
+
+
+def client_key(request):
+    """Client identity for rate limiting: the first X-Forwarded-For hop behind a trusted proxy, else REMOTE_ADDR"""
+    if settings.ADMISSION_TRUST_FORWARDED_FOR:
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def check_client_rate(request, cost=1):
+    """Raise AdmissionError (429) if this client is over its request rate; batches cost one per item"""
+    global _rate_limiter
+    with _lock:
+        if _rate_limiter is None:
+            _rate_limiter = ClientRateLimiter(settings.ADMISSION_CLIENT_RATE, settings.ADMISSION_CLIENT_BURST)
+    _rate_limiter.check(client_key(request), cost)
+
+
+def reset_admission():
+    """Drop limiters so they are rebuilt from settings (tests)"""
+    global _rate_limiter
+    with _lock:
+        _limiters.clear()
+        _rate_limiter = None
@@ -5,3 +5,23 @@ class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
 
+    def ready(self):
+        # Build the ledger backend from settings / contract-info.json. This does
+        # no network I/O; the node is first contacted by the first request.
+        from .ledger import get_ledger
+        get_ledger()
+
+        # A changed or removed stored encoding must not be served from the login prefetch cache
+        from django.db.models.signals import post_delete, post_save
+        from . import face_index, prefetch
+        from .models import UserFaceEncoding
+        post_save.connect(prefetch.invalidate_encoding, sender=UserFaceEncoding,
+                          dispatch_uid='prefetch_invalidate_save')
+        post_delete.connect(prefetch.invalidate_encoding, sender=UserFaceEncoding,
+                            dispatch_uid='prefetch_invalidate_delete')
+
+        # Keep the face key buckets in step with the stored encodings
+        post_save.connect(face_index.index_encoding, sender=UserFaceEncoding,
+                          dispatch_uid='face_index_save')
+        post_delete.connect(face_index.unindex_encoding, sender=UserFaceEncoding,
+                            dispatch_uid='face_index_delete')
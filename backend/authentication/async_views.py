@@ -0,0 +1,437 @@
+"""
+Async versions of the register/verify endpoints.
+
+With the web3 ledger backend these views talk to Ganache through AsyncWeb3,
+so a request waiting on the chain does not hold a worker thread, and they
+push the CPU-bound face encoding onto a process pool. Serve them through ``faceauth_backend.asgi``.
+
+Verify (sync and async) submits its encode to the pool before its ledger
+lookups (``start_encode``), so login latency is the longer of the two
+rather than their sum; the encode is cancelled if the lookups fail.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseNotAllowed, JsonResponse
+
+from . import admission, audit, face_index, prefetch
+from .admission import AdmissionError, admission_response, check_client_rate
+from .audit import audited
+from .idempotency import idempotent
+from .ledger import LedgerError, get_ledger
+from .metrics import ENCODES_CANCELLED, observe_stages, stage, track_request
+from .models import UserFaceEncoding
+from .payloads import PayloadError, encoding_payload, get_encoding_mode, get_face_hint, parse_face_request
+from .tokens import issue_token
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+from face_module.face_utils import encode_face_timed, get_face_distance, verify_face
+from face_module.face_keys import face_key
+
+logger = logging.getLogger(__name__)
+
+_encode_executor = None
+
+
+def get_encode_executor():
+    """Return the shared process pool used for face encoding"""
+    global _encode_executor
+    if _encode_executor is None:
+        _encode_executor = ProcessPoolExecutor(max_workers=settings.FACE_ENCODE_WORKERS)
+    return _encode_executor
+
+
+async def encode_face_async(face_image_bytes, face_hint=None):
+    """Run encode_face in the process pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    face_encoding, timings = await loop.run_in_executor(
+        get_encode_executor(), encode_face_timed, face_image_bytes,
+        settings.FACE_ENCODER, settings.FACE_ENCODING_PROFILE, face_hint
+    )
+    observe_stages(timings)
+    return face_encoding
+
+
+def _encode_failed(e):
+    logger.exception("Face encoding error: %s", e)
+    return JsonResponse({'error': f'Face encoding failed: {str(e)}'}, status=500)
+
+
+def _no_face():
+    logger.info("No face detected")
+    return JsonResponse({'error': 'No face detected in image. Please ensure your face is clearly visible.'}, status=400)
+
+
+class EncodeJob:
+    """
+    Face encode running in the encode pool while the request does its lookups
+
+    The job holds an ENCODE admission slot until the pool has finished it
+    (or dropped it unstarted), so abandoned encodes still count against the
+    limit. ``result``/``aresult`` return (face_encoding, error_response)
+    like ``_encode_or_error``; the wait shows up as stage 'encode_wait'.
+    """
+
+    def __init__(self, executor, face_image_bytes, face_hint, limiter):
+        self._limiter = limiter
+        self._submitted = time.perf_counter()
+        self.future = executor.submit(
+            encode_face_timed, face_image_bytes, settings.FACE_ENCODER, settings.FACE_ENCODING_PROFILE, face_hint
+        )
+        self.future.add_done_callback(self._release)
+
+    def _release(self, future):
+        self._limiter.release(time.perf_counter() - self._submitted)
+
+    def cancel(self):
+        """Drop the encode: a queued one never runs, a running one finishes unobserved"""
+        if self.future.done():
+            return
+        if self.future.cancel():
+            ENCODES_CANCELLED.inc(when='queued')
+        else:
+            ENCODES_CANCELLED.inc(when='running')
+
+    def _outcome(self, face_encoding, timings):
+        observe_stages(timings)
+        if face_encoding is None:
+            return None, _no_face()
+        return face_encoding, None
+
+    def result(self):
+        try:
+            with stage('encode_wait'):
+                face_encoding, timings = self.future.result()
+        except Exception as e:
+            return None, _encode_failed(e)
+        return self._outcome(face_encoding, timings)
+
+    async def aresult(self):
+        try:
+            with stage('encode_wait'):
+                face_encoding, timings = await asyncio.wrap_future(self.future)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        except Exception as e:
+            return None, _encode_failed(e)
+        return self._outcome(face_encoding, timings)
+
+
+def overlap_enabled(request):
+    """VERIFY_OVERLAP_ENCODE, or when unset: on for ASGI requests, off under WSGI"""
+    if settings.VERIFY_OVERLAP_ENCODE is None:
+        return isinstance(request, ASGIRequest)
+    return settings.VERIFY_OVERLAP_ENCODE
+
+
+def start_encode(request, face_image_bytes, face_hint=None):
+    """
+    Submit a verify encode ahead of the ledger lookups
+
+    Returns None, and the caller encodes after its checks as before, when
+    the overlap is off for this request (``overlap_enabled``) or no encode
+    slot is free right now: under load, the cheap checks still run first so
+    bad logins do not take encode capacity.
+    """
+    if not overlap_enabled(request):
+        return None
+    limiter = admission.get_limiter(admission.ENCODE)
+    if not limiter.try_enter():
+        return None
+    try:
+        return EncodeJob(get_encode_executor(), face_image_bytes, face_hint, limiter)
+    except Exception:
+        limiter.release()
+        raise
+
+
+def async_post_endpoint(view_func):
+    """
+    csrf_exempt + require_http_methods(["POST"]) for coroutine views.
+
+    The Django 4.2 decorators wrap views in a sync function, which would make
+    Django run the coroutine view in a thread instead of on the event loop.
+    """
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        return await view_func(request, *args, **kwargs)
+
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def _user_check_error(e):
+    """Map an isRegistered RPC failure to the same response the sync views return"""
+    error_msg = str(e)
+    if "contract" in error_msg.lower() and "deployed" in error_msg.lower():
+        return JsonResponse({
+            'error': 'Contract not deployed correctly. Please run: cd blockchain && npx truffle migrate --reset'
+        }, status=500)
+    return JsonResponse({'error': f'Error checking user: {error_msg}'}, status=500)
+
+
+async def _encode_or_error(face_image_bytes, face_hint=None):
+    """Encode the face image; returns (face_encoding, error_response)"""
+    try:
+        face_encoding = await encode_face_async(face_image_bytes, face_hint)
+    except Exception as e:
+        return None, _encode_failed(e)
+
+    if face_encoding is None:
+        return None, _no_face()
+    return face_encoding, None
+
+
+@async_post_endpoint
+@track_request('register_async')
+@audited('register_async')
+@idempotent('register')
+async def register(request):
+    """
+    Register a new user with username, password, and face image (async)
+    """
+    try:
+        try:
+            data, face_image_bytes = parse_face_request(request)
+            face_hint = get_face_hint(request, data)
+        except PayloadError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        username = data.get('username')
+        password = data.get('password')
+        audit.annotate(username=username)
+
+        if not all([username, password, face_image_bytes]):
+            return JsonResponse({'error': 'Missing required fields'}, status=400)
+        if len(username.strip()) == 0:
+            return JsonResponse({'error': 'Username cannot be empty'}, status=400)
+
+        logger.info("Registration attempt for user: %s", username)
+        check_client_rate(request)
+
+        ledger = get_ledger()
+        try:
+            await ledger.acheck_ready()
+        except LedgerError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        try:
+            if await ledger.ais_registered(username):
+                return JsonResponse({'error': 'User already exists'}, status=400)
+        except Exception as e:
+            logger.error("Error checking user existence: %s", e)
+            return _user_check_error(e)
+
+        password_hash = hashlib.sha256(password.encode()).hexdigest()
+
+        async with admission.aslot(admission.ENCODE):
+            face_encoding, error = await _encode_or_error(face_image_bytes, face_hint)
+        if error:
+            return error
+
+        face_hash = face_key(face_encoding, settings.FACE_KEY_SEED)
+        if not face_hash:
+            return JsonResponse({'error': 'Face hashing failed'}, status=500)
+
+        # One account per face: bucket lookup, exact distance on the candidates
+        if settings.REGISTER_REJECT_DUPLICATE_FACES:
+            with stage('face_index'):
+                matches = await sync_to_async(face_index.find_matches)(face_encoding, exclude=username)
+            if matches:
+                logger.info("Registration of %r refused: face matches %d existing user(s)", username, len(matches))
+                return JsonResponse({'error': 'This face is already registered to another account'}, status=409)
+
+        # Register on blockchain FIRST (before storing locally)
+        try:
+            async with admission.aslot(admission.CHAIN):
+                await ledger.aregister_user(username.strip(), password_hash, face_hash)
+        except AdmissionError:
+            raise
+        except Exception as e:
+            logger.exception("Blockchain registration error: %s", e)
+            try:
+                await UserFaceEncoding.objects.filter(username=username).adelete()
+            except Exception:
+                pass
+            if isinstance(e, LedgerError):
+                return JsonResponse({'error': str(e)}, status=e.status)
+            return JsonResponse({'error': f'Blockchain registration failed: {str(e)}'}, status=500)
+
+        # Store face encoding locally AFTER blockchain registration succeeds
+        try:
+            with stage('db_write'):
+                await UserFaceEncoding.objects.aupdate_or_create(
+                    username=username,
+                    defaults={'face_encoding': json.dumps(face_encoding.tolist())}
+                )
+        except Exception as e:
+            logger.warning("Could not store face encoding locally: %s", e)
+
+        logger.info("User registered: %s", username)
+        return JsonResponse({
+            'success': True,
+            'message': 'User registered successfully',
+            'username': username,
+            'password_hash': password_hash,
+            'face_hash': face_hash
+        })
+
+    except AdmissionError as e:
+        logger.info("Register shed by admission control: %s", e)
+        return admission_response(e)
+    except Exception as e:
+        logger.exception("Unexpected error in async register: %s", e)
+        return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+
+async def _alogin_or_error(ledger, username, password, prefetched=None):
+    """
+    Ledger checks of a login; returns ((password_hash, stored_face_hash), error_response)
+
+    With a `prefetched` entry (see prefetch.py) the ledger is not read again.
+    """
+    if prefetched is not None:
+        password_hash = hashlib.sha256(password.encode()).hexdigest()
+        if password_hash != prefetched.password_hash:
+            return None, JsonResponse({'error': 'Invalid password'}, status=401)
+        return (password_hash, prefetched.face_hash), None
+
+    try:
+        await ledger.acheck_ready()
+    except LedgerError as e:
+        return None, JsonResponse({'error': str(e)}, status=e.status)
+
+    try:
+        is_registered = await ledger.ais_registered(username)
+    except Exception as e:
+        logger.error("Error checking user existence: %s", e)
+        return None, _user_check_error(e)
+
+    if not is_registered:
+        # Clean up orphaned local data from an incomplete registration
+        with stage('db_lookup'):
+            deleted, _ = await UserFaceEncoding.objects.filter(username=username).adelete()
+        if deleted:
+            logger.warning("Cleaned up orphaned local data for: %s", username)
+            return None, JsonResponse({
+                'error': 'User registration was incomplete. Please register again to complete the process.'
+            }, status=404)
+        return None, JsonResponse({
+            'error': f'User "{username}" not found. Please register first.'
+        }, status=404)
+
+    try:
+        stored_password_hash, stored_face_hash = await ledger.aget_user_hash(username)
+    except LedgerError as e:
+        return None, JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        logger.exception("Error getting user data from blockchain: %s", e)
+        return None, JsonResponse({'error': f'Error retrieving user data: {str(e)}'}, status=500)
+
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    if password_hash != stored_password_hash:
+        return None, JsonResponse({'error': 'Invalid password'}, status=401)
+    return (password_hash, stored_face_hash), None
+
+
+@async_post_endpoint
+@track_request('verify_async')
+@audited('verify_async')
+@idempotent('verify')
+async def verify(request):
+    """
+    Verify user login with username, password, and face image (async)
+    """
+    try:
+        try:
+            data, face_image_bytes = parse_face_request(request)
+            face_hint = get_face_hint(request, data)
+            encoding_mode = get_encoding_mode(request, data)
+        except PayloadError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        username = data.get('username')
+        password = data.get('password')
+        audit.annotate(username=username)
+
+        if not all([username, password, face_image_bytes]):
+            return JsonResponse({'error': 'Missing required fields'}, status=400)
+
+        logger.info("Login attempt for user: %s", username)
+        check_client_rate(request)
+
+        ledger = get_ledger()
+        # Encode alongside the ledger and database lookups; cancelled if they fail
+        encode_job = start_encode(request, face_image_bytes, face_hint)
+        try:
+            prefetched = await prefetch.alookup(username)
+            credentials, error = await _alogin_or_error(ledger, username, password, prefetched)
+            if error:
+                return error
+            password_hash, stored_face_hash = credentials
+
+            stored_encoding = prefetched.encoding if prefetched is not None else None
+            if stored_encoding is None:
+                with stage('db_lookup'):
+                    stored_encoding_obj = await UserFaceEncoding.objects.filter(username=username).afirst()
+                stored_encoding = stored_encoding_obj.get_encoding() if stored_encoding_obj else None
+
+            if encode_job is not None:
+                face_encoding, error = await encode_job.aresult()
+            else:
+                async with admission.aslot(admission.ENCODE):
+                    face_encoding, error = await _encode_or_error(face_image_bytes, face_hint)
+            if error:
+                return error
+        finally:
+            if encode_job is not None:
+                encode_job.cancel()
+
+        # Similarity comparison against the stored encoding, ledger face key as fallback
+        if stored_encoding is not None:
+            distance = float(get_face_distance(stored_encoding, face_encoding))
+            audit.annotate(distance=distance)
+            face_match = distance <= settings.FACE_MATCH_TOLERANCE
+        else:
+            logger.warning("No stored encoding for %r, using the ledger face key (less reliable)", username)
+            face_match = verify_face(face_encoding, stored_face_hash,
+                                     settings.FACE_MATCH_TOLERANCE, settings.FACE_KEY_SEED)
+
+        if not face_match:
+            logger.info("Face verification failed for %r - faces don't match", username)
+            return JsonResponse({
+                'error': 'Face verification failed. Please ensure you are using the same face as registration.'
+            }, status=401)
+
+        logger.info("Face verification successful for %r", username)
+        return JsonResponse({
+            'success': True,
+            'message': 'Login successful',
+            **issue_token(username),
+            'dashboard_data': {
+                'username': username,
+                'password_hash': password_hash,
+                **encoding_payload(face_encoding, encoding_mode),
+                'face_hash': face_key(face_encoding, settings.FACE_KEY_SEED)
+            }
+        })
+
+    except AdmissionError as e:
+        logger.info("Verify shed by admission control: %s", e)
+        return admission_response(e)
+    except Exception as e:
+        logger.exception("Unexpected error in async verify: %s", e)
+        return JsonResponse({'error': str(e)}, status=500)
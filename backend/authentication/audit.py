@@ -0,0 +1,339 @@
+"""
+Audit log of register and verify attempts.
+
+Views never write audit rows themselves. ``@audited(endpoint)`` (or
+``record`` for per-item events) puts an event on a bounded in-memory queue
+and returns; a background thread drains the queue and writes events with
+``bulk_create``, AUDIT_BATCH_SIZE at a time or every AUDIT_FLUSH_INTERVAL
+seconds, whichever comes first. A request therefore pays a queue put, not a
+database write or a wait on SQLite's write lock.
+
+When the queue is full (the database cannot keep up), new events are
+dropped and counted in ``faceauth_audit_dropped_total{reason="queue_full"}``;
+a failed batch write counts under ``reason="write_failed"``. Memory is
+bounded by AUDIT_QUEUE_SIZE events.
+
+Events are stored in one table per calendar month (UTC),
+``audit_events_YYYYMM``, created on first write. Retention drops whole
+months (``manage.py purge_audit_log``), and queries for recent events only
+touch the newest tables.
+
+Each event has the endpoint, username, HTTP status and error, the face
+distance for verifications that got that far, per-stage timings and the
+client address. ``recent_failures(username)`` returns a user's latest
+failed attempts.
+"""
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import timedelta, timezone as dt_timezone
+from functools import wraps
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from .admission import client_key
+from .metrics import AUDIT_DROPPED, AUDIT_WRITTEN, current_stages
+from .models import AuditEvent
+
+TABLE_PREFIX = 'audit_events_'
+# Error bodies larger than this are not parsed for the message
+MAX_ERROR_BODY = 4096
+
+logger = logging.getLogger(__name__)
+
+_annotations = contextvars.ContextVar('faceauth_audit', default=None)
+_models = {}
+_created = set()
+_models_lock = threading.Lock()
+
+
+def month_of(when):
+    return when.astimezone(dt_timezone.utc).strftime('%Y%m')
+
+
+def partition_model(month):
+    """Concrete AuditEvent model for the month 'YYYYMM' (table audit_events_YYYYMM)"""
+    with _models_lock:
+        model = _models.get(month)
+        if model is None:
+            name = f'AuditEvent{month}'
+            try:
+                model = apps.get_model('authentication', name)
+            except LookupError:
+                meta = type('Meta', (AuditEvent.Meta,), {'db_table': TABLE_PREFIX + month})
+                model = type(name, (AuditEvent,), {'__module__': AuditEvent.__module__, 'Meta': meta})
+            _models[month] = model
+        return model
+
+
+def partitions():
+    """Months ('YYYYMM') that have an audit table, oldest first"""
+    return sorted(
+        table[len(TABLE_PREFIX):] for table in connection.introspection.table_names()
+        if table.startswith(TABLE_PREFIX) and table[len(TABLE_PREFIX):].isdigit()
+    )
+
+
+def ensure_partition(month):
+    """Create the table for `month` if it does not exist yet; returns its model"""
+    model = partition_model(month)
+    if month in _created:
+        return model
+    if model._meta.db_table not in connection.introspection.table_names():
+        try:
+            with connection.schema_editor() as editor:
+                editor.create_model(model)
+        except DatabaseError:
+            # Created concurrently by another process
+            if model._meta.db_table not in connection.introspection.table_names():
+                raise
+    _created.add(month)
+    return model
+
+
+def drop_partition(month):
+    model = partition_model(month)
+    with connection.schema_editor() as editor:
+        editor.delete_model(model)
+    _created.discard(month)
+
+
+def write_events(events):
+    """bulk_create `events` (dicts of AuditEvent fields) into their monthly tables"""
+    by_month = {}
+    for event in events:
+        by_month.setdefault(month_of(event['created_at']), []).append(event)
+    for month, month_events in by_month.items():
+        model = ensure_partition(month)
+        model.objects.bulk_create([model(**event) for event in month_events])
+    AUDIT_WRITTEN.inc(len(events))
+
+
+class AuditWriter:
+    """Bounded queue drained by a daemon thread that writes events in batches"""
+
+    def __init__(self, max_queue, batch_size, flush_interval):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def put(self, event):
+        """Queue `event` without blocking; False if it was dropped"""
+        self._start()
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            AUDIT_DROPPED.inc(reason='queue_full')
+            return False
+
+    def _start(self):
+        # A forked child inherits the writer but not its thread: start another
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+                if self._pid is None:
+                    atexit.register(self.flush)
+                self._pid = os.getpid()
+
+    def _next_batch(self):
+        """Block for the first event, then collect until the batch is full or the interval ends"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._write(self._next_batch())
+
+    def _write(self, batch):
+        try:
+            write_events(batch)
+        except Exception as e:
+            logger.error("Could not write %d audit events: %s", len(batch), e)
+            AUDIT_DROPPED.inc(len(batch), reason='write_failed')
+
+    def flush(self):
+        """Write everything queued so far from the calling thread (tests, shutdown)"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Process-wide AuditWriter built from settings"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AuditWriter(settings.AUDIT_QUEUE_SIZE, settings.AUDIT_BATCH_SIZE, settings.AUDIT_FLUSH_INTERVAL)
+        return _writer
+
+
+def record(endpoint, request, status, username='', error='', distance=None, timings=None):
+    """Queue one audit event; never blocks and never raises for a full queue"""
+    if not settings.AUDIT_LOG_ENABLED:
+        return
+    get_writer().put({
+        'created_at': timezone.now(),
+        'endpoint': endpoint,
+        'username': str(username or '')[:100],
+        'success': 200 <= status < 300,
+        'status': status,
+        'error': (error or '')[:255],
+        'distance': distance,
+        'timings': timings or {},
+        'client_ip': client_key(request)[:64],
+    })
+
+
+def annotate(**fields):
+    """Attach `username` / `distance` to the audit event of the current request"""
+    fields_so_far = _annotations.get()
+    if fields_so_far is not None:
+        fields_so_far.update(fields)
+
+
+def _response_error(response):
+    if response.status_code < 400 or len(response.content) > MAX_ERROR_BODY:
+        return ''
+    try:
+        return str(json.loads(response.content).get('error', ''))
+    except (ValueError, AttributeError):
+        return ''
+
+
+def _record_response(endpoint, request, response, fields, elapsed):
+    timings = current_stages()
+    timings['total'] = elapsed
+    record(
+        endpoint, request, response.status_code if response is not None else 500,
+        username=fields.get('username') or '', distance=fields.get('distance'),
+        error=_response_error(response) if response is not None else 'Unhandled exception',
+        timings=timings,
+    )
+
+
+def audited(endpoint):
+    """
+    Decorator queueing an audit event for every call of a sync or async view
+
+    Place it under ``track_request`` so the event carries the request's stage
+    timings. Views add the username and face distance with ``annotate``.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                fields = {}
+                token = _annotations.set(fields)
+                start = time.perf_counter()
+                response = None
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                    return response
+                finally:
+                    _annotations.reset(token)
+                    _record_response(endpoint, request, response, fields, time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            fields = {}
+            token = _annotations.set(fields)
+            start = time.perf_counter()
+            response = None
+            try:
+                response = view_func(request, *args, **kwargs)
+                return response
+            finally:
+                _annotations.reset(token)
+                _record_response(endpoint, request, response, fields, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def recent_failures(username, since=None, limit=20):
+    """
+    Latest failed attempts of `username`, newest first
+
+    Args:
+        since: oldest time to include (default: AUDIT_FAILURE_WINDOW seconds ago)
+        limit: most events to return
+
+    Returns:
+        list of dicts with created_at, endpoint, status, error, distance and client_ip
+    """
+    if since is None:
+        since = timezone.now() - timedelta(seconds=settings.AUDIT_FAILURE_WINDOW)
+    oldest = month_of(since)
+    failures = []
+    for month in reversed(partitions()):
+        if month < oldest or len(failures) >= limit:
+            break
+        failures.extend(
+            partition_model(month).objects
+            .filter(username=username, success=False, created_at__gte=since)
+            .order_by('-created_at')
+            .values('created_at', 'endpoint', 'status', 'error', 'distance', 'client_ip')[:limit - len(failures)]
+        )
+    return failures
+
+
+def purge_months(keep):
+    """Drop the audit tables of months before the last `keep` (this one included); returns them"""
+    now = timezone.now().astimezone(dt_timezone.utc)
+    year, month = divmod(now.year * 12 + now.month - 1 - (keep - 1), 12)
+    cutoff = f'{year:04d}{month + 1:02d}'
+    dropped = []
+    for month in partitions():
+        if month < cutoff:
+            drop_partition(month)
+            dropped.append(month)
+    return dropped
+
+
+def reset_audit():
+    """Drop the writer and forget created partitions (tests)"""
+    global _writer
+    with _writer_lock:
+        _writer = None
+    _created.clear()
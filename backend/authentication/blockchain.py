@@ -0,0 +1,484 @@
+"""
+Blockchain transport: provider factory and per-call RPC latency tracking.
+
+The transport is chosen from the URL in settings.GANACHE_URL:
+
+    http(s)://host:port     pooled keep-alive HTTP session (default)
+    ws(s)://host:port       WebSocket provider
+    ipc:///path/geth.ipc    IPC provider (also any path ending in .ipc)
+
+Every provider built here is wrapped with a middleware that records how long
+each JSON-RPC call takes, so transports can be compared with
+``python manage.py rpc_latency``. The same timings are exported per endpoint
+as ``faceauth_rpc_seconds`` on /api/metrics/.
+
+Views get the Web3 client and FaceAuth contract from ``get_chain()``. Nothing
+here talks to the node at import time or in ``AppConfig.ready()``; the first
+RPC happens on the first request that needs the chain.
+"""
+import json
+import threading
+import time
+from pathlib import Path
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from web3 import AsyncWeb3, HTTPProvider, IPCProvider, Web3, WebsocketProvider
+
+from . import metrics
+
+
+class RPCLatencyStats:
+    """Thread-safe per-method latency samples for JSON-RPC calls"""
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, seconds):
+        """Record one call of `method` that took `seconds`"""
+        with self._lock:
+            samples = self._samples.setdefault(method, [])
+            samples.append(seconds)
+            if len(samples) > self.max_samples:
+                del samples[:len(samples) - self.max_samples]
+
+    def reset(self):
+        """Drop all recorded samples"""
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        """
+        Latency summary per RPC method
+
+        Returns:
+            dict: method -> {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms'}
+        """
+        with self._lock:
+            snapshot = {method: sorted(samples) for method, samples in self._samples.items()}
+
+        result = {}
+        for method, samples in snapshot.items():
+            count = len(samples)
+            result[method] = {
+                'count': count,
+                'mean_ms': sum(samples) / count * 1000,
+                'p50_ms': samples[int(count * 0.50)] * 1000,
+                'p95_ms': samples[min(count - 1, int(count * 0.95))] * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        return result
+
+
+rpc_latency = RPCLatencyStats()
+
+
+def rpc_latency_middleware(make_request, w3):
+    """Web3 middleware that records the latency of every RPC call"""
+    def middleware(method, params):
+        start = time.perf_counter()
+        try:
+            return make_request(method, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            rpc_latency.record(method, elapsed)
+            metrics.observe_rpc(method, elapsed)
+    return middleware
+
+
+async def async_rpc_latency_middleware(make_request, async_w3):
+    """AsyncWeb3 middleware that records the latency of every RPC call"""
+    async def middleware(method, params):
+        start = time.perf_counter()
+        try:
+            return await make_request(method, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            rpc_latency.record(method, elapsed)
+            metrics.observe_rpc(method, elapsed)
+    return middleware
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider that sends every request through one shared, tuned session.
+
+    Web3's own HTTPProvider keeps one default requests.Session per thread,
+    so the pool size and keep-alive behaviour cannot be tuned and each
+    worker thread opens its own connections.
+    """
+
+    def __init__(self, endpoint_uri, session, timeout):
+        super().__init__(endpoint_uri, request_kwargs={'timeout': timeout})
+        self.session = session
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+def make_http_session(pool_size):
+    """Build a keep-alive requests.Session with a connection pool of `pool_size`"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def transport_for(url):
+    """Return 'http', 'ws' or 'ipc' for a provider URL"""
+    if url.startswith(('ws://', 'wss://')):
+        return 'ws'
+    if url.startswith('ipc://') or url.endswith('.ipc'):
+        return 'ipc'
+    return 'http'
+
+
+def make_provider(url=None):
+    """
+    Build a Web3 provider for `url` (defaults to settings.GANACHE_URL)
+
+    Args:
+        url: http(s)://, ws(s)://, ipc:// URL or a path to an .ipc socket
+
+    Returns:
+        BaseProvider: configured provider
+    """
+    url = url or settings.GANACHE_URL
+    transport = transport_for(url)
+    read_timeout = settings.GANACHE_READ_TIMEOUT
+
+    if transport == 'ws':
+        return WebsocketProvider(url, websocket_timeout=read_timeout)
+    if transport == 'ipc':
+        path = url[len('ipc://'):] if url.startswith('ipc://') else url
+        return IPCProvider(path, timeout=read_timeout)
+    return PooledHTTPProvider(
+        url,
+        session=make_http_session(settings.GANACHE_POOL_SIZE),
+        timeout=(settings.GANACHE_CONNECT_TIMEOUT, read_timeout),
+    )
+
+
+def make_web3(url=None):
+    """Build a Web3 instance on make_provider(url) with RPC latency tracking"""
+    w3 = Web3(make_provider(url))
+    w3.middleware_onion.add(rpc_latency_middleware, 'rpc_latency')
+    return w3
+
+
+def make_async_web3(url=None):
+    """
+    Build an AsyncWeb3 instance with RPC latency tracking
+
+    Only HTTP is supported for AsyncWeb3 here; aiohttp already keeps a
+    keep-alive connection pool per event loop.
+    """
+    import aiohttp
+
+    url = url or settings.GANACHE_URL
+    if transport_for(url) != 'http':
+        raise ValueError(f"Async views need an http(s) GANACHE_URL, got: {url}")
+
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=settings.GANACHE_CONNECT_TIMEOUT,
+        sock_read=settings.GANACHE_READ_TIMEOUT,
+    )
+    async_w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(url, request_kwargs={'timeout': timeout}))
+    async_w3.middleware_onion.add(async_rpc_latency_middleware, 'rpc_latency')
+    return async_w3
+
+
+# FaceAuth contract ABI (functions used by the backend)
+CONTRACT_ABI = [
+    {
+        "inputs": [
+            {"internalType": "string", "name": "username", "type": "string"},
+            {"internalType": "string", "name": "passwordHash", "type": "string"},
+            {"internalType": "string", "name": "faceHash", "type": "string"}
+        ],
+        "name": "registerUser",
+        "outputs": [],
+        "stateMutability": "nonpayable",
+        "type": "function"
+    },
+    {
+        "inputs": [{"internalType": "string", "name": "username", "type": "string"}],
+        "name": "getUserHash",
+        "outputs": [
+            {"internalType": "string", "name": "passwordHash", "type": "string"},
+            {"internalType": "string", "name": "faceHash", "type": "string"}
+        ],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [{"internalType": "string[]", "name": "usernames", "type": "string[]"}],
+        "name": "getUserHashes",
+        "outputs": [
+            {"internalType": "bool[]", "name": "exists", "type": "bool[]"},
+            {"internalType": "string[]", "name": "passwordHashes", "type": "string[]"},
+            {"internalType": "string[]", "name": "faceHashes", "type": "string[]"}
+        ],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [{"internalType": "string", "name": "username", "type": "string"}],
+        "name": "isRegistered",
+        "outputs": [{"internalType": "bool", "name": "", "type": "bool"}],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [],
+        "name": "getUserCount",
+        "outputs": [{"internalType": "uint256", "name": "count", "type": "uint256"}],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [
+            {"internalType": "uint256", "name": "offset", "type": "uint256"},
+            {"internalType": "uint256", "name": "limit", "type": "uint256"}
+        ],
+        "name": "getUsers",
+        "outputs": [{"internalType": "string[]", "name": "usernames", "type": "string[]"}],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [
+            {"internalType": "bytes32", "name": "root", "type": "bytes32"},
+            {"internalType": "uint256", "name": "leafCount", "type": "uint256"}
+        ],
+        "name": "anchorRoot",
+        "outputs": [{"internalType": "uint256", "name": "epoch", "type": "uint256"}],
+        "stateMutability": "nonpayable",
+        "type": "function"
+    },
+    {
+        "inputs": [{"internalType": "uint256", "name": "epoch", "type": "uint256"}],
+        "name": "getAnchoredRoot",
+        "outputs": [{"internalType": "bytes32", "name": "root", "type": "bytes32"}],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "anonymous": False,
+        "inputs": [
+            {"indexed": True, "internalType": "uint256", "name": "epoch", "type": "uint256"},
+            {"indexed": False, "internalType": "bytes32", "name": "root", "type": "bytes32"},
+            {"indexed": False, "internalType": "uint256", "name": "leafCount", "type": "uint256"}
+        ],
+        "name": "RootAnchored",
+        "type": "event"
+    }
+]
+
+# Address the backend used before it was configurable; last-resort fallback
+LEGACY_CONTRACT_ADDRESS = "0xe78A0F7E598Cc8b0Bb87894B0F60dD2a88d6a8Ab"
+
+
+def contract_info_path():
+    """Path of blockchain/contract-info.json written by the deploy scripts"""
+    return Path(settings.BASE_DIR).parent / 'blockchain' / 'contract-info.json'
+
+
+def contract_artifact_path():
+    """
+    Compiled FaceAuth artifact (``truffle compile`` output) used to deploy the
+    contract on the in-process eth-tester chain
+    """
+    if settings.CONTRACT_ARTIFACT:
+        return Path(settings.CONTRACT_ARTIFACT)
+    return Path(settings.BASE_DIR).parent / 'blockchain' / 'build' / 'contracts' / 'FaceAuth.json'
+
+
+def resolve_contract_address():
+    """
+    Contract address from settings.CONTRACT_ADDRESS, then
+    blockchain/contract-info.json, then LEGACY_CONTRACT_ADDRESS
+    """
+    if settings.CONTRACT_ADDRESS:
+        return settings.CONTRACT_ADDRESS
+    try:
+        with open(contract_info_path()) as f:
+            address = json.load(f).get('address')
+        if address:
+            return address
+    except (OSError, ValueError):
+        pass
+    return LEGACY_CONTRACT_ADDRESS
+
+
+class ChainService:
+    """
+    Lazily connected Web3 client and FaceAuth contract.
+
+    Creating the service does no I/O; the providers are built on first
+    access to ``w3``/``async_w3`` and the node is contacted on the first call.
+    """
+
+    def __init__(self, url=None, address=None):
+        self.url = url or settings.GANACHE_URL
+        self.address = address if address is not None else resolve_contract_address()
+        self._lock = threading.Lock()
+        self._w3 = None
+        self._contract = None
+        self._async_w3 = None
+        self._async_contract = None
+
+    @property
+    def w3(self):
+        if self._w3 is None:
+            with self._lock:
+                if self._w3 is None:
+                    self._w3 = make_web3(self.url)
+        return self._w3
+
+    @property
+    def async_w3(self):
+        """AsyncWeb3 client; raises ValueError if GANACHE_URL is not http(s)"""
+        if self._async_w3 is None:
+            with self._lock:
+                if self._async_w3 is None:
+                    self._async_w3 = make_async_web3(self.url)
+        return self._async_w3
+
+    @property
+    def contract(self):
+        """FaceAuth contract, or None if no valid address is configured"""
+        if self._contract is None and self.address and Web3.is_address(self.address):
+            self._contract = self.w3.eth.contract(
+                address=Web3.to_checksum_address(self.address), abi=CONTRACT_ABI
+            )
+        return self._contract
+
+    @property
+    def async_contract(self):
+        """AsyncWeb3 FaceAuth contract, or None if no valid address is configured"""
+        if self._async_contract is None and self.address and Web3.is_address(self.address):
+            self._async_contract = self.async_w3.eth.contract(
+                address=Web3.to_checksum_address(self.address), abi=CONTRACT_ABI
+            )
+        return self._async_contract
+
+    def set_contract_address(self, address):
+        """Point the service at a newly deployed contract"""
+        self.address = address
+        self._contract = None
+        self._async_contract = None
+
+    def verify_contract_deployed(self, address=None):
+        """Verify that a contract is actually deployed at the given address"""
+        address = address or self.address
+        try:
+            if not self.w3.is_connected():
+                return False, "Not connected to blockchain"
+
+            if not Web3.is_address(address):
+                return False, "Invalid address format"
+
+            code = self.w3.eth.get_code(Web3.to_checksum_address(address))
+            if code == b'':
+                return False, "No contract code found at this address"
+
+            return True, "Contract verified"
+        except Exception as e:
+            return False, f"Error verifying contract: {str(e)}"
+
+    async def averify_contract_deployed(self, address=None):
+        """Async counterpart of verify_contract_deployed"""
+        address = address or self.address
+        try:
+            if not await self.async_w3.is_connected():
+                return False, "Not connected to blockchain"
+
+            if not Web3.is_address(address):
+                return False, "Invalid address format"
+
+            code = await self.async_w3.eth.get_code(Web3.to_checksum_address(address))
+            if code == b'':
+                return False, "No contract code found at this address"
+
+            return True, "Contract verified"
+        except Exception as e:
+            return False, f"Error verifying contract: {str(e)}"
+
+
+class EthTesterChain(ChainService):
+    """
+    ChainService on an in-process py-evm chain (eth-tester).
+
+    The FaceAuth contract is deployed from its compiled artifact when the
+    client is first used, so each process starts from an empty ledger. There
+    is no AsyncWeb3 client; callers run the sync client instead.
+    """
+
+    def __init__(self, artifact_path=None):
+        super().__init__(url='eth-tester', address='')
+        self.artifact_path = artifact_path or contract_artifact_path()
+
+    @property
+    def w3(self):
+        if self._w3 is None:
+            with self._lock:
+                if self._w3 is None:
+                    from web3 import EthereumTesterProvider
+
+                    w3 = Web3(EthereumTesterProvider())
+                    w3.middleware_onion.add(rpc_latency_middleware, 'rpc_latency')
+                    self.address = self._deploy(w3)
+                    self._w3 = w3
+        return self._w3
+
+    @property
+    def async_w3(self):
+        raise ValueError("The eth-tester chain has no async client")
+
+    @property
+    def contract(self):
+        self.w3  # deploys on first use and sets self.address
+        return super().contract
+
+    def _deploy(self, w3):
+        try:
+            with open(self.artifact_path) as f:
+                artifact = json.load(f)
+        except OSError:
+            raise FileNotFoundError(
+                f"Contract artifact not found at {self.artifact_path}. "
+                "Build it with: cd blockchain && npx truffle compile"
+            )
+        factory = w3.eth.contract(abi=artifact['abi'], bytecode=artifact['bytecode'])
+        tx_hash = factory.constructor().transact({'from': w3.eth.accounts[0]})
+        return w3.eth.wait_for_transaction_receipt(tx_hash).contractAddress
+
+
+_chain = None
+_chain_lock = threading.Lock()
+
+
+def get_chain():
+    """Return the process-wide ChainService, creating it on first use"""
+    global _chain
+    if _chain is None:
+        with _chain_lock:
+            if _chain is None:
+                _chain = ChainService()
+    return _chain
+
+
+def reset_chain():
+    """Drop the process-wide ChainService so it is rebuilt from current settings"""
+    global _chain
+    with _chain_lock:
+        _chain = None
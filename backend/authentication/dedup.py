@@ -0,0 +1,213 @@
+"""
+All-pairs duplicate-face search over stored encodings.
+
+Used by ``manage.py face_dedup_audit``. The work is split into three resumable
+steps inside a work directory:
+
+1. export     UserFaceEncoding rows are streamed into an (N, 128) float32
+              memmap plus a username list
+2. pairs      for each block row i, distances to blocks j >= i are computed
+              with one float32 matrix product per block pair and pairs under
+              the tolerance are saved to pairs/row_<i>.npz; block rows run in
+              a process pool and finished rows are skipped on resume
+3. clusters   the pairs are merged with union-find
+
+Squared distances use |a|^2 + |b|^2 - 2 a.b, so memory per worker is bounded
+by block_size^2 floats regardless of the number of users.
+"""
+import json
+import os
+
+import numpy as np
+
+ENCODING_DIM = 128
+MANIFEST = 'manifest.json'
+ENCODINGS = 'encodings.npy'
+USERNAMES = 'usernames.txt'
+PAIRS_DIR = 'pairs'
+
+
+def _limit_blas_threads():
+    """Pool initializer: one BLAS thread per worker process (threadpoolctl is optional)"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(1)
+
+
+def export_encodings(rows, count, work_dir):
+    """
+    Write encodings to the work directory
+
+    Args:
+        rows: iterable of (username, face_encoding_json)
+        count: number of rows `rows` will yield (upper bound)
+        work_dir: directory for the memmap and username list
+
+    Returns:
+        int: rows written
+    """
+    matrix = np.lib.format.open_memmap(
+        os.path.join(work_dir, ENCODINGS), mode='w+', dtype=np.float32,
+        shape=(max(count, 1), ENCODING_DIM)
+    )
+    written = 0
+    with open(os.path.join(work_dir, USERNAMES), 'w') as names:
+        for username, encoding_json in rows:
+            if written >= count:
+                break
+            vector = json.loads(encoding_json)
+            if len(vector) != ENCODING_DIM:
+                continue
+            matrix[written] = vector
+            names.write(username + '\n')
+            written += 1
+    matrix.flush()
+    del matrix
+    return written
+
+
+def load_encodings(work_dir, count):
+    """Read-only view of the first `count` exported encodings"""
+    matrix = np.load(os.path.join(work_dir, ENCODINGS), mmap_mode='r')
+    return matrix[:count]
+
+
+def load_usernames(work_dir):
+    with open(os.path.join(work_dir, USERNAMES)) as f:
+        return f.read().splitlines()
+
+
+def row_path(work_dir, block_row):
+    return os.path.join(work_dir, PAIRS_DIR, f'row_{block_row:06d}.npz')
+
+
+def audit_block_row(work_dir, count, block_size, tolerance, block_row):
+    """
+    Find all pairs (a, b), a in block `block_row`, b > a, closer than `tolerance`
+
+    Results are written atomically to pairs/row_<block_row>.npz.
+
+    Returns:
+        int: number of pairs found
+    """
+    matrix = load_encodings(work_dir, count)
+    threshold = np.float32(tolerance) ** 2
+
+    start = block_row * block_size
+    left = np.ascontiguousarray(matrix[start:start + block_size])
+    left_norms = np.einsum('ij,ij->i', left, left)
+    left_scaled = left * np.float32(-2)
+
+    found_a, found_b, found_d = [], [], []
+    for other in range(start, count, block_size):
+        right = np.ascontiguousarray(matrix[other:other + block_size])
+        right_norms = np.einsum('ij,ij->i', right, right)
+
+        dist2 = left_scaled @ right.T
+        dist2 += left_norms[:, None]
+        dist2 += right_norms
+        if other == start:
+            # Same block: keep only the upper triangle (b > a)
+            dist2[np.tril_indices(len(left), m=len(right))] = np.inf
+
+        close = dist2 < threshold
+        # Most blocks have no match; any() is far cheaper than nonzero()
+        if not close.any():
+            continue
+        rows, cols = np.nonzero(close)
+        found_a.append(rows + start)
+        found_b.append(cols + other)
+        found_d.append(np.sqrt(np.maximum(dist2[rows, cols], 0)))
+
+    pairs_a = np.concatenate(found_a).astype(np.int64) if found_a else np.empty(0, np.int64)
+    pairs_b = np.concatenate(found_b).astype(np.int64) if found_b else np.empty(0, np.int64)
+    distances = np.concatenate(found_d).astype(np.float32) if found_d else np.empty(0, np.float32)
+
+    path = row_path(work_dir, block_row)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, a=pairs_a, b=pairs_b, distance=distances)
+    os.replace(tmp_path, path)
+    return len(pairs_a)
+
+
+def pending_block_rows(work_dir, count, block_size):
+    """Block rows without a finished pairs file"""
+    total = (count + block_size - 1) // block_size
+    return [i for i in range(total) if not os.path.exists(row_path(work_dir, i))]
+
+
+def load_pairs(work_dir, count, block_size):
+    """Concatenate all saved pairs as (a, b, distance) arrays"""
+    total = (count + block_size - 1) // block_size
+    parts = [np.load(row_path(work_dir, i)) for i in range(total)]
+    if not parts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    return (
+        np.concatenate([p['a'] for p in parts]),
+        np.concatenate([p['b'] for p in parts]),
+        np.concatenate([p['distance'] for p in parts]),
+    )
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with path halving and union by size"""
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+
+
+def find_clusters(count, pairs_a, pairs_b, distances):
+    """
+    Group users connected by a close pair
+
+    Returns:
+        list of (member_indices, max_pair_distance), largest cluster first
+    """
+    sets = UnionFind(count)
+    for a, b in zip(pairs_a.tolist(), pairs_b.tolist()):
+        sets.union(a, b)
+
+    members = {}
+    worst = {}
+    for a, b, distance in zip(pairs_a.tolist(), pairs_b.tolist(), distances.tolist()):
+        root = sets.find(a)
+        members.setdefault(root, set()).update((a, b))
+        worst[root] = max(worst.get(root, 0.0), distance)
+
+    clusters = [(sorted(m), worst[root]) for root, m in members.items()]
+    clusters.sort(key=lambda c: (-len(c[0]), c[0][0]))
+    return clusters
+
+
+def read_manifest(work_dir):
+    try:
+        with open(os.path.join(work_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(work_dir, manifest):
+    path = os.path.join(work_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
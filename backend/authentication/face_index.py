@@ -0,0 +1,101 @@
+"""
+Candidate search over stored encodings through face key buckets.
+
+Every UserFaceEncoding is indexed under the BANDS buckets of its face key
+(face_module/face_keys.py) in FaceKeyBucket; post_save / post_delete
+receivers, connected in apps.py, keep the rows in step with the table.
+
+``find_matches`` looks a probe encoding up in its own buckets plus
+FACE_INDEX_PROBES multi-probe buckets per band: one indexed query instead
+of a scan. The exact distance is then checked on the few candidates found.
+Captures of one face share a bucket with high probability, not always, so
+a miss is possible (face_module/evaluate_face_keys.py measures hit rates).
+
+Buckets depend on FACE_KEY_SEED. After changing it, or for encodings stored
+before the index existed, rebuild with ``manage.py index_face_keys``.
+"""
+import os
+import sys
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from .models import FaceKeyBucket, UserFaceEncoding
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+from face_module.face_keys import face_buckets, face_key, probe_buckets
+
+
+def bucket_rows(username, encoding):
+    """FaceKeyBucket rows (unsaved) for `username`'s encoding"""
+    return [FaceKeyBucket(username=username, bucket=bucket)
+            for bucket in face_buckets(face_key(encoding, settings.FACE_KEY_SEED))]
+
+
+def index(username, encoding):
+    """Replace the buckets of `username` with those of `encoding`"""
+    with transaction.atomic():
+        FaceKeyBucket.objects.filter(username=username).delete()
+        FaceKeyBucket.objects.bulk_create(bucket_rows(username, encoding))
+
+
+def unindex(username):
+    FaceKeyBucket.objects.filter(username=username).delete()
+
+
+def index_encoding(sender, instance, **kwargs):
+    """post_save receiver for UserFaceEncoding"""
+    index(instance.username, instance.get_encoding())
+
+
+def unindex_encoding(sender, instance, **kwargs):
+    """post_delete receiver for UserFaceEncoding"""
+    unindex(instance.username)
+
+
+def candidates(encoding, probes=None):
+    """Usernames sharing at least one probed bucket with `encoding`"""
+    probes = settings.FACE_INDEX_PROBES if probes is None else probes
+    buckets = probe_buckets(encoding, probes, settings.FACE_KEY_SEED)
+    if not buckets:
+        return set()
+    return set(FaceKeyBucket.objects.filter(bucket__in=buckets).values_list('username', flat=True))
+
+
+def find_matches(encoding, tolerance=None, exclude=None, probes=None):
+    """
+    Stored encodings within `tolerance` (default FACE_MATCH_TOLERANCE) of `encoding`
+
+    Returns:
+        list of (username, distance), closest first; `exclude` is left out
+    """
+    tolerance = settings.FACE_MATCH_TOLERANCE if tolerance is None else tolerance
+    usernames = candidates(encoding, probes)
+    usernames.discard(exclude)
+    if not usernames:
+        return []
+    rows = list(UserFaceEncoding.objects.filter(username__in=usernames))
+    if not rows:
+        return []
+    # Euclidean distance, as face_recognition.face_distance
+    distances = np.linalg.norm(np.array([row.get_encoding() for row in rows]) - np.asarray(encoding), axis=1)
+    matches = [(row.username, float(distance)) for row, distance in zip(rows, distances) if distance <= tolerance]
+    return sorted(matches, key=lambda match: match[1])
+
+
+def rebuild(batch_size=1000):
+    """Re-index every stored encoding (after a FACE_KEY_SEED change or for older rows); returns the count"""
+    count = 0
+    with transaction.atomic():
+        FaceKeyBucket.objects.all().delete()
+        rows = UserFaceEncoding.objects.order_by('id').values_list('username', 'face_encoding')
+        batch = []
+        for username, encoding_json in rows.iterator(chunk_size=batch_size):
+            batch.extend(bucket_rows(username, UserFaceEncoding(face_encoding=encoding_json).get_encoding()))
+            count += 1
+            if len(batch) >= batch_size:
+                FaceKeyBucket.objects.bulk_create(batch)
+                batch = []
+        FaceKeyBucket.objects.bulk_create(batch)
+    return count
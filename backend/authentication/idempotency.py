@@ -0,0 +1,276 @@
+"""
+Idempotency-Key support for register/verify.
+
+A client that retries after a timeout sends the same ``Idempotency-Key``
+header. The first request claims the key by inserting a pending
+IdempotencyRecord and runs the view. A retry with the same key then either
+waits for that request to finish, or replays the stored response with
+``Idempotent-Replayed: true``. Either way the face encode, ledger RPCs and
+the registerUser transaction are not repeated.
+
+    2xx / 4xx responses   stored until IDEMPOTENCY_TTL expires
+    5xx / 429 /           key released, so a retry runs the request again
+    exceptions
+    same key, different   422; the key is bound to a fingerprint of the
+    request               parsed credentials, encoding mode, face box and
+                          image bytes (not the raw body: multipart
+                          boundaries change on every send)
+    still pending after   409 with Retry-After
+    IDEMPOTENCY_WAIT
+
+Records live in the database, so retries landing on another worker process
+are covered as well. A pending claim older than IDEMPOTENCY_LOCK_TIMEOUT
+(its worker died) may be taken over. ``manage.py purge_idempotency_keys``
+deletes expired records.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyRecord
+from .payloads import PayloadError, parse_face_request
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# Poll interval while waiting on another request holding the key
+POLL_START = 0.02
+POLL_MAX = 0.25
+
+
+class IdempotencyConflict(Exception):
+    """The key cannot be used for this request; carries the HTTP status to return"""
+
+    def __init__(self, message, status=409, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def request_fingerprint(request, endpoint):
+    """
+    sha256 over everything that determines the outcome of a register/verify request
+
+    Built from the parsed request (``parse_face_request`` keeps the result for
+    the view), so the same upload sent as JSON, multipart with a fresh
+    boundary or a raw body fingerprints alike.
+
+    Raises:
+        PayloadError: the body is malformed or over its limits
+    """
+    data, face_image_bytes = parse_face_request(request)
+    fields = {
+        'endpoint': endpoint,
+        'username': data.get('username'),
+        'password': data.get('password'),
+        'encoding': request.GET.get('encoding') or data.get('encoding'),
+        'face_box': data.get('face_box') or request.GET.get('face_box') or request.headers.get('X-Face-Box'),
+        'image': hashlib.sha256(face_image_bytes or b'').hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _fingerprint_or_none(request, endpoint):
+    # A body the view will reject runs unchanged: the view returns the error
+    try:
+        return request_fingerprint(request, endpoint)
+    except PayloadError:
+        return None
+
+
+def claim(key, endpoint, fingerprint):
+    """
+    Claim `key` for this request, or return the record of the request that holds it
+
+    Returns:
+        None if claimed (run the view), else the existing IdempotencyRecord
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(
+                key=key, endpoint=endpoint, fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL),
+            )
+        return None
+    except IntegrityError:
+        pass
+
+    record = IdempotencyRecord.objects.filter(key=key).first()
+    if record is None:
+        return claim(key, endpoint, fingerprint)  # released in the meantime
+    if record.endpoint != endpoint or record.fingerprint != fingerprint:
+        raise IdempotencyConflict(
+            f'{HEADER} was already used for a different request', status=422
+        )
+
+    stale_pending = (
+        record.state == IdempotencyRecord.PENDING
+        and record.created_at < now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    )
+    if record.expires_at <= now or stale_pending:
+        # Take over atomically: only one retry may win the update
+        taken = IdempotencyRecord.objects.filter(pk=record.pk, created_at=record.created_at).update(
+            state=IdempotencyRecord.PENDING, created_at=now, response_status=None, response_body=b'',
+            expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_TTL),
+        )
+        if taken:
+            return None
+        record.refresh_from_db()
+    return record
+
+
+def finish(key, response):
+    """Store a final response, or release the key so a retry runs again (errors, shed requests)"""
+    if response is None or response.status_code >= 500 or response.status_code == 429:
+        release(key)
+        return
+    IdempotencyRecord.objects.filter(key=key).update(
+        state=IdempotencyRecord.DONE,
+        response_status=response.status_code,
+        response_content_type=response.get('Content-Type', 'application/json'),
+        response_body=response.content,
+    )
+
+
+def release(key):
+    IdempotencyRecord.objects.filter(key=key, state=IdempotencyRecord.PENDING).delete()
+
+
+def replay(record):
+    response = HttpResponse(
+        bytes(record.response_body), status=record.response_status,
+        content_type=record.response_content_type,
+    )
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _pending_error():
+    return IdempotencyConflict(
+        'A request with this Idempotency-Key is still in progress', status=409, retry_after=1
+    )
+
+
+def wait_for(key, record):
+    """Poll until the request holding `key` finishes; returns its response"""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    delay = POLL_START
+    while record.state == IdempotencyRecord.PENDING:
+        if time.monotonic() >= deadline:
+            raise _pending_error()
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+        record = IdempotencyRecord.objects.filter(key=key).first()
+        if record is None:
+            return None  # released after a failure: caller runs the request
+    return replay(record)
+
+
+async def await_for(key, record):
+    """wait_for for async views: sleeps on the event loop between polls"""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    delay = POLL_START
+    while record.state == IdempotencyRecord.PENDING:
+        if time.monotonic() >= deadline:
+            raise _pending_error()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+        record = await IdempotencyRecord.objects.filter(key=key).afirst()
+        if record is None:
+            return None
+    return replay(record)
+
+
+def _conflict_response(error):
+    response = JsonResponse({'error': str(error)}, status=error.status)
+    if error.retry_after:
+        response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _read_key(request):
+    key = request.headers.get(HEADER)
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        raise IdempotencyConflict(f'Invalid {HEADER} header', status=400)
+    return key
+
+
+def idempotent(endpoint):
+    """
+    Decorator making a sync or async POST view honour Idempotency-Key.
+
+    Requests without the header, and malformed or oversized bodies (which
+    the view rejects anyway), run unchanged. `endpoint` scopes keys, so sync and
+    async variants of the same operation share them.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                try:
+                    key = _read_key(request)
+                    fingerprint = _fingerprint_or_none(request, endpoint) if key is not None else None
+                    if fingerprint is None:
+                        return await view_func(request, *args, **kwargs)
+                    while True:
+                        record = await sync_to_async(claim)(key, endpoint, fingerprint)
+                        if record is None:
+                            break
+                        response = await await_for(key, record)
+                        if response is not None:
+                            return response
+                except IdempotencyConflict as e:
+                    return _conflict_response(e)
+
+                response = None
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                    return response
+                finally:
+                    await sync_to_async(finish)(key, response)
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            try:
+                key = _read_key(request)
+                fingerprint = _fingerprint_or_none(request, endpoint) if key is not None else None
+                if fingerprint is None:
+                    return view_func(request, *args, **kwargs)
+                while True:
+                    record = claim(key, endpoint, fingerprint)
+                    if record is None:
+                        break
+                    response = wait_for(key, record)
+                    if response is not None:
+                        return response
+            except IdempotencyConflict as e:
+                return _conflict_response(e)
+
+            response = None
+            try:
+                response = view_func(request, *args, **kwargs)
+                return response
+            finally:
+                finish(key, response)
+        return wrapper
+    return decorator
+
+
+def purge_expired():
+    """Delete expired records; returns how many were removed"""
+    deleted, _ = IdempotencyRecord.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
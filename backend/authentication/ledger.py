@@ -0,0 +1,515 @@
+"""
+Ledger backends: where user records (password hash, face hash) are stored.
+
+The views only talk to the ledger returned by ``get_ledger()``; the backend is
+chosen with settings.LEDGER_BACKEND:
+
+    web3        FaceAuth contract on the node at GANACHE_URL (default)
+    eth_tester  FaceAuth on an in-process py-evm chain, deployed on first use
+    memory      pure-Python implementation of the contract's rules
+
+eth_tester and memory need no Ganache, which makes them suitable for tests,
+load tests of the HTTP/DB/encoding path, and local development. Their state
+lives in the process and is lost on restart.
+
+With settings.REGISTRATION_MODE = 'merkle' the backend is wrapped in a
+MerkleLedger (merkle.py), which batches new registrations under Merkle
+roots anchored once per epoch.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .blockchain import EthTesterChain, get_chain
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerError(Exception):
+    """Ledger unavailable or operation rejected; carries the HTTP status to return"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+class Ledger:
+    """
+    Interface shared by all backends.
+
+    The async methods default to calling the sync ones, which is right for
+    backends that do no network I/O.
+    """
+
+    name = None
+
+    def check_ready(self):
+        """Raise LedgerError if the ledger cannot serve requests"""
+
+    def is_registered(self, username):
+        raise NotImplementedError
+
+    def get_user_hash(self, username):
+        """Return (password_hash, face_hash) of a registered user"""
+        raise NotImplementedError
+
+    def get_user_hashes(self, usernames):
+        """
+        Look up many users at once
+
+        Returns:
+            dict: username -> (password_hash, face_hash) for the registered
+            ones; unregistered usernames are left out. A user whose record
+            exists but cannot be used maps to the LedgerError a single
+            get_user_hash would raise for them.
+        """
+        return {
+            username: self.get_user_hash(username)
+            for username in usernames if self.is_registered(username)
+        }
+
+    def user_count(self):
+        """Number of registered users"""
+        raise NotImplementedError
+
+    def get_users(self, offset, limit):
+        """Up to `limit` usernames in registration order, starting at `offset`"""
+        raise NotImplementedError
+
+    def register_user(self, username, password_hash, face_hash):
+        """
+        Store a new user record
+
+        Returns:
+            str: transaction hash, or None for backends without transactions
+
+        Raises:
+            LedgerError: the ledger rejected the registration
+        """
+        raise NotImplementedError
+
+    def anchor_root(self, root, leaf_count):
+        """
+        Anchor the Merkle root ('0x...') of `leaf_count` registrations as a new epoch
+
+        Returns:
+            tuple: (epoch, transaction hash or None)
+        """
+        raise NotImplementedError
+
+    def get_anchored_root(self, epoch):
+        """Root ('0x...') anchored for `epoch`, or None if there is no such epoch"""
+        raise NotImplementedError
+
+    async def acheck_ready(self):
+        return self.check_ready()
+
+    async def ais_registered(self, username):
+        return self.is_registered(username)
+
+    async def aget_user_hash(self, username):
+        return self.get_user_hash(username)
+
+    async def aregister_user(self, username, password_hash, face_hash):
+        return self.register_user(username, password_hash, face_hash)
+
+    async def aget_anchored_root(self, epoch):
+        return self.get_anchored_root(epoch)
+
+
+class MemoryLedger(Ledger):
+    """Thread-safe dict with the same validation rules as FaceAuth.sol"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._users = {}
+        self._order = []
+        self._roots = []
+        self._lock = threading.Lock()
+
+    def is_registered(self, username):
+        return username in self._users
+
+    def user_count(self):
+        return len(self._order)
+
+    def get_users(self, offset, limit):
+        return self._order[offset:offset + limit]
+
+    def get_user_hash(self, username):
+        try:
+            return self._users[username]
+        except KeyError:
+            raise LedgerError('User does not exist', status=404)
+
+    def get_user_hashes(self, usernames):
+        users = self._users
+        return {username: users[username] for username in usernames if username in users}
+
+    def register_user(self, username, password_hash, face_hash):
+        if not username:
+            raise LedgerError('Validation error: Username cannot be empty', status=400)
+        if not password_hash or not face_hash:
+            raise LedgerError('Validation error: hash cannot be empty', status=400)
+        with self._lock:
+            if username in self._users:
+                raise LedgerError('User already exists on blockchain', status=400)
+            self._users[username] = (password_hash, face_hash)
+            self._order.append(username)
+        return None
+
+    def anchor_root(self, root, leaf_count):
+        if int(root, 16) == 0 or leaf_count <= 0:
+            raise LedgerError('Validation error: root and batch cannot be empty', status=400)
+        with self._lock:
+            self._roots.append(root)
+            return len(self._roots) - 1, None
+
+    def get_anchored_root(self, epoch):
+        return self._roots[epoch] if 0 <= epoch < len(self._roots) else None
+
+
+class Web3Ledger(Ledger):
+    """FaceAuth contract reached through a ChainService"""
+
+    name = 'web3'
+    # Pause after the receipt before re-reading state (Ganache can lag a little)
+    settle_delay = 0.5
+    # Usernames per getUserHashes call (bounds eth_call gas and response size)
+    hashes_per_call = 100
+
+    def __init__(self, chain=None):
+        self._chain = chain
+
+    @property
+    def chain(self):
+        # Looked up on every use so reset_chain()/set_contract_address() apply
+        return self._chain or get_chain()
+
+    def check_ready(self):
+        chain = self.chain
+        if not chain.w3.is_connected():
+            logger.error("Web3 not connected")
+            raise LedgerError('Blockchain not connected. Is Ganache running?')
+
+        if not chain.contract:
+            logger.error("Contract not initialized")
+            raise LedgerError(
+                'Contract not deployed. Please deploy the contract first using: cd blockchain && npx truffle migrate'
+            )
+
+        is_deployed, message = chain.verify_contract_deployed()
+        if not is_deployed:
+            logger.error("Contract verification failed: %s", message)
+            raise LedgerError(f'Contract not found at address {chain.address}. Please deploy the contract first.')
+
+    def is_registered(self, username):
+        return self.chain.contract.functions.isRegistered(username).call()
+
+    def get_user_hash(self, username):
+        stored_data = self.chain.contract.functions.getUserHash(username).call()
+        return parse_user_hash(stored_data)
+
+    def get_user_hashes(self, usernames):
+        # One eth_call per chunk instead of isRegistered + getUserHash per user
+        contract = self.chain.contract
+        usernames = list(dict.fromkeys(usernames))
+        found = {}
+        for start in range(0, len(usernames), self.hashes_per_call):
+            chunk = usernames[start:start + self.hashes_per_call]
+            exists, password_hashes, face_hashes = contract.functions.getUserHashes(chunk).call()
+            for username, registered, password_hash, face_hash in zip(chunk, exists, password_hashes, face_hashes):
+                if registered:
+                    found[username] = (password_hash, face_hash)
+        return found
+
+    def user_count(self):
+        return self.chain.contract.functions.getUserCount().call()
+
+    def get_users(self, offset, limit):
+        return self.chain.contract.functions.getUsers(offset, limit).call()
+
+    def _transact(self, contract_call):
+        """
+        Send `contract_call` from the first node account and wait for it to be mined
+
+        Returns:
+            tuple: (tx_hash, receipt) of a successful transaction
+
+        Raises:
+            LedgerError: no usable account, or the transaction reverted
+        """
+        w3 = self.chain.w3
+
+        # Get account for transaction
+        accounts = w3.eth.accounts
+        if not accounts:
+            raise LedgerError('No accounts available')
+        account = accounts[0]
+        logger.debug("Sending transaction with account: %s", account)
+
+        # Check account balance
+        if w3.eth.get_balance(account) == 0:
+            raise LedgerError('Account has no balance. Check Ganache accounts.')
+
+        # Estimate gas first
+        try:
+            gas_limit = int(contract_call.estimate_gas({'from': account}) * 1.2)  # Add 20% buffer
+        except Exception as e:
+            logger.warning("Gas estimation failed: %s", e)
+            gas_limit = 300000  # Use default if estimation fails
+
+        tx = contract_call.build_transaction({
+            'from': account,
+            'gas': gas_limit,
+            'gasPrice': w3.eth.gas_price,
+            'nonce': w3.eth.get_transaction_count(account)
+        })
+        logger.debug("Transaction: gas limit=%s gas price=%s nonce=%s",
+                     gas_limit, tx['gasPrice'], tx['nonce'])
+
+        tx_hash = w3.eth.send_transaction(tx)
+        logger.debug("Waiting for transaction: %s", tx_hash.hex())
+        with stage('receipt_wait'):
+            receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
+
+        # Check transaction status (1 = success, 0 = failed)
+        if receipt.status != 1:
+            logger.error("Transaction %s failed with status %s (gas used %s, block %s)",
+                         tx_hash.hex(), receipt.status, receipt.gasUsed, receipt.blockNumber)
+            # Call the function directly to get the revert reason
+            try:
+                contract_call.call({'from': account})
+            except Exception as call_error:
+                raise revert_error(call_error)
+            raise LedgerError(
+                f'Transaction failed on blockchain. Status: {receipt.status}. Check Ganache console for revert reason.'
+            )
+        return tx_hash, receipt
+
+    def register_user(self, username, password_hash, face_hash):
+        contract = self.chain.contract
+        tx_hash, receipt = self._transact(contract.functions.registerUser(username, password_hash, face_hash))
+
+        logger.debug("Transaction confirmed, %d events emitted", len(receipt.logs))
+        if self.settle_delay:
+            time.sleep(self.settle_delay)
+
+        # Verify user is now registered on blockchain
+        try:
+            registered = contract.functions.isRegistered(username).call()
+        except Exception as e:
+            logger.exception("Error verifying user: %s", e)
+            raise LedgerError(f'Error verifying registration: {str(e)}')
+        if not registered:
+            logger.error("User registration failed - not found on blockchain after transaction")
+            raise LedgerError(
+                'Registration transaction succeeded but user not found. This might be a contract issue. Check Ganache logs.'
+            )
+        return tx_hash.hex()
+
+    def anchor_root(self, root, leaf_count):
+        contract = self.chain.contract
+        tx_hash, receipt = self._transact(contract.functions.anchorRoot(root, leaf_count))
+        events = contract.events.RootAnchored().process_receipt(receipt)
+        if not events:
+            raise LedgerError('anchorRoot transaction emitted no RootAnchored event. Is the contract up to date?')
+        return events[0].args.epoch, tx_hash.hex()
+
+    def get_anchored_root(self, epoch):
+        root = self.chain.contract.functions.getAnchoredRoot(epoch).call()
+        return None if not any(root) else '0x' + root.hex()
+
+    async def acheck_ready(self):
+        chain = self.chain
+        try:
+            connected = await chain.async_w3.is_connected()
+        except ValueError as e:
+            logger.error("Async endpoints unavailable: %s", e)
+            connected = False
+        if not connected:
+            logger.error("Web3 not connected")
+            raise LedgerError('Blockchain not connected. Is Ganache running?')
+
+        if not chain.async_contract:
+            logger.error("Contract not initialized")
+            raise LedgerError(
+                'Contract not deployed. Please deploy the contract first using: cd blockchain && npx truffle migrate'
+            )
+
+        is_deployed, message = await chain.averify_contract_deployed()
+        if not is_deployed:
+            logger.error("Contract verification failed: %s", message)
+            raise LedgerError(f'Contract not found at address {chain.address}. Please deploy the contract first.')
+
+    async def ais_registered(self, username):
+        return await self.chain.async_contract.functions.isRegistered(username).call()
+
+    async def aget_user_hash(self, username):
+        stored_data = await self.chain.async_contract.functions.getUserHash(username).call()
+        return parse_user_hash(stored_data)
+
+    async def aregister_user(self, username, password_hash, face_hash):
+        chain = self.chain
+        async_w3 = chain.async_w3
+        contract = chain.async_contract
+
+        accounts = await async_w3.eth.accounts
+        if not accounts:
+            raise LedgerError('No accounts available')
+        account = accounts[0]
+
+        if await async_w3.eth.get_balance(account) == 0:
+            raise LedgerError('Account has no balance. Check Ganache accounts.')
+
+        register_call = contract.functions.registerUser(username, password_hash, face_hash)
+        try:
+            gas_limit = int(await register_call.estimate_gas({'from': account}) * 1.2)  # Add 20% buffer
+        except Exception as e:
+            logger.warning("Gas estimation failed: %s", e)
+            gas_limit = 300000  # Use default if estimation fails
+
+        gas_price, nonce = await asyncio.gather(
+            async_w3.eth.gas_price,
+            async_w3.eth.get_transaction_count(account),
+        )
+        tx = await register_call.build_transaction({
+            'from': account,
+            'gas': gas_limit,
+            'gasPrice': gas_price,
+            'nonce': nonce,
+        })
+
+        tx_hash = await async_w3.eth.send_transaction(tx)
+        logger.debug("Waiting for transaction: %s", tx_hash.hex())
+        with stage('receipt_wait'):
+            receipt = await async_w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
+
+        if receipt.status != 1:
+            logger.error("Transaction %s failed with status %s", tx_hash.hex(), receipt.status)
+            try:
+                await register_call.call({'from': account})
+            except Exception as call_error:
+                raise revert_error(call_error)
+            raise LedgerError(
+                f'Transaction failed on blockchain. Status: {receipt.status}. Check Ganache console for revert reason.'
+            )
+
+        if not await contract.functions.isRegistered(username).call():
+            logger.error("User registration failed - not found on blockchain after transaction")
+            raise LedgerError(
+                'Registration transaction succeeded but user not found. This might be a contract issue. Check Ganache logs.'
+            )
+        return tx_hash.hex()
+
+    async def aget_anchored_root(self, epoch):
+        root = await self.chain.async_contract.functions.getAnchoredRoot(epoch).call()
+        return None if not any(root) else '0x' + root.hex()
+
+
+class EthTesterLedger(Web3Ledger):
+    """FaceAuth on an in-process eth-tester chain; blocks are mined instantly"""
+
+    name = 'eth_tester'
+    settle_delay = 0
+
+    def __init__(self, chain=None):
+        super().__init__(chain or EthTesterChain())
+
+    def check_ready(self):
+        try:
+            self.chain.w3  # builds the chain and deploys FaceAuth
+        except (ImportError, FileNotFoundError) as e:
+            logger.error("eth-tester ledger unavailable: %s", e)
+            raise LedgerError(f'In-process chain unavailable: {e}')
+        super().check_ready()
+
+    # No AsyncWeb3 client for eth-tester; the sync calls stay in-process
+    acheck_ready = Ledger.acheck_ready
+    ais_registered = Ledger.ais_registered
+    aget_user_hash = Ledger.aget_user_hash
+    aregister_user = Ledger.aregister_user
+    aget_anchored_root = Ledger.aget_anchored_root
+
+
+def parse_user_hash(stored_data):
+    """
+    Split getUserHash() output into (password_hash, face_hash).
+
+    Handles the tuple returned by the current contract as well as the list
+    and "password|face" string forms of older deployments.
+    """
+    if isinstance(stored_data, (tuple, list)):
+        if len(stored_data) == 2:
+            return stored_data[0], stored_data[1]
+    elif isinstance(stored_data, str):
+        if '|' in stored_data:
+            password_hash, face_hash = stored_data.split('|')
+            return password_hash, face_hash
+    else:
+        raise LedgerError(f'Unexpected data type from blockchain: {type(stored_data)}')
+    raise LedgerError(f'Invalid user data format from blockchain: {stored_data}')
+
+
+def revert_error(call_error):
+    """Map a registerUser revert reason to a LedgerError"""
+    logger.error("Revert reason: %s", call_error)
+    error_msg = str(call_error)
+    if "User already exists" in error_msg:
+        return LedgerError('User already exists on blockchain', status=400)
+    if "cannot be empty" in error_msg:
+        return LedgerError(f'Validation error: {error_msg}', status=400)
+    return LedgerError(f'Transaction reverted: {error_msg}. Check Ganache logs for more details.')
+
+
+LEDGER_BACKENDS = {
+    'web3': Web3Ledger,
+    'eth_tester': EthTesterLedger,
+    'memory': MemoryLedger,
+}
+
+_ledger = None
+_ledger_key = None
+_ledger_lock = threading.Lock()
+
+REGISTRATION_MODES = ('direct', 'merkle')
+
+
+def get_ledger():
+    """
+    Return the process-wide ledger for settings.LEDGER_BACKEND, wrapped in a
+    MerkleLedger when settings.REGISTRATION_MODE is 'merkle'
+    """
+    global _ledger, _ledger_key
+    key = (settings.LEDGER_BACKEND, settings.REGISTRATION_MODE)
+    if _ledger is None or _ledger_key != key:
+        with _ledger_lock:
+            if _ledger is None or _ledger_key != key:
+                backend, mode = key
+                if mode not in REGISTRATION_MODES:
+                    raise ValueError(
+                        f"Unknown REGISTRATION_MODE: {mode}. Use one of: {', '.join(REGISTRATION_MODES)}"
+                    )
+                try:
+                    ledger = LEDGER_BACKENDS[backend]()
+                except KeyError:
+                    raise ValueError(
+                        f"Unknown LEDGER_BACKEND: {backend}. Use one of: {', '.join(LEDGER_BACKENDS)}"
+                    )
+                if mode == 'merkle':
+                    from .merkle import MerkleLedger
+                    ledger = MerkleLedger(ledger)
+                _ledger, _ledger_key = ledger, key
+    return _ledger
+
+
+def reset_ledger():
+    """Drop the process-wide ledger (and its state, for in-process backends)"""
+    global _ledger, _ledger_key
+    with _ledger_lock:
+        _ledger = _ledger_key = None
@@ -0,0 +1,51 @@
+"""
+Anchor pending Merkle-mode registrations on chain, one root per epoch.
+
+    python manage.py anchor_registrations
+    python manage.py anchor_registrations --every 300
+
+Each run builds a Merkle tree over every registration still waiting for an
+epoch, sends one FaceAuth.anchorRoot transaction and stores each user's
+inclusion proof; the users can log in from then on. With --every the
+command keeps anchoring at that interval (seconds) until interrupted.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.ledger import LedgerError, get_ledger
+from authentication.merkle import anchor_pending
+
+
+class Command(BaseCommand):
+    help = "Anchor pending Merkle-mode registrations with one anchorRoot transaction"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='keep anchoring every this many seconds')
+
+    def handle(self, *args, **options):
+        if settings.REGISTRATION_MODE != 'merkle':
+            self.stderr.write(self.style.WARNING(
+                f"REGISTRATION_MODE is {settings.REGISTRATION_MODE!r}; only 'merkle' registrations are anchored"
+            ))
+        ledger = get_ledger()
+        while True:
+            try:
+                ledger.check_ready()
+                anchored = anchor_pending(ledger)
+            except LedgerError as e:
+                if not options['every']:
+                    raise CommandError(str(e))
+                self.stderr.write(self.style.ERROR(f"Anchoring failed, will retry: {e}"))
+                anchored = None
+            if anchored is None:
+                self.stdout.write("No pending registrations")
+            else:
+                self.stdout.write(
+                    f"Anchored {anchored.leaf_count} registrations as epoch {anchored.epoch} "
+                    f"(root {anchored.root}, tx {anchored.tx_hash or '-'})"
+                )
+            if not options['every']:
+                return
+            time.sleep(options['every'])
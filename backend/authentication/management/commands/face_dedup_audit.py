@@ -0,0 +1,119 @@
+"""
+Find groups of users whose stored face encodings are near-duplicates
+(one person enrolled under several usernames).
+
+    python manage.py face_dedup_audit
+    python manage.py face_dedup_audit --tolerance 0.45 --workers 16 --work-dir /data/dedup
+    python manage.py face_dedup_audit --json report.json
+
+Interrupted runs resume from the work directory; finished block rows are
+not recomputed. Use --restart to start over (e.g. after new enrollments).
+"""
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication import dedup
+from authentication.models import UserFaceEncoding
+
+
+class Command(BaseCommand):
+    help = "Report clusters of users with near-identical face encodings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tolerance', type=float, default=settings.FACE_MATCH_TOLERANCE,
+                            help='face distance below which two users are flagged (default: FACE_MATCH_TOLERANCE)')
+        parser.add_argument('--block-size', type=int, default=4096,
+                            help='encodings per block; memory per worker is about 4*block_size^2 bytes')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--work-dir', default='face_dedup_work',
+                            help='directory for the exported matrix and partial results')
+        parser.add_argument('--restart', action='store_true', help='discard previous partial results')
+        parser.add_argument('--json', dest='json_path', help='also write the clusters to this JSON file')
+        parser.add_argument('--limit', type=int, default=20, help='clusters to print (0 for all)')
+
+    def handle(self, *args, **options):
+        work_dir = options['work_dir']
+        block_size = options['block_size']
+        tolerance = options['tolerance']
+        if block_size <= 0 or tolerance <= 0:
+            raise CommandError('--block-size and --tolerance must be positive')
+
+        if options['restart'] and os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(os.path.join(work_dir, dedup.PAIRS_DIR), exist_ok=True)
+
+        manifest = dedup.read_manifest(work_dir)
+        if manifest and (manifest['block_size'], manifest['tolerance']) != (block_size, tolerance):
+            raise CommandError(
+                f"{work_dir} holds a run with block size {manifest['block_size']} and tolerance "
+                f"{manifest['tolerance']}; pass the same values or --restart"
+            )
+        if manifest is None:
+            manifest = self.export(work_dir, block_size, tolerance)
+        else:
+            self.stdout.write(f"Resuming: {manifest['count']} encodings in {work_dir}")
+
+        count = manifest['count']
+        self.compute_pairs(work_dir, count, block_size, tolerance, options['workers'])
+
+        pairs_a, pairs_b, distances = dedup.load_pairs(work_dir, count, block_size)
+        clusters = dedup.find_clusters(count, pairs_a, pairs_b, distances)
+        self.report(clusters, dedup.load_usernames(work_dir), len(pairs_a), options)
+
+    def export(self, work_dir, block_size, tolerance):
+        """Stream encodings from the database into the work directory"""
+        start = time.perf_counter()
+        queryset = UserFaceEncoding.objects.order_by('id').values_list('username', 'face_encoding')
+        total = queryset.count()
+        self.stdout.write(f"Exporting {total} encodings...")
+        count = dedup.export_encodings(queryset.iterator(chunk_size=2000), total, work_dir)
+        manifest = {'count': count, 'block_size': block_size, 'tolerance': tolerance}
+        dedup.write_manifest(work_dir, manifest)
+        self.stdout.write(f"  {count} encodings exported in {time.perf_counter() - start:.1f}s")
+        return manifest
+
+    def compute_pairs(self, work_dir, count, block_size, tolerance, workers):
+        """Run every unfinished block row in a process pool"""
+        pending = dedup.pending_block_rows(work_dir, count, block_size)
+        total = (count + block_size - 1) // block_size
+        if not pending:
+            return
+        self.stdout.write(f"Comparing: {len(pending)} of {total} block rows left, {workers} workers")
+
+        start = time.perf_counter()
+        done = total - len(pending)
+        with ProcessPoolExecutor(max_workers=workers, initializer=dedup._limit_blas_threads) as pool:
+            futures = [
+                pool.submit(dedup.audit_block_row, work_dir, count, block_size, tolerance, row)
+                for row in pending
+            ]
+            for future in as_completed(futures):
+                future.result()
+                done += 1
+                if done % max(1, total // 20) == 0 or done == total:
+                    self.stdout.write(f"  {done}/{total} block rows ({time.perf_counter() - start:.0f}s)")
+
+    def report(self, clusters, usernames, pair_count, options):
+        duplicated = sum(len(members) for members, _ in clusters)
+        self.stdout.write(
+            f"\n{pair_count} close pairs, {len(clusters)} clusters, {duplicated} users involved"
+        )
+        limit = options['limit'] or len(clusters)
+        for members, max_distance in clusters[:limit]:
+            names = ', '.join(usernames[i] for i in members[:10])
+            more = f' (+{len(members) - 10} more)' if len(members) > 10 else ''
+            self.stdout.write(f"  [{len(members)}] max distance {max_distance:.3f}: {names}{more}")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump([
+                    {'usernames': [usernames[i] for i in members], 'max_distance': max_distance}
+                    for members, max_distance in clusters
+                ], f, indent=2)
+            self.stdout.write(f"Clusters written to {options['json_path']}")
@@ -0,0 +1,25 @@
+"""
+Rebuild the face key buckets of all stored encodings.
+
+    python manage.py index_face_keys
+
+New and changed encodings are indexed as they are saved; run this once for
+encodings stored before the index existed, and after changing FACE_KEY_SEED.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentication.face_index import rebuild
+
+
+class Command(BaseCommand):
+    help = "Re-index every stored face encoding under its face key buckets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='bucket rows per insert')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(f"Indexed {count} face encodings ({time.perf_counter() - start:.1f}s)")
@@ -0,0 +1,54 @@
+"""
+Report RSS/PSS of a server's master and worker processes (Linux).
+
+    python manage.py memory_report --master $(cat gunicorn.pid)
+    python manage.py memory_report --pid 4121 4122 4123
+
+With --master the master and all its descendants (workers and their encode
+pools) are listed. Compare the totals: sum(RSS) counts shared model pages
+once per process, sum(PSS) once overall, so the difference is what
+preloading the models before fork saves.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.memory import command_line, process_memory, process_tree
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = "Report per-process RSS, PSS, shared and private memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--master', type=int, help='report this process and all its descendants')
+        parser.add_argument('--pid', type=int, nargs='+', default=[], help='processes to report')
+
+    def handle(self, *args, **options):
+        pids = list(options['pid'])
+        if options['master']:
+            try:
+                pids = process_tree(options['master']) + [p for p in pids if p != options['master']]
+            except OSError as e:
+                raise CommandError(f"Cannot read the process table: {e}")
+        if not pids:
+            raise CommandError("Give --master <pid> or --pid <pid> ...")
+
+        self.stdout.write(f"{'PID':>7} {'RSS MB':>9} {'PSS MB':>9} {'Shared MB':>10} {'Private MB':>11}  Command")
+        total_rss = total_pss = 0
+        for pid in pids:
+            try:
+                usage = process_memory(pid)
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f"{pid:>7} unavailable: {e}"))
+                continue
+            total_rss += usage['rss']
+            total_pss += usage['pss']
+            self.stdout.write(
+                f"{pid:>7} {usage['rss'] / MB:>9.1f} {usage['pss'] / MB:>9.1f} "
+                f"{usage['shared'] / MB:>10.1f} {usage['private'] / MB:>11.1f}  {command_line(pid)[:60]}"
+            )
+
+        self.stdout.write(
+            f"\nTotal RSS {total_rss / MB:.1f} MB, total PSS {total_pss / MB:.1f} MB "
+            f"(sharing saves {(total_rss - total_pss) / MB:.1f} MB)"
+        )
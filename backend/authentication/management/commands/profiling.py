@@ -0,0 +1,50 @@
+"""
+Request profiling: issue X-Profile tokens, switch sampling, list traces.
+
+    python manage.py profiling --token
+    python manage.py profiling --sample-rate 0.01 --for 600
+    python manage.py profiling --sample-rate 0
+    python manage.py profiling
+
+A request sent with ``X-Profile: <token>`` to register or verify is
+profiled; its response names the trace in X-Profile-Trace. Traces are
+pstats files in PROFILE_DIR (``python -m pstats <file>``).
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.profiling import issue_profile_token, list_traces, read_sampling, set_sampling
+
+
+class Command(BaseCommand):
+    help = "Issue profiling tokens, set the sampling rate and list stored request profiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--token', action='store_true', help='print a signed X-Profile header value')
+        parser.add_argument('--sample-rate', type=float, help='fraction of requests to profile (0 switches off)')
+        parser.add_argument('--for', dest='duration', type=float,
+                            help='seconds the sampling rate stays in effect (default: until changed)')
+
+    def handle(self, *args, **options):
+        if options['token']:
+            self.stdout.write(issue_profile_token())
+            self.stderr.write(f"Valid for {settings.PROFILE_TOKEN_TTL}s")
+            return
+        if options['sample_rate'] is not None:
+            try:
+                set_sampling(options['sample_rate'], options['duration'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        sampling = read_sampling()
+        until = f" until {datetime.fromtimestamp(sampling['until']):%Y-%m-%d %H:%M:%S}" if sampling['until'] else ''
+        self.stdout.write(f"Sampling rate {sampling['rate']:g}{until if sampling['rate'] else ''}")
+        traces = list_traces()
+        self.stdout.write(f"{len(traces)} traces in {settings.PROFILE_DIR}")
+        for trace in traces:
+            self.stdout.write(
+                f"  {trace['name']}  {trace['method']} {trace['path']} {trace['status']} "
+                f"{trace['seconds'] * 1000:.1f} ms ({trace['trigger']})"
+            )
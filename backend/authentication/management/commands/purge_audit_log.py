@@ -0,0 +1,26 @@
+"""
+Drop monthly audit log tables older than the retention period.
+
+    python manage.py purge_audit_log --keep-months 6
+
+The current month always counts as one of the kept months. Run it
+periodically (cron); dropping a month's table is instant, however many
+events it holds.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.audit import purge_months
+
+
+class Command(BaseCommand):
+    help = "Drop audit_events_YYYYMM tables older than --keep-months"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=12,
+                            help='months to keep, including the current one (default: 12)')
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 1:
+            raise CommandError("--keep-months must be at least 1")
+        dropped = purge_months(options['keep_months'])
+        self.stdout.write(f"Dropped {len(dropped)} audit tables" + (f": {', '.join(dropped)}" if dropped else ''))
@@ -0,0 +1,17 @@
+"""
+Delete expired Idempotency-Key records.
+
+    python manage.py purge_idempotency_keys
+
+Run it periodically (cron); expired records are also replaced on reuse.
+"""
+from django.core.management.base import BaseCommand
+
+from authentication.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete Idempotency-Key records past their expiry"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Deleted {purge_expired()} expired idempotency records")
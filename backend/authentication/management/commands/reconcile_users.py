@@ -0,0 +1,73 @@
+"""
+Compare users registered on the ledger with the local face-encoding table.
+
+    python manage.py reconcile_users
+    python manage.py reconcile_users --page-size 1000 --workers 16 --repair
+    python manage.py reconcile_users --json reconcile.json
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.ledger import LedgerError, get_ledger
+from authentication.reconcile import reconcile
+
+
+class Command(BaseCommand):
+    help = "Report (and optionally repair) users missing on the ledger or in the local database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=500, help='usernames per getUsers call')
+        parser.add_argument('--workers', type=int, default=8, help='concurrent ledger calls')
+        parser.add_argument('--repair', action='store_true',
+                            help='delete local encodings that have no ledger entry')
+        parser.add_argument('--json', dest='json_path', help='also write the full report to this JSON file')
+        parser.add_argument('--limit', type=int, default=20, help='orphans of each kind to print (0 for all)')
+
+    def handle(self, *args, **options):
+        if options['page_size'] <= 0:
+            raise CommandError('--page-size must be positive')
+
+        ledger = get_ledger()
+        try:
+            ledger.check_ready()
+        except LedgerError as e:
+            raise CommandError(str(e))
+
+        start = time.perf_counter()
+        try:
+            report = reconcile(ledger, page_size=options['page_size'], workers=options['workers'],
+                               repair=options['repair'])
+        except LedgerError as e:
+            raise CommandError(str(e))
+        except Exception as e:
+            raise CommandError(
+                f"Reading users from the ledger failed: {e}. A contract deployed before getUsers() "
+                "was added must be redeployed: cd blockchain && npx truffle migrate --reset"
+            )
+
+        self.stdout.write(
+            f"Ledger users: {report.chain_count}, local encodings: {report.local_count} "
+            f"({time.perf_counter() - start:.1f}s)"
+        )
+        limit = options['limit']
+        self.write_orphans("On ledger without local encoding (must re-enroll)", report.chain_only, limit)
+        self.write_orphans("Local encoding without ledger entry", report.local_only, limit)
+        if options['repair']:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {report.repaired} orphaned local encodings"))
+        elif report.local_only:
+            self.stdout.write("Run with --repair to delete the orphaned local encodings")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report.as_dict(), f, indent=2)
+            self.stdout.write(f"Report written to {options['json_path']}")
+
+    def write_orphans(self, title, usernames, limit):
+        self.stdout.write(f"{title}: {len(usernames)}")
+        shown = usernames if not limit else usernames[:limit]
+        for username in shown:
+            self.stdout.write(f"  - {username}")
+        if len(shown) < len(usernames):
+            self.stdout.write(f"  ... and {len(usernames) - len(shown)} more")
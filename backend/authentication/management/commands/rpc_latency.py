@@ -0,0 +1,56 @@
+"""
+Measure per-call JSON-RPC latency for one or more blockchain transports.
+
+    python manage.py rpc_latency
+    python manage.py rpc_latency http://127.0.0.1:7545 ws://127.0.0.1:7545 --calls 500 --concurrency 8
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authentication.blockchain import make_web3, rpc_latency, transport_for
+
+
+class Command(BaseCommand):
+    help = "Report per-call RPC latency for each blockchain transport URL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', help='provider URLs (default: settings.GANACHE_URL)')
+        parser.add_argument('--calls', type=int, default=200, help='calls per RPC method')
+        parser.add_argument('--concurrency', type=int, default=1, help='threads issuing calls')
+
+    def handle(self, *args, **options):
+        urls = options['urls'] or [settings.GANACHE_URL]
+        for url in urls:
+            self.stdout.write(f"\n{url} ({transport_for(url)})")
+            try:
+                self.measure(url, options['calls'], options['concurrency'])
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"  failed: {e}"))
+                continue
+
+            for method, stats in sorted(rpc_latency.summary().items()):
+                self.stdout.write(
+                    f"  {method:<24} n={stats['count']:<5} mean={stats['mean_ms']:.2f}ms "
+                    f"p50={stats['p50_ms']:.2f}ms p95={stats['p95_ms']:.2f}ms max={stats['max_ms']:.2f}ms"
+                )
+
+    def measure(self, url, calls, concurrency):
+        """Issue `calls` of each probe RPC against `url`"""
+        w3 = make_web3(url)
+        if not w3.is_connected():
+            raise ConnectionError("node not reachable")
+
+        accounts = w3.eth.accounts
+        probes = [
+            lambda: w3.eth.block_number,
+            lambda: w3.eth.chain_id,
+        ]
+        if accounts:
+            probes.append(lambda: w3.eth.get_balance(accounts[0]))
+
+        rpc_latency.reset()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for probe in probes:
+                list(pool.map(lambda _: probe(), range(calls)))
@@ -0,0 +1,80 @@
+"""
+Per-process memory figures from /proc (Linux), for checking how much of a
+pre-forked server's memory its workers actually share.
+
+    rss      resident pages, shared ones counted in full for every process
+    pss      resident pages, each shared page split between its sharers
+    shared   resident pages also mapped by another process
+    private  resident pages only this process maps
+
+For a master and its workers, sum(rss) - sum(pss) is the memory saved by
+sharing; a worker whose pss is close to its rss shares little.
+"""
+import os
+
+PROC = '/proc'
+
+_ROLLUP_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty',
+    'Swap': 'swap',
+}
+
+
+def parse_smaps_rollup(text):
+    """Byte counts from the text of /proc/<pid>/smaps_rollup"""
+    usage = dict.fromkeys(_ROLLUP_FIELDS.values(), 0)
+    for line in text.splitlines():
+        key, _, rest = line.partition(':')
+        if key in _ROLLUP_FIELDS:
+            usage[_ROLLUP_FIELDS[key]] = int(rest.split()[0]) * 1024  # reported in kB
+    usage['shared'] = usage['shared_clean'] + usage['shared_dirty']
+    usage['private'] = usage['private_clean'] + usage['private_dirty']
+    return usage
+
+
+def process_memory(pid):
+    """
+    Memory usage of `pid` in bytes
+
+    Raises:
+        OSError: no such process, no permission, or no /proc (not Linux)
+    """
+    with open(os.path.join(PROC, str(pid), 'smaps_rollup')) as f:
+        return parse_smaps_rollup(f.read())
+
+
+def command_line(pid):
+    try:
+        with open(os.path.join(PROC, str(pid), 'cmdline'), 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode(errors='replace').strip()
+    except OSError:
+        return ''
+
+
+def _parent_pid(pid):
+    with open(os.path.join(PROC, str(pid), 'stat')) as f:
+        # The command name may contain spaces; fields resume after its ')'
+        return int(f.read().rsplit(')', 1)[1].split()[1])
+
+
+def process_tree(root):
+    """`root` and all its descendants, parents before children"""
+    children = {}
+    for entry in os.listdir(PROC):
+        if not entry.isdigit():
+            continue
+        try:
+            children.setdefault(_parent_pid(entry), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue  # exited while scanning
+    tree, stack = [], [int(root)]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(sorted(children.get(pid, ()), reverse=True))
+    return tree
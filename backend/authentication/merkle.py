@@ -0,0 +1,291 @@
+"""
+Merkle-anchored batch registration (REGISTRATION_MODE = 'merkle').
+
+Instead of one registerUser transaction per signup, register stores the
+user's (username, password hash, face hash) locally as a pending Merkle
+leaf. ``anchor_pending()`` (``manage.py anchor_registrations``, run every
+epoch) builds a tree over all pending leaves, anchors its root with one
+``FaceAuth.anchorRoot`` transaction and stores each user's inclusion proof,
+so a wave of thousands of registrations costs one transaction.
+
+Verify looks batch-registered users up locally and checks their proof
+against the root anchored for their epoch (read from the contract once per
+epoch and cached: anchored roots never change). A tampered local record
+fails the check. Users whose epoch is not anchored yet cannot log in.
+
+Hashing matches ``FaceAuth.verifyMerkleUser``:
+
+    leaf    keccak256(keccak256(abi.encode(username, passwordHash, faceHash)))
+    node    keccak256(min(a, b) ++ max(a, b))
+
+An odd node at the end of a level moves up unchanged.
+"""
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from eth_abi import encode
+from eth_utils import keccak
+
+from .ledger import Ledger, LedgerError, get_ledger
+from .models import MerkleEpoch, MerkleRegistration
+
+LEAF_TYPES = ['string', 'string', 'string']
+
+logger = logging.getLogger(__name__)
+
+
+def leaf_hash(username, password_hash, face_hash):
+    return keccak(keccak(encode(LEAF_TYPES, [username, password_hash, face_hash])))
+
+
+def node_hash(a, b):
+    return keccak(a + b if a < b else b + a)
+
+
+def build_levels(leaves):
+    """All levels of the tree over `leaves` (bytes), leaves first, root level last"""
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_proof(levels, index):
+    """Sibling hashes from leaf `index` up to the root"""
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    node = leaf
+    for sibling in proof:
+        node = node_hash(node, sibling)
+    return node == root
+
+
+def to_hex(value):
+    return '0x' + value.hex()
+
+
+def from_hex(value):
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+
+class MerkleLedger(Ledger):
+    """
+    Ledger for REGISTRATION_MODE='merkle', wrapping the LEDGER_BACKEND one
+
+    New users become pending leaves instead of registerUser transactions.
+    Users registered directly on the contract are still found through the
+    base ledger, so switching modes keeps everyone able to log in.
+    """
+
+    name = 'merkle'
+
+    def __init__(self, base):
+        self.base = base
+        self._roots = {}
+        self._roots_lock = threading.Lock()
+
+    def check_ready(self):
+        self.base.check_ready()
+
+    def root(self, epoch):
+        """Anchored root of `epoch` as bytes, cached"""
+        root = self._roots.get(epoch)
+        if root is None:
+            anchored = self.base.get_anchored_root(epoch)
+            if anchored is None:
+                raise LedgerError(f'Merkle epoch {epoch} is not anchored on the blockchain')
+            root = from_hex(anchored)
+            with self._roots_lock:
+                self._roots[epoch] = root
+        return root
+
+    async def aroot(self, epoch):
+        root = self._roots.get(epoch)
+        if root is None:
+            anchored = await self.base.aget_anchored_root(epoch)
+            if anchored is None:
+                raise LedgerError(f'Merkle epoch {epoch} is not anchored on the blockchain')
+            root = from_hex(anchored)
+            with self._roots_lock:
+                self._roots[epoch] = root
+        return root
+
+    def _checked_hashes(self, record, root):
+        """(password_hash, face_hash) of `record` once its proof leads to `root`"""
+        leaf = leaf_hash(record.username, record.password_hash, record.face_hash)
+        if not verify_proof(leaf, [from_hex(sibling) for sibling in record.proof], root):
+            logger.error("Merkle proof of %r does not match the root of epoch %s", record.username, record.epoch)
+            raise LedgerError('Stored registration does not match the anchored Merkle root')
+        return record.password_hash, record.face_hash
+
+    def _pending_error(self):
+        return LedgerError('Registration is waiting for the next anchoring epoch, please retry later', status=403)
+
+    def is_registered(self, username):
+        return MerkleRegistration.objects.filter(username=username).exists() or self.base.is_registered(username)
+
+    def get_user_hash(self, username):
+        record = MerkleRegistration.objects.filter(username=username).first()
+        if record is None:
+            return self.base.get_user_hash(username)
+        if record.epoch is None:
+            raise self._pending_error()
+        return self._checked_hashes(record, self.root(record.epoch))
+
+    def get_user_hashes(self, usernames):
+        """
+        As Ledger.get_user_hashes. A user still waiting for their epoch, or
+        whose proof does not check out, maps to the LedgerError single verify
+        would raise, so the rest of the batch is unaffected.
+        """
+        records = MerkleRegistration.objects.in_bulk(list(usernames), field_name='username')
+        found = self.base.get_user_hashes([username for username in usernames if username not in records])
+        for username, record in records.items():
+            try:
+                if record.epoch is None:
+                    raise self._pending_error()
+                found[username] = self._checked_hashes(record, self.root(record.epoch))
+            except LedgerError as e:
+                found[username] = e
+        return found
+
+    def user_count(self):
+        return self.base.user_count() + MerkleRegistration.objects.count()
+
+    def get_users(self, offset, limit):
+        # Direct registrations first, then batch registrations in signup order
+        direct_count = self.base.user_count()
+        usernames = self.base.get_users(offset, limit) if offset < direct_count else []
+        remaining = limit - len(usernames)
+        if remaining > 0:
+            start = max(offset - direct_count, 0)
+            usernames += list(
+                MerkleRegistration.objects.order_by('id').values_list('username', flat=True)[start:start + remaining]
+            )
+        return usernames
+
+    def register_user(self, username, password_hash, face_hash):
+        if not username:
+            raise LedgerError('Validation error: Username cannot be empty', status=400)
+        if not password_hash or not face_hash:
+            raise LedgerError('Validation error: hash cannot be empty', status=400)
+        if self.base.is_registered(username):
+            raise LedgerError('User already exists on blockchain', status=400)
+        try:
+            MerkleRegistration.objects.create(username=username, password_hash=password_hash, face_hash=face_hash)
+        except IntegrityError:
+            raise LedgerError('User already exists on blockchain', status=400)
+        return None
+
+    def anchor_root(self, root, leaf_count):
+        return self.base.anchor_root(root, leaf_count)
+
+    def get_anchored_root(self, epoch):
+        return self.base.get_anchored_root(epoch)
+
+    async def acheck_ready(self):
+        await self.base.acheck_ready()
+
+    async def ais_registered(self, username):
+        if await MerkleRegistration.objects.filter(username=username).aexists():
+            return True
+        return await self.base.ais_registered(username)
+
+    async def aget_user_hash(self, username):
+        record = await MerkleRegistration.objects.filter(username=username).afirst()
+        if record is None:
+            return await self.base.aget_user_hash(username)
+        if record.epoch is None:
+            raise self._pending_error()
+        return self._checked_hashes(record, await self.aroot(record.epoch))
+
+    async def aregister_user(self, username, password_hash, face_hash):
+        if username and await self.base.ais_registered(username):
+            raise LedgerError('User already exists on blockchain', status=400)
+        return await sync_to_async(self.register_user)(username, password_hash, face_hash)
+
+    async def aget_anchored_root(self, epoch):
+        return await self.base.aget_anchored_root(epoch)
+
+
+def claim_pending():
+    """
+    Claim every unclaimed pending registration for one anchoring run
+
+    A single conditional UPDATE, so two concurrent runs never claim the same
+    record. Claims older than MERKLE_CLAIM_TIMEOUT are taken over.
+
+    Returns:
+        (claim token, claimed records in signup order)
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.MERKLE_CLAIM_TIMEOUT)
+    MerkleRegistration.objects.filter(epoch__isnull=True).filter(
+        Q(claim_token='') | Q(claimed_at__lt=stale)
+    ).update(claim_token=token, claimed_at=now)
+    return token, list(MerkleRegistration.objects.filter(claim_token=token, epoch__isnull=True).order_by('id'))
+
+
+def release_claim(token):
+    MerkleRegistration.objects.filter(claim_token=token, epoch__isnull=True).update(claim_token='', claimed_at=None)
+
+
+def anchor_pending(ledger=None):
+    """
+    Anchor all pending registrations under one new root
+
+    The records are claimed before anchorRoot is sent, so a concurrent run
+    skips them instead of anchoring them again under another epoch.
+
+    Returns:
+        MerkleEpoch, or None if nothing was pending (or all of it is claimed)
+
+    Raises:
+        LedgerError: the anchorRoot transaction failed; registrations stay pending
+    """
+    ledger = ledger or get_ledger()
+    token, pending = claim_pending()
+    if not pending:
+        return None
+
+    levels = build_levels([leaf_hash(r.username, r.password_hash, r.face_hash) for r in pending])
+    root = to_hex(levels[-1][0])
+    try:
+        epoch, tx_hash = ledger.anchor_root(root, len(pending))
+    except BaseException:
+        release_claim(token)
+        raise
+
+    for index, record in enumerate(pending):
+        record.epoch = epoch
+        record.leaf_index = index
+        record.proof = [to_hex(sibling) for sibling in merkle_proof(levels, index)]
+        record.claim_token = ''
+        record.claimed_at = None
+    with transaction.atomic():
+        anchored = MerkleEpoch.objects.create(epoch=epoch, root=root, leaf_count=len(pending), tx_hash=tx_hash or '')
+        MerkleRegistration.objects.bulk_update(
+            pending, ['epoch', 'leaf_index', 'proof', 'claim_token', 'claimed_at'], batch_size=500
+        )
+    logger.info("Anchored %d registrations as epoch %s (root %s)", len(pending), epoch, root)
+    return anchored
@@ -0,0 +1,243 @@
+"""
+Lightweight request-stage timing and Prometheus text exposition.
+
+Views are wrapped with ``track_request(endpoint)``; code inside them times
+stages with ``with stage('db_lookup'):`` or records a pre-measured duration
+with ``observe_stage``. The endpoint label is carried in a context variable,
+so the RPC middleware and helpers called from a view are attributed to it
+without passing it around. Metrics are per process.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Seconds; covers sub-millisecond parsing up to slow receipt waits
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_endpoint = contextvars.ContextVar('faceauth_endpoint', default='none')
+# {stage: seconds} of the request being handled, for the audit log
+_current_stages = contextvars.ContextVar('faceauth_stages', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        series = self._series.get(key)
+        return series[2] if series else 0
+
+    def collect(self):
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key, ('le', '+Inf'))
+            yield f'{self.name}_bucket{labels} {count}'
+            plain = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{plain} {_format_value(total)}'
+            yield f'{self.name}_count{plain} {count}'
+
+
+class Registry:
+    """Collection of metrics rendered together at /metrics/"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'faceauth_requests_total', 'Requests handled, by endpoint and HTTP status', ('endpoint', 'status')))
+REQUEST_SECONDS = registry.register(Histogram(
+    'faceauth_request_seconds', 'End-to-end request latency', ('endpoint',)))
+STAGE_SECONDS = registry.register(Histogram(
+    'faceauth_stage_seconds', 'Latency of individual request stages', ('endpoint', 'stage')))
+RPC_SECONDS = registry.register(Histogram(
+    'faceauth_rpc_seconds', 'Blockchain JSON-RPC call latency', ('endpoint', 'method')))
+ADMISSION_REJECTED = registry.register(Counter(
+    'faceauth_admission_rejected_total', 'Requests shed by admission control', ('limiter', 'reason')))
+AUDIT_WRITTEN = registry.register(Counter(
+    'faceauth_audit_written_total', 'Audit events written to the database'))
+AUDIT_DROPPED = registry.register(Counter(
+    'faceauth_audit_dropped_total', 'Audit events lost, by reason', ('reason',)))
+ENCODES_CANCELLED = registry.register(Counter(
+    'faceauth_encode_cancelled_total', 'Verify encodes dropped after a failed login check, by whether they had started',
+    ('when',)))
+PROFILE_TRACES = registry.register(Counter(
+    'faceauth_profile_traces_total', 'Request profiles stored, by trigger', ('trigger',)))
+PREFETCH = registry.register(Counter(
+    'faceauth_prefetch_total', 'Login prefetches queued or dropped, and verify cache hits and misses', ('result',)))
+
+
+def current_endpoint():
+    return _current_endpoint.get()
+
+
+def current_stages():
+    """{stage: seconds} recorded so far by the current request (empty outside one)"""
+    return dict(_current_stages.get() or {})
+
+
+def observe_stage(name, seconds):
+    """Record a stage duration measured elsewhere (e.g. in a worker process)"""
+    STAGE_SECONDS.observe(seconds, endpoint=_current_endpoint.get(), stage=name)
+    stages = _current_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def observe_stages(timings):
+    """Record every stage in a {stage: seconds} dict"""
+    for name, seconds in timings.items():
+        observe_stage(name, seconds)
+
+
+def observe_rpc(method, seconds):
+    RPC_SECONDS.observe(seconds, endpoint=_current_endpoint.get(), method=method)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage `name` of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def track_request(endpoint):
+    """
+    Decorator recording request count and latency for a sync or async view,
+    and labelling stages/RPC calls made while it runs with `endpoint`.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                token = _current_endpoint.set(endpoint)
+                stages_token = _current_stages.set({})
+                start = time.perf_counter()
+                status = 500
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                    REQUESTS.inc(endpoint=endpoint, status=str(status))
+                    _current_stages.reset(stages_token)
+                    _current_endpoint.reset(token)
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            token = _current_endpoint.set(endpoint)
+            stages_token = _current_stages.set({})
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = view_func(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                REQUESTS.inc(endpoint=endpoint, status=str(status))
+                _current_stages.reset(stages_token)
+                _current_endpoint.reset(token)
+        return wrapper
+    return decorator
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MerkleEpoch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.PositiveIntegerField(unique=True)),
+                ('root', models.CharField(max_length=66)),
+                ('leaf_count', models.PositiveIntegerField()),
+                ('tx_hash', models.CharField(blank=True, max_length=66)),
+                ('anchored_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'merkle_epochs',
+            },
+        ),
+        migrations.CreateModel(
+            name='MerkleRegistration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=100, unique=True)),
+                ('password_hash', models.CharField(max_length=64)),
+                ('face_hash', models.CharField(max_length=64)),
+                ('epoch', models.PositiveIntegerField(db_index=True, null=True)),
+                ('leaf_index', models.PositiveIntegerField(null=True)),
+                ('proof', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'merkle_registrations',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_merkle_registration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FaceKeyBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(db_index=True, max_length=100)),
+                ('bucket', models.CharField(db_index=True, max_length=8)),
+            ],
+            options={
+                'db_table': 'face_key_buckets',
+                'unique_together': {('username', 'bucket')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0004_face_key_buckets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='merkleregistration',
+            name='claim_token',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='merkleregistration',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
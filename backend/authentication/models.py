@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 import json
 import numpy as np
 
@@ -22,3 +23,99 @@ class UserFaceEncoding(models.Model):
     class Meta:
         db_table = 'user_face_encodings'
 
+
+class FaceKeyBucket(models.Model):
+    """
+    One LSH bucket of a user's face key (see face_index.py); every stored
+    encoding has face_keys.BANDS of them
+    """
+    username = models.CharField(max_length=100, db_index=True)
+    bucket = models.CharField(max_length=8, db_index=True)
+
+    class Meta:
+        db_table = 'face_key_buckets'
+        unique_together = [('username', 'bucket')]
+
+
+
+class IdempotencyRecord(models.Model):
+    """
+    Outcome of a register/verify request, keyed by its Idempotency-Key header
+    (see idempotency.py)
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    STATES = [(PENDING, 'Pending'), (DONE, 'Done')]
+
+    key = models.CharField(max_length=255, unique=True)
+    endpoint = models.CharField(max_length=50)
+    fingerprint = models.CharField(max_length=64)
+    state = models.CharField(max_length=10, choices=STATES, default=PENDING)
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_content_type = models.CharField(max_length=100, default='application/json')
+    response_body = models.BinaryField(default=b'')
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'idempotency_records'
+
+
+class AuditEvent(models.Model):
+    """
+    One register/verify attempt (see audit.py)
+
+    Abstract: events live in one table per calendar month
+    (audit_events_YYYYMM), created on first write, so old months are
+    dropped whole instead of deleted row by row.
+    """
+    created_at = models.DateTimeField(default=timezone.now)
+    endpoint = models.CharField(max_length=50)
+    username = models.CharField(max_length=100, blank=True)
+    success = models.BooleanField()
+    status = models.PositiveSmallIntegerField()
+    error = models.CharField(max_length=255, blank=True)
+    distance = models.FloatField(null=True)
+    timings = models.JSONField(default=dict)
+    client_ip = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(fields=['username', 'created_at'], name='%(class)s_user'),
+            models.Index(fields=['created_at'], name='%(class)s_time'),
+        ]
+
+
+class MerkleEpoch(models.Model):
+    """A batch of registrations whose Merkle root was anchored on chain (see merkle.py)"""
+    epoch = models.PositiveIntegerField(unique=True)
+    root = models.CharField(max_length=66)
+    leaf_count = models.PositiveIntegerField()
+    tx_hash = models.CharField(max_length=66, blank=True)
+    anchored_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'merkle_epochs'
+
+
+class MerkleRegistration(models.Model):
+    """
+    A user registered in Merkle mode: the leaf fields and, once the user's
+    epoch is anchored, the inclusion proof (see merkle.py)
+    """
+    username = models.CharField(max_length=100, unique=True)
+    password_hash = models.CharField(max_length=64)
+    face_hash = models.CharField(max_length=64)
+    # None until anchored
+    epoch = models.PositiveIntegerField(null=True, db_index=True)
+    leaf_index = models.PositiveIntegerField(null=True)
+    # Sibling hashes ('0x...') from the leaf up to the root
+    proof = models.JSONField(default=list)
+    # Set while an anchoring run owns the pending record
+    claim_token = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    claimed_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'merkle_registrations'
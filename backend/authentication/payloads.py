@@ -0,0 +1,351 @@
+"""
+Request/response payload helpers for the register and verify endpoints.
+
+Three request body formats are accepted:
+
+    application/json       {"username", "password", "face_image": <base64 JPEG>}
+    multipart/form-data    username + password fields, face_image file part
+    image/jpeg (raw body)  JPEG bytes; username/password in X-Username/X-Password,
+                           only encoding and face_box from the query string
+
+The image size limit (settings.MAX_FACE_IMAGE_BYTES) is checked against
+Content-Length before any of the body is read, and again while streaming.
+Image dimensions (settings.MAX_FACE_IMAGE_SIDE) are checked from the image
+header, before the pixels are decoded.
+
+The batch verify endpoint takes a list of such items instead, see
+``parse_batch_request``.
+"""
+import base64
+import io
+import json
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from PIL import Image, UnidentifiedImageError
+
+from .metrics import stage
+
+RAW_IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png', 'application/octet-stream')
+CHUNK_SIZE = 64 * 1024
+# Room for the non-image parts of a JSON or multipart body
+FORM_OVERHEAD_BYTES = 16 * 1024
+
+ENCODING_MODES = ('full', 'binary', 'omit')
+# Query parameters a raw image body may carry; credentials only come from headers
+RAW_QUERY_FIELDS = ('encoding', 'face_box')
+
+
+class PayloadError(Exception):
+    """Invalid or oversized request body; carries the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _check_content_length(request, limit):
+    """Reject the request from its Content-Length header alone"""
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise PayloadError('Invalid Content-Length header')
+    if length > limit:
+        raise PayloadError(f'Request body too large: {length} bytes (limit {limit})', status=413)
+
+
+def _image_too_large(size, limit):
+    return PayloadError(f'Face image too large: {size} bytes (limit {limit})', status=413)
+
+
+def _body_too_large(error):
+    return PayloadError(f'Request body too large: {error}', status=413)
+
+
+def _stream_too_large(size, limit):
+    return PayloadError(f'Request body too large: over {limit} bytes', status=413)
+
+
+def _read_bounded(request, limit, too_large):
+    """Read the body in chunks; `too_large(size, limit)` builds the error once it passes `limit`"""
+    buffer = bytearray()
+    while True:
+        chunk = request.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if len(buffer) + len(chunk) > limit:
+            raise too_large(len(buffer) + len(chunk), limit)
+        buffer += chunk
+    return bytes(buffer)
+
+
+def read_raw_image(request, limit):
+    """Stream a raw image body into memory, enforcing `limit` bytes"""
+    _check_content_length(request, limit)
+    return _read_bounded(request, limit, _image_too_large)
+
+
+def decode_base64_image(face_image_data, limit):
+    """Decode a base64 face image (data: URL prefix allowed)"""
+    if ',' in face_image_data[:64]:
+        face_image_data = face_image_data.split(',', 1)[1]
+    if len(face_image_data) * 3 // 4 > limit:
+        raise _image_too_large(len(face_image_data) * 3 // 4, limit)
+    try:
+        with stage('base64_decode'):
+            return base64.b64decode(face_image_data)
+    except Exception as e:
+        raise PayloadError(f'Invalid image data: {str(e)}')
+
+
+def check_image_dimensions(image_bytes, max_side):
+    """
+    Reject images whose width or height exceeds `max_side` pixels
+
+    Only the header is parsed. Bytes PIL cannot identify are passed through;
+    the encoder reports those as "no face detected".
+    """
+    try:
+        width, height = Image.open(io.BytesIO(image_bytes)).size
+    except Image.DecompressionBombError as e:
+        raise PayloadError(f'Face image dimensions too large: {e}', status=413)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return
+    if max(width, height) > max_side:
+        raise PayloadError(
+            f'Face image dimensions too large: {width}x{height} (limit {max_side} pixels per side)',
+            status=413
+        )
+
+
+def parse_face_request(request):
+    """
+    Read the fields and face image of a register/verify request
+
+    Args:
+        request: Django HttpRequest
+
+    Returns:
+        tuple: (data, face_image_bytes) where data is a dict of the text
+        fields and face_image_bytes is None when no image was sent
+
+    Raises:
+        PayloadError: malformed or oversized body or image
+
+    The body is read once per request: later calls (the idempotency
+    fingerprint, then the view) get a copy of the same result.
+    """
+    parsed = getattr(request, '_face_request', None)
+    if parsed is None:
+        try:
+            data, face_image_bytes = _read_face_request(request)
+            if face_image_bytes:
+                with stage('image_header'):
+                    check_image_dimensions(face_image_bytes, settings.MAX_FACE_IMAGE_SIDE)
+            parsed = (data, face_image_bytes, None)
+        except PayloadError as e:
+            parsed = (None, None, e)
+        request._face_request = parsed
+    data, face_image_bytes, error = parsed
+    if error is not None:
+        raise error
+    return dict(data), face_image_bytes
+
+
+def _read_face_request(request):
+    limit = settings.MAX_FACE_IMAGE_BYTES
+    content_type = request.content_type
+
+    if content_type in RAW_IMAGE_CONTENT_TYPES:
+        data = {field: request.GET[field] for field in RAW_QUERY_FIELDS if field in request.GET}
+        data['username'] = request.headers.get('X-Username')
+        data['password'] = request.headers.get('X-Password')
+        with stage('body_read'):
+            face_image_bytes = read_raw_image(request, limit)
+        return data, face_image_bytes or None
+
+    if content_type == 'multipart/form-data':
+        _check_content_length(request, limit + FORM_OVERHEAD_BYTES)
+        try:
+            with stage('body_read'):
+                data = request.POST.dict()
+        except RequestDataTooBig as e:
+            raise _body_too_large(e)
+        upload = request.FILES.get('face_image')
+        if upload is not None:
+            if upload.size > limit:
+                raise _image_too_large(upload.size, limit)
+            return data, upload.read() or None
+        face_image_data = data.pop('face_image', None)
+        return data, decode_base64_image(face_image_data, limit) if face_image_data else None
+
+    # JSON body with a base64 image (original format)
+    _check_content_length(request, limit * 4 // 3 + FORM_OVERHEAD_BYTES)
+    try:
+        with stage('json_parse'):
+            data = json.loads(request.body)
+    except RequestDataTooBig as e:
+        raise _body_too_large(e)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise PayloadError(f'Invalid JSON: {str(e)}')
+    if not isinstance(data, dict):
+        raise PayloadError('Invalid JSON: expected an object')
+    face_image_data = data.pop('face_image', None)
+    if face_image_data is not None and not isinstance(face_image_data, str):
+        raise PayloadError('Invalid image data: expected a base64 string')
+    return data, decode_base64_image(face_image_data, limit) if face_image_data else None
+
+
+class BatchItem:
+    """One entry of a batch verify request; `error` is a PayloadError for a malformed item"""
+
+    __slots__ = ('index', 'username', 'password', 'image', 'error')
+
+    def __init__(self, index, username=None, password=None, image=None, error=None):
+        self.index = index
+        self.username = username
+        self.password = password
+        self.image = image
+        self.error = error
+
+
+def parse_batch_request(request):
+    """
+    Read the items of a batch verify request
+
+    Two body formats are accepted:
+
+        application/json     {"items": [{"username", "password", "face_image": <base64>}, ...]}
+        multipart/form-data  items = JSON list of {"username", "password"},
+                             plus one face_image_<index> file part per item
+
+    The whole body is bounded by settings.VERIFY_BATCH_MAX_BYTES and the item
+    count by settings.VERIFY_BATCH_MAX_ITEMS. A bad image only fails its own
+    item: its BatchItem carries the PayloadError.
+
+    Returns:
+        tuple: (data, items) where data holds the top-level fields other
+        than items, and items is a list of BatchItem in request order
+
+    Raises:
+        PayloadError: malformed or oversized body, or too many items
+    """
+    limit = settings.MAX_FACE_IMAGE_BYTES
+    _check_content_length(request, settings.VERIFY_BATCH_MAX_BYTES)
+
+    files = {}
+    if request.content_type == 'multipart/form-data':
+        try:
+            with stage('body_read'):
+                data = request.POST.dict()
+                files = request.FILES
+        except RequestDataTooBig as e:
+            raise _body_too_large(e)
+        raw_items = data.pop('items', None)
+        try:
+            raw_items = json.loads(raw_items) if raw_items is not None else None
+        except json.JSONDecodeError as e:
+            raise PayloadError(f'Invalid items field: {str(e)}')
+    else:
+        # Read the stream directly: request.body would stop at DATA_UPLOAD_MAX_MEMORY_SIZE.
+        # Content-Length may be absent (chunked upload), so the limit holds while reading too
+        with stage('body_read'):
+            body = _read_bounded(request, settings.VERIFY_BATCH_MAX_BYTES, _stream_too_large)
+        try:
+            with stage('json_parse'):
+                data = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise PayloadError(f'Invalid JSON: {str(e)}')
+        if not isinstance(data, dict):
+            raise PayloadError('Invalid JSON: expected an object')
+        raw_items = data.pop('items', None)
+
+    if not isinstance(raw_items, list) or not raw_items:
+        raise PayloadError('items must be a non-empty list')
+    if len(raw_items) > settings.VERIFY_BATCH_MAX_ITEMS:
+        raise PayloadError(
+            f'Too many items: {len(raw_items)} (limit {settings.VERIFY_BATCH_MAX_ITEMS})', status=413
+        )
+
+    items = []
+    for index, raw in enumerate(raw_items):
+        if not isinstance(raw, dict):
+            items.append(BatchItem(index, error=PayloadError('Invalid item: expected an object')))
+            continue
+        item = BatchItem(index, username=raw.get('username'), password=raw.get('password'))
+        try:
+            upload = files.get(f'face_image_{index}')
+            if upload is not None:
+                if upload.size > limit:
+                    raise _image_too_large(upload.size, limit)
+                item.image = upload.read() or None
+            elif isinstance(raw.get('face_image'), str) and raw['face_image']:
+                item.image = decode_base64_image(raw['face_image'], limit)
+            if item.image:
+                with stage('image_header'):
+                    check_image_dimensions(item.image, settings.MAX_FACE_IMAGE_SIDE)
+        except PayloadError as e:
+            item.image, item.error = None, e
+        items.append(item)
+    return data, items
+
+
+def get_encoding_mode(request, data):
+    """
+    How the verify response should carry the face encoding
+
+    'full' (default) returns the 128 floats as a JSON list, 'binary' returns
+    them as base64 little-endian float32 and 'omit' leaves them out.
+    """
+    mode = request.GET.get('encoding') or data.get('encoding') or 'full'
+    if mode not in ENCODING_MODES:
+        raise PayloadError(f'Invalid encoding mode: {mode}. Use one of: {", ".join(ENCODING_MODES)}')
+    return mode
+
+
+def get_face_hint(request, data):
+    """
+    Optional face box located by the client, to skip full-image detection
+
+    Sent as ``face_box`` "x,y,width,height" in pixels of the uploaded image
+    (form field, query parameter or X-Face-Box header), or as
+    {"x", "y", "width", "height"} in a JSON body. The encoder only trusts
+    it after finding a face near it, so a wrong box costs a fallback, not
+    a wrong encoding.
+
+    Returns:
+        tuple: (top, right, bottom, left), or None when no box was sent
+
+    Raises:
+        PayloadError: malformed box
+    """
+    box = data.pop('face_box', None) or request.GET.get('face_box') or request.headers.get('X-Face-Box')
+    if not box:
+        return None
+    try:
+        if isinstance(box, dict):
+            values = [box[key] for key in ('x', 'y', 'width', 'height')]
+        elif isinstance(box, str):
+            values = box.split(',')
+        else:
+            values = list(box)
+        x, y, width, height = (int(round(float(value))) for value in values)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise PayloadError('Invalid face_box: expected x,y,width,height')
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise PayloadError('Invalid face_box: expected x,y,width,height')
+    return y, x + width, y + height, x
+
+
+def encoding_payload(face_encoding, mode):
+    """Response fields for `face_encoding` in the given encoding mode"""
+    if mode == 'omit':
+        return {}
+    if mode == 'binary':
+        packed = np.asarray(face_encoding, dtype='<f4').tobytes()
+        return {
+            'face_encoding_b64': base64.b64encode(packed).decode('ascii'),
+            'face_encoding_format': 'float32-le',
+        }
+    return {'face_encoding': face_encoding.tolist()}
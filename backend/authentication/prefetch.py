@@ -0,0 +1,173 @@
+"""
+Login prefetch: load a user's ledger record and stored encoding before verify.
+
+The login form knows the username long before the face is captured. The
+frontend POSTs it to ``/api/prepare/`` when the username field loses focus;
+``start_prefetch`` queues a background load of the user's
+(password_hash, face_hash) from the ledger and their decoded
+UserFaceEncoding, cached for PREFETCH_TTL seconds. A verify that finds the
+entry skips the ledger checks and the encoding query and only pays for the
+face encode.
+
+Only registered users are cached, so a user who registers right after a
+prefetch is not shut out by a stale miss. The password is still checked by
+verify. Loads run on PREFETCH_WORKERS threads; at most PREFETCH_MAX_PENDING
+wait, further prefetches are dropped (verify then does the lookups itself).
+
+A cached record can go stale. Saving or deleting a UserFaceEncoding (a
+re-registration, the orphan cleanup of verify or reconcile) drops the entry
+(``invalidate``, connected in apps.py). Changes this process cannot see are
+not caught: updateFaceHash sent to the contract directly, a chain reset, a
+load that read the database just before a delete. PREFETCH_TTL bounds how
+long verify may use such an entry, so keep it to the seconds between the
+username field and the face capture.
+
+Entries live in Django's default cache. The default LocMemCache is per
+process: with several workers, point CACHES at a shared cache (memcached,
+redis) or the prefetch and the verify may land in different processes.
+"""
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .ledger import get_ledger
+from .metrics import PREFETCH
+from .models import UserFaceEncoding
+
+CACHE_PREFIX = 'faceauth:prefetch:'
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetched(namedtuple('Prefetched', 'password_hash face_hash encoding')):
+    """A registered user's ledger record and stored encoding (None if there is none)"""
+
+
+def cache_key(username):
+    # Hashed: usernames may hold characters memcached keys cannot
+    return CACHE_PREFIX + hashlib.sha256(username.encode()).hexdigest()
+
+
+def load(username):
+    """
+    Read `username`'s ledger record and stored encoding
+
+    Returns:
+        Prefetched, or None if the user is not registered (or the ledger
+        could not tell)
+    """
+    ledger = get_ledger()
+    try:
+        ledger.check_ready()
+        password_hash, face_hash = ledger.get_user_hash(username)
+    except Exception as e:
+        logger.debug("Prefetch of %r found no ledger record: %s", username, e)
+        return None
+    stored = UserFaceEncoding.objects.filter(username=username).first()
+    return Prefetched(password_hash, face_hash, stored.get_encoding() if stored else None)
+
+
+def invalidate(username):
+    """Drop the cached entry of `username`"""
+    cache.delete(cache_key(username))
+
+
+def invalidate_encoding(sender, instance, **kwargs):
+    """post_save / post_delete receiver for UserFaceEncoding"""
+    invalidate(instance.username)
+
+
+def prefetch(username):
+    """Load `username` and cache the result; returns the Prefetched entry or None"""
+    entry = load(username)
+    if entry is not None:
+        cache.set(cache_key(username), entry, settings.PREFETCH_TTL)
+    return entry
+
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.PREFETCH_WORKERS,
+                                               thread_name_prefix='prefetch')
+    return _executor
+
+
+def _run(username):
+    # Pool threads keep their own connection; retire it like a request would
+    close_old_connections()
+    try:
+        prefetch(username)
+    except Exception as e:
+        logger.warning("Prefetch of %r failed: %s", username, e)
+    finally:
+        close_old_connections()
+        with _lock:
+            _pending.discard(username)
+
+
+def start_prefetch(username):
+    """
+    Queue a background prefetch of `username`
+
+    Returns:
+        str: 'queued', 'cached' (already warm), 'pending' (already queued),
+        'dropped' (too many pending) or 'disabled' (PREFETCH_TTL is 0)
+    """
+    if settings.PREFETCH_TTL <= 0:
+        return 'disabled'
+    if cache.get(cache_key(username)) is not None:
+        return 'cached'
+    with _lock:
+        if username in _pending:
+            return 'pending'
+        if len(_pending) >= settings.PREFETCH_MAX_PENDING:
+            PREFETCH.inc(result='dropped')
+            return 'dropped'
+        _pending.add(username)
+    try:
+        get_prefetch_executor().submit(_run, username)
+    except RuntimeError:  # executor shut down
+        with _lock:
+            _pending.discard(username)
+        return 'dropped'
+    PREFETCH.inc(result='queued')
+    return 'queued'
+
+
+def lookup(username):
+    """The cached Prefetched entry of `username`, or None"""
+    if settings.PREFETCH_TTL <= 0:
+        return None
+    entry = cache.get(cache_key(username))
+    PREFETCH.inc(result='hit' if entry is not None else 'miss')
+    return entry
+
+
+async def alookup(username):
+    if settings.PREFETCH_TTL <= 0:
+        return None
+    entry = await cache.aget(cache_key(username))
+    PREFETCH.inc(result='hit' if entry is not None else 'miss')
+    return entry
+
+
+def reset_prefetch():
+    """Forget queued prefetches and drop the executor (tests)"""
+    global _executor
+    with _lock:
+        _executor = None
+        _pending.clear()
@@ -0,0 +1,47 @@
+"""
+Load everything a worker needs before a pre-forking server forks.
+
+With ``preload_app`` (see backend/gunicorn.conf.py) the master imports the
+project once; ``preload()`` then imports the URLconf (views, ledger, the
+face module) and loads and warms the face models of
+FACE_ENCODING_PROFILE. Workers forked afterwards, including replacements
+for restarted workers, share those pages copy-on-write instead of each
+loading a private copy of the dlib models.
+
+``gc.freeze()`` moves everything allocated so far out of the collector's
+reach, so collections in the workers do not write to (and so copy) the
+shared pages.
+"""
+import gc
+import logging
+import os
+import sys
+import time
+
+from django.conf import settings
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    """
+    Import the app and warm the face models in this (master) process
+
+    Returns:
+        float: seconds spent
+    """
+    start = time.perf_counter()
+    get_resolver().url_patterns  # imports the views and everything they import
+
+    if settings.FACE_ENCODER == 'face_recognition':
+        sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+        from face_module.face_utils import preload_models
+        timings = preload_models(settings.FACE_ENCODING_PROFILE)
+        logger.info("Face models preloaded (profile %s): %s", settings.FACE_ENCODING_PROFILE, timings)
+
+    gc.collect()
+    gc.freeze()
+    elapsed = time.perf_counter() - start
+    logger.info("Preload finished in %.2fs, %d objects frozen", elapsed, gc.get_freeze_count())
+    return elapsed
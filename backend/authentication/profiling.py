@@ -0,0 +1,240 @@
+"""
+On-demand cProfile traces of single register/verify requests.
+
+``ProfilingMiddleware`` profiles a request to one of PROFILE_PATHS when
+
+  * it carries ``X-Profile: <token>``, a signed token from
+    ``python manage.py profiling --token`` (valid PROFILE_TOKEN_TTL seconds), or
+  * sampling is switched on (``/api/profiling/sampling/`` or
+    ``manage.py profiling --sample-rate``) and the request is drawn.
+
+The trace is written as a pstats file (``python -m pstats``, snakeviz) to
+PROFILE_DIR with a JSON sidecar describing the request; only the newest
+PROFILE_MAX_TRACES are kept. The response names its trace in
+``X-Profile-Trace``. Staff users list and download traces at
+``/api/profiling/``.
+
+Requests that are not profiled pay a set lookup on the path and, on
+profiled paths, a header lookup and a sampling rate cached for
+SAMPLING_CHECK_INTERVAL seconds (under a microsecond in all). At most one request per process is
+profiled at a time; others run unprofiled. Async requests are profiled on
+the event loop thread, so other coroutines interleaved with them show up
+in their traces, and encoding done in the worker pool does not.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import PROFILE_TRACES
+
+SALT = 'faceauth.profile'
+HEADER = 'X-Profile'
+HEADER_META = 'HTTP_X_PROFILE'
+TRACE_HEADER = 'X-Profile-Trace'
+SAMPLING_FILE = 'sampling.json'
+# Seconds a process keeps using the sampling rate it last read
+SAMPLING_CHECK_INTERVAL = 1.0
+
+TRACE_NAME = re.compile(r'^[\w.-]+\.prof$')
+
+logger = logging.getLogger(__name__)
+
+_profiling = threading.Lock()
+
+
+def issue_profile_token():
+    """Signed value for the X-Profile header"""
+    return signing.dumps({'p': 1}, salt=SALT, compress=False)
+
+
+def valid_profile_token(token):
+    try:
+        signing.loads(token, salt=SALT, max_age=settings.PROFILE_TOKEN_TTL)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def trace_dir():
+    return str(settings.PROFILE_DIR)
+
+
+def read_sampling():
+    """{'rate', 'until'} currently in effect; rate 0 when off or expired"""
+    try:
+        with open(os.path.join(trace_dir(), SAMPLING_FILE)) as f:
+            sampling = json.load(f)
+        rate = float(sampling.get('rate', 0))
+        until = sampling.get('until')
+    except (OSError, ValueError, TypeError, AttributeError):
+        return {'rate': 0.0, 'until': None}
+    if until is not None and until <= time.time():
+        rate = 0.0
+    return {'rate': min(max(rate, 0.0), 1.0), 'until': until}
+
+
+def set_sampling(rate, duration=None):
+    """
+    Profile a `rate` fraction of requests in every process, for `duration` seconds
+    (or until switched off with rate 0)
+    """
+    rate = float(rate)
+    if not 0 <= rate <= 1:
+        raise ValueError("Sampling rate must be between 0 and 1")
+    sampling = {'rate': rate, 'until': time.time() + duration if duration and rate else None}
+    os.makedirs(trace_dir(), exist_ok=True)
+    path = os.path.join(trace_dir(), SAMPLING_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(sampling, f)
+    os.replace(path + '.tmp', path)
+    return sampling
+
+
+def list_traces():
+    """Metadata of the stored traces, newest first"""
+    traces = []
+    try:
+        names = sorted((n for n in os.listdir(trace_dir()) if n.endswith('.json') and n != SAMPLING_FILE), reverse=True)
+    except OSError:
+        return traces
+    for name in names:
+        try:
+            with open(os.path.join(trace_dir(), name)) as f:
+                traces.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # pruned while listing
+    return traces
+
+
+def trace_path(name):
+    """Path of the stored trace `name`, or None if there is no such trace"""
+    if not TRACE_NAME.match(name):
+        return None
+    path = os.path.join(trace_dir(), name)
+    return path if os.path.isfile(path) else None
+
+
+def save_trace(profiler, request, status, elapsed, trigger):
+    """Write the pstats file and its sidecar, then drop traces beyond PROFILE_MAX_TRACES"""
+    now = datetime.now(dt_timezone.utc)
+    slug = request.path.strip('/').replace('/', '_') or 'root'
+    name = f"{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{slug}.prof"
+    os.makedirs(trace_dir(), exist_ok=True)
+    path = os.path.join(trace_dir(), name)
+    profiler.dump_stats(path)
+    with open(path[:-len('.prof')] + '.json', 'w') as f:
+        json.dump({
+            'name': name,
+            'created_at': now.isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'seconds': round(elapsed, 6),
+            'trigger': trigger,
+            'pid': os.getpid(),
+        }, f)
+    prune_traces(settings.PROFILE_MAX_TRACES)
+    PROFILE_TRACES.inc(trigger=trigger)
+    return name
+
+
+def prune_traces(keep):
+    try:
+        names = sorted(n for n in os.listdir(trace_dir()) if n.endswith('.prof'))
+    except OSError:
+        return
+    for name in names[:max(len(names) - keep, 0)]:
+        for path in (name, name[:-len('.prof')] + '.json'):
+            try:
+                os.remove(os.path.join(trace_dir(), path))
+            except OSError:
+                pass
+
+
+class ProfilingMiddleware:
+    """Profile selected requests to PROFILE_PATHS (see module docstring)"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.paths = frozenset(settings.PROFILE_PATHS)
+        self._rate = 0.0
+        self._rate_checked = float('-inf')
+        self._async = iscoroutinefunction(get_response)
+        if self._async:
+            markcoroutinefunction(self)
+
+    def _sampling_rate(self):
+        now = time.monotonic()
+        if now - self._rate_checked >= SAMPLING_CHECK_INTERVAL:
+            self._rate = read_sampling()['rate']
+            self._rate_checked = now
+        return self._rate
+
+    def _trigger(self, request):
+        """'header', 'sample' or None"""
+        if request.path not in self.paths:
+            return None
+        token = request.META.get(HEADER_META)
+        if token is not None and valid_profile_token(token):
+            return 'header'
+        rate = self._sampling_rate()
+        if rate and random.random() < rate:
+            return 'sample'
+        return None
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        trigger = self._trigger(request)
+        if trigger is None or not _profiling.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            return self._finish(profiler, request, response, time.perf_counter() - start, trigger)
+        finally:
+            _profiling.release()
+
+    async def __acall__(self, request):
+        trigger = self._trigger(request)
+        if trigger is None or not _profiling.acquire(blocking=False):
+            return await self.get_response(request)
+        try:
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                response = await self.get_response(request)
+            finally:
+                profiler.disable()
+            return self._finish(profiler, request, response, time.perf_counter() - start, trigger)
+        finally:
+            _profiling.release()
+
+    def _finish(self, profiler, request, response, elapsed, trigger):
+        try:
+            response[TRACE_HEADER] = save_trace(profiler, request, response.status_code, elapsed, trigger)
+        except OSError as e:
+            logger.warning("Could not store the profile of %s: %s", request.path, e)
+        return response
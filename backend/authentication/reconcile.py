@@ -0,0 +1,99 @@
+"""
+Diff the ledger's registered users against the local UserFaceEncoding table.
+
+Chain usernames are read in pages with ``getUsers(offset, limit)``, several
+pages in flight at once, and each page is matched against the database with
+one ``username IN (...)`` query. Local rows are then streamed and checked
+against the chain set, so no per-user RPC is made.
+
+Two kinds of orphan are reported:
+
+    chain_only   registered on the ledger but no local encoding; verify falls
+                 back to hash comparison, which rarely matches. The user has
+                 to enroll again (ledger entries cannot be deleted).
+    local_only   local encoding without a ledger entry, left behind by a
+                 failed registration; safe to delete (``repair``).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from .models import UserFaceEncoding
+
+
+class ReconcileReport:
+    """Result of a reconciliation run"""
+
+    def __init__(self):
+        self.chain_count = 0
+        self.local_count = 0
+        self.chain_only = []
+        self.local_only = []
+        self.repaired = 0
+
+    def as_dict(self):
+        return {
+            'chain_count': self.chain_count,
+            'local_count': self.local_count,
+            'chain_only': self.chain_only,
+            'local_only': self.local_only,
+            'repaired': self.repaired,
+        }
+
+
+def iter_chain_pages(ledger, page_size, workers):
+    """Yield pages of ledger usernames in order, fetching up to `workers` pages at once"""
+    total = ledger.user_count()
+    offsets = range(0, total, page_size)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        yield from pool.map(lambda offset: ledger.get_users(offset, page_size), offsets)
+
+
+def reconcile(ledger, page_size=500, workers=8, repair=False, chunk_size=2000):
+    """
+    Compare ledger users with local face encodings
+
+    Args:
+        ledger: Ledger backend (see ledger.get_ledger)
+        page_size: usernames per getUsers call
+        workers: concurrent getUsers calls
+        repair: delete local rows that have no ledger entry
+        chunk_size: rows per database query
+
+    Returns:
+        ReconcileReport
+    """
+    report = ReconcileReport()
+    chain_users = set()
+
+    for page in iter_chain_pages(ledger, page_size, workers):
+        chain_users.update(page)
+        local = set(UserFaceEncoding.objects.filter(username__in=page).values_list('username', flat=True))
+        report.chain_only.extend(username for username in page if username not in local)
+    report.chain_count = len(chain_users)
+
+    local_usernames = UserFaceEncoding.objects.order_by('id').values_list('username', flat=True)
+    for username in local_usernames.iterator(chunk_size=chunk_size):
+        report.local_count += 1
+        if username not in chain_users:
+            report.local_only.append(username)
+
+    if repair and report.local_only:
+        report.repaired = repair_local_orphans(ledger, report.local_only, workers, chunk_size)
+    return report
+
+
+def repair_local_orphans(ledger, usernames, workers=8, chunk_size=2000):
+    """
+    Delete local encodings of users that are still not on the ledger.
+
+    Each candidate is re-checked first, so a user whose registration landed
+    after the chain pages were read is kept.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        registered = list(pool.map(ledger.is_registered, usernames))
+    orphans = [username for username, on_chain in zip(usernames, registered) if not on_chain]
+
+    deleted = 0
+    for start in range(0, len(orphans), chunk_size):
+        count, _ = UserFaceEncoding.objects.filter(username__in=orphans[start:start + chunk_size]).delete()
+        deleted += count
+    return deleted
@@ -1,8 +1,22 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.conf import settings
 from django.urls import reverse
 import json
 import base64
 import hashlib
+from unittest import mock
+
+# Audit events queued by the tests stay in memory unless a test flushes them;
+# a background writer would race the test database's flushes and rollbacks
+_audit_thread = mock.patch('authentication.audit.AuditWriter._start')
+
+
+def setUpModule():
+    _audit_thread.start()
+
+
+def tearDownModule():
+    _audit_thread.stop()
 
 class AuthenticationAPITestCase(TestCase):
     """Test cases for authentication API endpoints"""
@@ -54,3 +68,1526 @@ class AuthenticationAPITestCase(TestCase):
         )
         self.assertEqual(response.status_code, 400)
 
+
+
+class AsyncAuthenticationAPITestCase(TestCase):
+    """Test cases for the async (ASGI) authentication endpoints"""
+
+    def setUp(self):
+        """Set up test data"""
+        self.register_url = reverse('register_async')
+        self.verify_url = reverse('verify_async')
+
+    def test_register_missing_fields(self):
+        """Test async registration with missing fields"""
+        response = self.client.post(
+            self.register_url,
+            data=json.dumps({}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+    def test_verify_invalid_json(self):
+        """Test async verification with invalid JSON"""
+        response = self.client.post(
+            self.verify_url,
+            data="invalid json",
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_not_allowed(self):
+        """Test that async endpoints only accept POST"""
+        self.assertEqual(self.client.get(self.register_url).status_code, 405)
+        self.assertEqual(self.client.get(self.verify_url).status_code, 405)
+
+    def test_views_are_coroutines(self):
+        """Test that the async views stay coroutine functions after decoration"""
+        import asyncio
+        from . import async_views
+        self.assertTrue(asyncio.iscoroutinefunction(async_views.register))
+        self.assertTrue(asyncio.iscoroutinefunction(async_views.verify))
+        self.assertTrue(async_views.register.csrf_exempt)
+
+
+class BlockchainTransportTestCase(TestCase):
+    """Test cases for the blockchain provider factory"""
+
+    def test_transport_selection(self):
+        """Test that the provider type follows the URL scheme"""
+        from web3 import IPCProvider, WebsocketProvider
+        from .blockchain import PooledHTTPProvider, make_provider
+
+        self.assertIsInstance(make_provider('http://127.0.0.1:7545'), PooledHTTPProvider)
+        self.assertIsInstance(make_provider('ws://127.0.0.1:7545'), WebsocketProvider)
+        self.assertIsInstance(make_provider('ipc:///tmp/node.ipc'), IPCProvider)
+        self.assertIsInstance(make_provider('/tmp/node.ipc'), IPCProvider)
+
+    def test_http_provider_uses_settings(self):
+        """Test that timeouts and pool size come from settings"""
+        from .blockchain import make_provider
+
+        with self.settings(GANACHE_CONNECT_TIMEOUT=1.5, GANACHE_READ_TIMEOUT=9, GANACHE_POOL_SIZE=7):
+            provider = make_provider('http://127.0.0.1:7545')
+        self.assertEqual(provider.get_request_kwargs()['timeout'], (1.5, 9))
+        self.assertEqual(provider.session.get_adapter('http://127.0.0.1').poolmanager.connection_pool_kw['maxsize'], 7)
+
+    def test_rpc_latency_summary(self):
+        """Test per-method latency aggregation"""
+        from .blockchain import RPCLatencyStats
+
+        stats = RPCLatencyStats(max_samples=3)
+        for seconds in (0.001, 0.002, 0.003, 0.004):
+            stats.record('eth_call', seconds)
+        summary = stats.summary()['eth_call']
+        self.assertEqual(summary['count'], 3)
+        self.assertAlmostEqual(summary['max_ms'], 4.0)
+
+
+class ChainServiceTestCase(TestCase):
+    """Test cases for the lazily initialized chain service"""
+
+    def tearDown(self):
+        from .blockchain import reset_chain
+        reset_chain()
+
+    def test_service_creation_does_no_io(self):
+        """Test that building the service does not create a provider or contact the node"""
+        from unittest import mock
+        from .blockchain import ChainService
+
+        with mock.patch('authentication.blockchain.make_web3') as make_web3:
+            service = ChainService(url='http://127.0.0.1:1')
+            make_web3.assert_not_called()
+            service.w3
+            make_web3.assert_called_once_with('http://127.0.0.1:1')
+
+    def test_contract_address_from_settings(self):
+        """Test that settings.CONTRACT_ADDRESS takes precedence"""
+        from .blockchain import resolve_contract_address
+
+        address = '0x' + '1' * 40
+        with self.settings(CONTRACT_ADDRESS=address):
+            self.assertEqual(resolve_contract_address(), address)
+
+    def test_contract_address_from_contract_info(self):
+        """Test that blockchain/contract-info.json is used when settings are empty"""
+        import tempfile
+        from unittest import mock
+        from .blockchain import resolve_contract_address
+
+        address = '0x' + '2' * 40
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'address': address}, f)
+        with self.settings(CONTRACT_ADDRESS=''), \
+                mock.patch('authentication.blockchain.contract_info_path', return_value=f.name):
+            self.assertEqual(resolve_contract_address(), address)
+
+    def test_legacy_module_attributes(self):
+        """Test that views.CONTRACT_ADDRESS still resolves through the service"""
+        from . import views
+        from .blockchain import get_chain
+
+        self.assertEqual(views.CONTRACT_ADDRESS, get_chain().address)
+
+
+class PayloadParsingTestCase(TestCase):
+    """Test cases for multipart/raw image uploads and compact responses"""
+
+    def setUp(self):
+        from django.test import RequestFactory
+        self.factory = RequestFactory()
+        self.image = b"\xff\xd8\xff\xe0fake-jpeg-bytes"
+
+    def test_json_body(self):
+        """Test the original JSON + base64 format"""
+        from .payloads import parse_face_request
+
+        request = self.factory.post('/api/verify/', data=json.dumps({
+            'username': 'alice', 'password': 'pw',
+            'face_image': base64.b64encode(self.image).decode('utf-8'),
+        }), content_type='application/json')
+        data, image = parse_face_request(request)
+        self.assertEqual(data['username'], 'alice')
+        self.assertEqual(image, self.image)
+
+    def test_multipart_body(self):
+        """Test multipart/form-data with a binary file part"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .payloads import parse_face_request
+
+        request = self.factory.post('/api/verify/', data={
+            'username': 'alice', 'password': 'pw',
+            'face_image': SimpleUploadedFile('face.jpg', self.image, content_type='image/jpeg'),
+        })
+        data, image = parse_face_request(request)
+        self.assertEqual(data, {'username': 'alice', 'password': 'pw'})
+        self.assertEqual(image, self.image)
+
+    def test_raw_jpeg_body(self):
+        """Test a raw image/jpeg body with credentials in headers"""
+        from .payloads import parse_face_request
+
+        request = self.factory.post('/api/verify/', data=self.image, content_type='image/jpeg',
+                                    HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+        data, image = parse_face_request(request)
+        self.assertEqual(data['username'], 'alice')
+        self.assertEqual(image, self.image)
+
+    def test_raw_body_ignores_query_credentials(self):
+        """Test that a raw body takes credentials from headers only, not the query string"""
+        from .payloads import parse_face_request
+
+        request = self.factory.post('/api/verify/?username=bob&password=x&encoding=omit', data=self.image,
+                                    content_type='image/jpeg', HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+        data, _ = parse_face_request(request)
+        self.assertEqual(data, {'username': 'alice', 'password': 'pw', 'encoding': 'omit'})
+
+    def test_json_body_over_upload_memory_limit(self):
+        """Test that a body Django refuses to buffer is a 413, not a 400"""
+        body = json.dumps({'username': 'a', 'password': 'b', 'face_image': self.dummy_b64()})
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=64):
+            response = self.client.post(reverse('verify'), data=body, content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='too-big')
+        self.assertEqual(response.status_code, 413)
+
+    def test_size_limit_enforced_before_reading(self):
+        """Test that an oversized upload is rejected with 413"""
+        with self.settings(MAX_FACE_IMAGE_BYTES=8):
+            response = self.client.post(reverse('verify'), data=self.image, content_type='image/jpeg',
+                                        HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+        self.assertEqual(response.status_code, 413)
+
+    def test_image_dimensions_enforced(self):
+        """Test that images over MAX_FACE_IMAGE_SIDE are rejected from the header"""
+        import io
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (1600, 64)).save(buffer, format='JPEG')
+        with self.settings(MAX_FACE_IMAGE_SIDE=1280):
+            response = self.client.post(reverse('verify'), data=buffer.getvalue(), content_type='image/jpeg',
+                                        HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('1600x64', response.json()['error'])
+
+    def test_client_config(self):
+        """Test the capture parameters published to the frontend"""
+        with self.settings(CAPTURE_MAX_SIDE=320, MAX_FACE_IMAGE_SIDE=640):
+            response = self.client.get(reverse('client_config'))
+        self.assertEqual(response.status_code, 200)
+        config = response.json()
+        self.assertEqual(config['capture']['max_side'], 320)
+        self.assertEqual(config['limits']['max_image_side'], 640)
+
+    def test_encoding_payload_modes(self):
+        """Test full, binary and omitted encodings in the verify response"""
+        import numpy as np
+        from .payloads import encoding_payload
+
+        encoding = np.linspace(-1, 1, 128)
+        self.assertEqual(len(encoding_payload(encoding, 'full')['face_encoding']), 128)
+        self.assertEqual(encoding_payload(encoding, 'omit'), {})
+        packed = encoding_payload(encoding, 'binary')
+        unpacked = np.frombuffer(base64.b64decode(packed['face_encoding_b64']), dtype='<f4')
+        np.testing.assert_allclose(unpacked, encoding, rtol=1e-6)
+
+    def test_invalid_encoding_mode(self):
+        """Test that an unknown response encoding mode is rejected"""
+        response = self.client.post(
+            reverse('verify') + '?encoding=xml',
+            data=json.dumps({'username': 'a', 'password': 'b', 'face_image': self.dummy_b64()}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_face_hint(self):
+        """Test the client face box in its form, header and JSON spellings"""
+        from .payloads import PayloadError, get_face_hint
+
+        request = self.factory.post('/api/verify/', data=b'', content_type='image/jpeg', HTTP_X_FACE_BOX='40,30,100,120')
+        self.assertEqual(get_face_hint(request, {}), (30, 140, 150, 40))
+        data = {'face_box': {'x': 10.4, 'y': 20, 'width': 50, 'height': 50}}
+        self.assertEqual(get_face_hint(request, data), (20, 60, 70, 10))
+        self.assertNotIn('face_box', data)
+        self.assertIsNone(get_face_hint(self.factory.post('/api/verify/'), {}))
+        for bad in ('1,2,3', '0,0,-5,10', 'a,b,c,d', {'x': 1}, 'nan,0,1,1'):
+            with self.assertRaises(PayloadError):
+                get_face_hint(request, {'face_box': bad})
+
+    def test_face_hint_reaches_encoder(self):
+        """Test that verify/register pass the hint to the encoder"""
+        from unittest import mock
+
+        with mock.patch('authentication.views.get_encoder') as get_encoder:
+            get_encoder.return_value.return_value = None
+            with self.settings(LEDGER_BACKEND='memory'):
+                response = self.client.post(reverse('register'), data=self.image, content_type='image/jpeg',
+                                            HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw',
+                                            HTTP_X_FACE_BOX='1,2,30,40')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_encoder.return_value.call_args.kwargs['face_hint'], (2, 31, 42, 1))
+
+    def dummy_b64(self):
+        return base64.b64encode(self.image).decode('utf-8')
+
+
+class SettingsConfigTestCase(TestCase):
+    """Test cases for environment parsing in settings.config"""
+
+    FLAGS = ('DEBUG', 'VERIFY_OVERLAP_ENCODE', 'PRELOAD_FACE_MODELS', 'ADMISSION_TRUST_FORWARDED_FOR',
+             'AUDIT_LOG_ENABLED', 'PROFILING_ENABLED')
+
+    def load_settings(self, environ):
+        """A fresh copy of the settings module, evaluated under `environ`"""
+        import importlib.util
+        import os
+        from faceauth_backend import settings as settings_module
+
+        spec = importlib.util.spec_from_file_location('settings_under_test', settings_module.__file__)
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, environ):
+            spec.loader.exec_module(module)
+        return module
+
+    def test_boolean_flags_can_be_turned_off(self):
+        """Test that every boolean flag reads "False" and "0" as False"""
+        for value in ('False', '0', 'off'):
+            module = self.load_settings({flag: value for flag in self.FLAGS})
+            for flag in self.FLAGS:
+                self.assertIs(getattr(module, flag), False, f'{flag}={value}')
+        module = self.load_settings({flag: 'yes' for flag in self.FLAGS})
+        for flag in self.FLAGS:
+            self.assertIs(getattr(module, flag), True, flag)
+
+    def test_invalid_boolean_is_rejected(self):
+        """Test that a value that is neither true nor false fails loudly"""
+        from django.core.exceptions import ImproperlyConfigured
+
+        with self.assertRaises(ImproperlyConfigured):
+            self.load_settings({'AUDIT_LOG_ENABLED': 'maybe'})
+
+
+class MetricsTestCase(TestCase):
+    """Test cases for per-stage latency metrics"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test Prometheus histogram exposition"""
+        from .metrics import Histogram, Registry
+
+        registry = Registry()
+        histogram = registry.register(Histogram('test_seconds', 'Test', ('stage',), buckets=(0.1, 1.0)))
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.5, stage='a')
+        histogram.observe(5, stage='a')
+        text = registry.render()
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="a"} 3', text)
+
+    def test_stages_labelled_with_endpoint(self):
+        """Test that stages inside a tracked view carry its endpoint label"""
+        from django.http import JsonResponse
+        from .metrics import REQUESTS, STAGE_SECONDS, stage, track_request
+
+        @track_request('test_endpoint')
+        def view(request):
+            with stage('work'):
+                pass
+            return JsonResponse({}, status=201)
+
+        view(None)
+        self.assertEqual(STAGE_SECONDS.count(endpoint='test_endpoint', stage='work'), 1)
+        self.assertEqual(REQUESTS.value(endpoint='test_endpoint', status='201'), 1)
+
+    def test_metrics_endpoint(self):
+        """Test that /api/metrics/ serves the text format after a request"""
+        self.client.post(reverse('verify'), data='invalid json', content_type='application/json')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('faceauth_requests_total{endpoint="verify",status="400"}', body)
+        self.assertIn('faceauth_stage_seconds_count{endpoint="verify",stage="json_parse"}', body)
+
+
+class LedgerBackendTestCase(TestCase):
+    """Test cases for the register/verify success paths on the in-memory ledger"""
+
+    def setUp(self):
+        from .ledger import reset_ledger
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub')
+        self.override.enable()
+        self.image = b"\xff\xd8\xff\xe0alice-face"
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+
+    def post(self, name, username, password, image):
+        return self.client.post(reverse(name), data=image, content_type='image/jpeg',
+                                HTTP_X_USERNAME=username, HTTP_X_PASSWORD=password)
+
+    def test_register_then_verify(self):
+        """Test a full registration and login without a blockchain node"""
+        from .models import UserFaceEncoding
+
+        response = self.post('register', 'alice', 'pw', self.image)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['password_hash'], hashlib.sha256(b'pw').hexdigest())
+        self.assertTrue(UserFaceEncoding.objects.filter(username='alice').exists())
+
+        response = self.post('verify', 'alice', 'pw', self.image)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['dashboard_data']['username'], 'alice')
+
+    def test_duplicate_and_failed_logins(self):
+        """Test duplicate registration, wrong password, wrong face and unknown user"""
+        self.post('register', 'alice', 'pw', self.image)
+        self.assertEqual(self.post('register', 'alice', 'pw', self.image).status_code, 400)
+        self.assertEqual(self.post('verify', 'alice', 'wrong', self.image).status_code, 401)
+        self.assertEqual(self.post('verify', 'alice', 'pw', b"\xff\xd8other-face").status_code, 401)
+        self.assertEqual(self.post('verify', 'bob', 'pw', self.image).status_code, 404)
+
+    def test_verify_encode_overlaps_lookups(self):
+        """Test that verify encodes ahead of its lookups and cancels the encode when they fail"""
+        from concurrent.futures import Future, ThreadPoolExecutor
+        from django.test import RequestFactory
+        from django.test.client import AsyncRequestFactory
+        from .admission import ENCODE, get_limiter, reset_admission
+        from .async_views import overlap_enabled, start_encode
+        from .metrics import ENCODES_CANCELLED
+
+        class HeldExecutor:
+            """Accepts jobs without running them"""
+            def __init__(self, started):
+                self.started = started
+                self.futures = []
+
+            def submit(self, fn, *args):
+                future = Future()
+                if self.started:
+                    future.set_running_or_notify_cancel()
+                self.futures.append(future)
+                return future
+
+        # Unset, the overlap follows the server interface
+        with self.settings(VERIFY_OVERLAP_ENCODE=None):
+            self.assertFalse(overlap_enabled(RequestFactory().post('/api/verify/')))
+            self.assertTrue(overlap_enabled(AsyncRequestFactory().post('/api/verify/')))
+
+        reset_admission()
+        self.addCleanup(reset_admission)
+        overlap = self.settings(VERIFY_OVERLAP_ENCODE=True)
+        overlap.enable()
+        self.addCleanup(overlap.disable)
+        with self.settings(ADMISSION_ENCODE_CONCURRENCY=1):
+            limiter = get_limiter(ENCODE)
+        self.post('register', 'alice', 'pw', self.image)
+        queued, running = ENCODES_CANCELLED.value(when='queued'), ENCODES_CANCELLED.value(when='running')
+
+        held = HeldExecutor(started=False)
+        with mock.patch('authentication.async_views.get_encode_executor', return_value=held):
+            self.assertEqual(self.post('verify', 'alice', 'wrong', self.image).status_code, 401)
+            self.assertEqual(self.post('verify', 'bob', 'pw', self.image).status_code, 404)
+            self.assertEqual(self.post('verify_async', 'alice', 'wrong', self.image).status_code, 401)
+        self.assertEqual(len(held.futures), 3)
+        self.assertTrue(all(future.cancelled() for future in held.futures))
+        self.assertEqual(ENCODES_CANCELLED.value(when='queued'), queued + 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+        # A started encode keeps its slot until the pool finishes it
+        held = HeldExecutor(started=True)
+        with mock.patch('authentication.async_views.get_encode_executor', return_value=held):
+            self.assertEqual(self.post('verify', 'alice', 'wrong', self.image).status_code, 401)
+        self.assertEqual(ENCODES_CANCELLED.value(when='running'), running + 1)
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertIsNone(start_encode(None, self.image))  # no free slot: encode after the checks
+        held.futures[0].set_result((None, {}))
+        self.assertEqual(limiter.in_flight, 0)
+
+        with ThreadPoolExecutor(1) as pool, \
+                mock.patch('authentication.async_views.get_encode_executor', return_value=pool):
+            self.assertEqual(self.post('verify', 'alice', 'pw', self.image).status_code, 200)
+            self.assertEqual(self.post('verify_async', 'alice', 'pw', self.image).status_code, 200)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_verify_falls_back_to_the_face_key(self):
+        """Test that another capture of the face matches the ledger key without a local encoding"""
+        import numpy as np
+        from face_module.face_keys import face_key
+        from face_module.face_utils import stub_encode_face
+        from .models import UserFaceEncoding
+
+        def capture(image_bytes, **kwargs):
+            # Captures of one face: the same base encoding plus per-image noise
+            face = image_bytes.split(b'-')[0]
+            noise = np.random.default_rng(len(image_bytes)).normal(0, 0.015, 128)
+            return stub_encode_face(face) + noise
+
+        with mock.patch('authentication.views.get_encoder', return_value=capture), \
+                mock.patch('authentication.async_views.get_encode_executor', return_value=None):
+            response = self.post('register', 'alice', 'pw', b'alice-1')
+            self.assertEqual(response.json()['face_hash'], face_key(capture(b'alice-1'), settings.FACE_KEY_SEED))
+            UserFaceEncoding.objects.filter(username='alice').delete()
+
+            self.assertEqual(self.post('verify', 'alice', 'pw', b'alice-22').status_code, 200)
+            self.assertEqual(self.post('verify', 'alice', 'pw', b'mallory-1').status_code, 401)
+            with self.settings(FACE_KEY_SEED=settings.FACE_KEY_SEED + 1):
+                self.assertEqual(self.post('verify', 'alice', 'pw', b'alice-22').status_code, 401)
+
+    def test_face_index_finds_other_captures(self):
+        """Test that stored encodings are bucketed and another capture finds its owner among few candidates"""
+        import numpy as np
+        from face_module.face_keys import BANDS
+        from face_module.face_utils import stub_encode_face
+        from . import face_index
+        from .admission import reset_admission
+        from .models import FaceKeyBucket, UserFaceEncoding
+
+        def capture(image_bytes, **kwargs):
+            face = image_bytes.split(b'-')[0]
+            noise = np.random.default_rng(len(image_bytes)).normal(0, 0.015, 128)
+            return stub_encode_face(face) + noise
+
+        reset_admission()
+        self.addCleanup(reset_admission)
+        with self.settings(ADMISSION_CLIENT_RATE=0), \
+                mock.patch('authentication.views.get_encoder', return_value=capture):
+            for name in ('alice', 'bob', 'carol'):
+                self.assertEqual(self.post('register', name, 'pw', f'{name}-1'.encode()).status_code, 200)
+            self.assertEqual(FaceKeyBucket.objects.filter(username='alice').count(), BANDS)
+
+            matches = face_index.find_matches(capture(b'alice-22'))
+            self.assertEqual([username for username, _ in matches], ['alice'])
+            self.assertEqual(face_index.find_matches(capture(b'alice-22'), exclude='alice'), [])
+
+            # Duplicate faces are refused only when enabled
+            self.assertEqual(self.post('register', 'alice2', 'pw', b'alice-333').status_code, 200)
+            with self.settings(REGISTER_REJECT_DUPLICATE_FACES=True):
+                response = self.post('register', 'alice3', 'pw', b'alice-4444')
+                self.assertEqual(response.status_code, 409)
+                async def encode_async(image_bytes, face_hint=None):
+                    return capture(image_bytes)
+                with mock.patch('authentication.async_views.encode_face_async', side_effect=encode_async):
+                    self.assertEqual(self.post('register_async', 'alice3', 'pw', b'alice-4444').status_code, 409)
+                self.assertEqual(self.post('register', 'dave', 'pw', b'dave-1').status_code, 200)
+
+        UserFaceEncoding.objects.filter(username='bob').delete()
+        self.assertFalse(FaceKeyBucket.objects.filter(username='bob').exists())
+        FaceKeyBucket.objects.all().delete()
+        self.assertEqual(face_index.rebuild(), 4)
+        self.assertEqual(FaceKeyBucket.objects.count(), 4 * BANDS)
+
+    def test_verify_fails_closed_on_errors(self):
+        """Test that an error in the distance check is a 500, not a fall back to the face key"""
+        self.post('register', 'alice', 'pw', self.image)
+        with mock.patch('authentication.views.get_face_distance', side_effect=ValueError('bad encoding')), \
+                mock.patch('authentication.views.verify_face', return_value=True) as key_match:
+            self.assertEqual(self.post('verify', 'alice', 'pw', self.image).status_code, 500)
+        key_match.assert_not_called()
+
+    def test_async_views_share_the_ledger(self):
+        """Test that a user registered through the sync view can log in through the async one"""
+        from unittest import mock
+
+        self.post('register', 'alice', 'pw', self.image)
+        with mock.patch('authentication.async_views.get_encode_executor', return_value=None):
+            response = self.post('verify_async', 'alice', 'pw', self.image)
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_many_registrations(self):
+        """Test that the memory ledger handles thousands of registrations quickly"""
+        from .ledger import get_ledger
+
+        ledger = get_ledger()
+        for i in range(5000):
+            ledger.register_user(f'user{i}', 'p' * 64, 'f' * 64)
+        self.assertTrue(ledger.is_registered('user4999'))
+        self.assertEqual(ledger.get_user_hash('user0'), ('p' * 64, 'f' * 64))
+
+    def test_eth_tester_backend(self):
+        """Test FaceAuth on the in-process EVM when eth-tester and the compiled artifact exist"""
+        import importlib.util
+        from unittest import SkipTest
+        from .blockchain import contract_artifact_path
+        from .ledger import get_ledger
+
+        if importlib.util.find_spec('eth_tester') is None or not contract_artifact_path().exists():
+            raise SkipTest('needs eth-tester and blockchain/build/contracts/FaceAuth.json')
+        with self.settings(LEDGER_BACKEND='eth_tester'):
+            ledger = get_ledger()
+            ledger.check_ready()
+            ledger.register_user('alice', 'p' * 64, 'f' * 64)
+            self.assertTrue(ledger.is_registered('alice'))
+            self.assertEqual(tuple(ledger.get_user_hash('alice')), ('p' * 64, 'f' * 64))
+
+    def test_eth_tester_without_artifact(self):
+        """Test that a missing compiled contract is reported as a ledger error"""
+        from .blockchain import EthTesterChain
+        from .ledger import EthTesterLedger, LedgerError
+
+        ledger = EthTesterLedger(EthTesterChain(artifact_path='/nonexistent/FaceAuth.json'))
+        with self.assertRaises(LedgerError):
+            ledger.check_ready()
+
+    def test_unknown_backend(self):
+        """Test that a misconfigured backend name is reported"""
+        from .ledger import get_ledger
+
+        with self.settings(LEDGER_BACKEND='nope'):
+            with self.assertRaises(ValueError):
+                get_ledger()
+
+
+class FaceDedupAuditTestCase(TestCase):
+    """Test cases for the blocked all-pairs duplicate search"""
+
+    def test_blocked_search_matches_brute_force(self):
+        """Test that blocked pairs equal a direct all-pairs computation"""
+        import os
+        import tempfile
+        import numpy as np
+        from . import dedup
+
+        rng = np.random.default_rng(0)
+        encodings = rng.normal(0, 0.1, (130, 128)).astype(np.float32)
+        encodings[100] = encodings[3] + 0.001
+        encodings[101] = encodings[3] - 0.001
+        encodings[120] = encodings[7]
+        rows = [(f'user{i}', json.dumps(e.tolist())) for i, e in enumerate(encodings)]
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.makedirs(os.path.join(work_dir, dedup.PAIRS_DIR))
+            count = dedup.export_encodings(rows, len(rows), work_dir)
+            for row in dedup.pending_block_rows(work_dir, count, 32):
+                dedup.audit_block_row(work_dir, count, 32, 0.8, row)
+            self.assertEqual(dedup.pending_block_rows(work_dir, count, 32), [])
+            pairs_a, pairs_b, distances = dedup.load_pairs(work_dir, count, 32)
+
+        diff = encodings[:, None, :] - encodings[None, :, :]
+        full = np.sqrt((diff ** 2).sum(-1))
+        expected = {(a, b) for a, b in zip(*np.nonzero(full < 0.8)) if a < b}
+        self.assertEqual(set(zip(pairs_a.tolist(), pairs_b.tolist())), expected)
+
+        clusters = dedup.find_clusters(count, pairs_a, pairs_b, distances)
+        members = [m for m, _ in clusters]
+        self.assertIn([3, 100, 101], members)
+        self.assertIn([7, 120], members)
+
+    def test_command_reports_clusters(self):
+        """Test the management command end to end on the database"""
+        import tempfile
+        from io import StringIO
+        import numpy as np
+        from django.core.management import call_command
+        from .models import UserFaceEncoding
+
+        rng = np.random.default_rng(1)
+        base = rng.normal(0, 0.1, 128)
+        for i in range(5):
+            UserFaceEncoding.objects.create(
+                username=f'user{i}', face_encoding=json.dumps(rng.normal(0, 0.1, 128).tolist()))
+        UserFaceEncoding.objects.create(username='alice', face_encoding=json.dumps(base.tolist()))
+        UserFaceEncoding.objects.create(username='alice2', face_encoding=json.dumps((base + 0.01).tolist()))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            out = StringIO()
+            call_command('face_dedup_audit', work_dir=work_dir, workers=1, tolerance=0.5, stdout=out)
+            self.assertIn('alice, alice2', out.getvalue())
+            # Second run resumes from the finished work directory
+            out = StringIO()
+            call_command('face_dedup_audit', work_dir=work_dir, workers=1, tolerance=0.5, stdout=out)
+            self.assertIn('Resuming', out.getvalue())
+            self.assertIn('alice, alice2', out.getvalue())
+
+
+class ReconcileUsersTestCase(TestCase):
+    """Test cases for paged ledger/database reconciliation"""
+
+    def setUp(self):
+        from .ledger import reset_ledger
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory')
+        self.override.enable()
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+
+    def populate(self):
+        from .ledger import get_ledger
+        from .models import UserFaceEncoding
+
+        ledger = get_ledger()
+        for i in range(25):
+            ledger.register_user(f'user{i}', 'p' * 64, 'f' * 64)
+            if i not in (3, 17):
+                UserFaceEncoding.objects.create(username=f'user{i}', face_encoding='[]')
+        UserFaceEncoding.objects.create(username='orphan', face_encoding='[]')
+        return ledger
+
+    def test_reports_orphans_in_both_directions(self):
+        """Test that small pages and several workers find every mismatch"""
+        from .reconcile import reconcile
+
+        report = reconcile(self.populate(), page_size=4, workers=3)
+        self.assertEqual(report.chain_count, 25)
+        self.assertEqual(report.local_count, 24)
+        self.assertEqual(report.chain_only, ['user3', 'user17'])
+        self.assertEqual(report.local_only, ['orphan'])
+
+    def test_repair_command(self):
+        """Test that --repair deletes local rows missing from the ledger"""
+        from io import StringIO
+        from django.core.management import call_command
+        from .models import UserFaceEncoding
+
+        self.populate()
+        out = StringIO()
+        call_command('reconcile_users', page_size=10, repair=True, stdout=out)
+        self.assertIn('Deleted 1 orphaned', out.getvalue())
+        self.assertFalse(UserFaceEncoding.objects.filter(username='orphan').exists())
+        self.assertEqual(UserFaceEncoding.objects.count(), 23)
+
+
+class SessionTokenTestCase(TestCase):
+    """Test cases for signed session tokens issued by verify"""
+
+    def setUp(self):
+        from .ledger import reset_ledger
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub')
+        self.override.enable()
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+
+    def bearer(self, token):
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def test_verify_issues_usable_token(self):
+        """Test that the verify token authorizes /api/session/ and can be refreshed"""
+        image = b"\xff\xd8\xff\xe0alice-face"
+        for name in ('register', 'verify'):
+            response = self.client.post(reverse(name), data=image, content_type='image/jpeg',
+                                        HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+            self.assertEqual(response.status_code, 200, response.content)
+        token = response.json()['session_token']
+
+        response = self.client.get(reverse('session'), **self.bearer(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['username'], 'alice')
+
+        response = self.client.post(reverse('token_refresh'), **self.bearer(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['expires_in'], 15 * 60)
+
+    def test_rejected_tokens(self):
+        """Test missing, tampered and expired tokens"""
+        from .tokens import issue_token
+
+        token = issue_token('alice')['session_token']
+        self.assertEqual(self.client.get(reverse('session')).status_code, 401)
+        response = self.client.get(reverse('session'), **self.bearer(token[:-2] + 'xx'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        with self.settings(SESSION_TOKEN_TTL=-1):
+            response = self.client.get(reverse('session'), **self.bearer(token))
+        self.assertEqual(response.json()['error'], 'Session token expired')
+
+    def test_refresh_keeps_auth_time(self):
+        """Test that refreshing cannot extend a session past SESSION_MAX_AGE"""
+        import time
+        from .tokens import issue_token, read_token, refresh_token, TokenError
+
+        auth_time = int(time.time()) - 3600
+        refreshed = refresh_token(issue_token('alice', auth_time=auth_time)['session_token'])
+        self.assertEqual(read_token(refreshed['session_token'])['a'], auth_time)
+        with self.settings(SESSION_MAX_AGE=1800):
+            with self.assertRaises(TokenError):
+                refresh_token(refreshed['session_token'])
+
+
+class IdempotencyKeyTestCase(TestCase):
+    """Test cases for Idempotency-Key handling on register/verify"""
+
+    def setUp(self):
+        from .ledger import reset_ledger
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub')
+        self.override.enable()
+        self.image = b"\xff\xd8\xff\xe0alice-face"
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+
+    def post(self, name, key, image=None, password='pw'):
+        headers = {'HTTP_X_USERNAME': 'alice', 'HTTP_X_PASSWORD': password}
+        if key:
+            headers['HTTP_IDEMPOTENCY_KEY'] = key
+        return self.client.post(reverse(name), data=image or self.image, content_type='image/jpeg', **headers)
+
+    def test_retry_replays_original_response(self):
+        """Test that a retried registration is replayed instead of re-run"""
+        first = self.post('register', 'key-1')
+        self.assertEqual(first.status_code, 200, first.content)
+        retry = self.post('register', 'key-1')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.content, first.content)
+        # Without the key the request really runs again
+        self.assertEqual(self.post('register', None).json()['error'], 'User already exists')
+
+    def test_async_view_shares_keys(self):
+        """Test that the async register replays an outcome stored by the sync view"""
+        self.post('register', 'key-2')
+        retry = self.post('register_async', 'key-2')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_key_reused_for_different_request(self):
+        """Test that a key is bound to the request it was first used with"""
+        self.post('register', 'key-3')
+        self.assertEqual(self.post('register', 'key-3', password='other').status_code, 422)
+        self.assertEqual(self.post('verify', 'key-3').status_code, 422)
+
+    def test_multipart_retry_with_new_boundary(self):
+        """Test that a multipart retry replays although its boundary differs, like a browser FormData resend"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test.client import encode_multipart
+
+        def post(boundary, password='pw'):
+            body = encode_multipart(boundary, {
+                'username': 'alice', 'password': password,
+                'face_image': SimpleUploadedFile('face.jpg', self.image, content_type='image/jpeg'),
+            })
+            return self.client.post(reverse('register'), data=body, HTTP_IDEMPOTENCY_KEY='key-6',
+                                    content_type=f'multipart/form-data; boundary={boundary}')
+
+        first = post('----FormBoundaryA1')
+        self.assertEqual(first.status_code, 200, first.content)
+        retry = post('----FormBoundaryB2')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(post('----FormBoundaryC3', password='other').status_code, 422)
+
+    def test_server_errors_release_the_key(self):
+        """Test that a 5xx outcome is not stored, so a retry runs again"""
+        from .models import IdempotencyRecord
+
+        with self.settings(FACE_ENCODING_PROFILE='unknown', FACE_ENCODER='face_recognition'):
+            self.assertEqual(self.post('register', 'key-4').status_code, 500)
+        self.assertFalse(IdempotencyRecord.objects.filter(key='key-4').exists())
+        self.assertEqual(self.post('register', 'key-4').status_code, 200)
+
+    def test_pending_key_times_out(self):
+        """Test that a retry gives up with 409 while the original is still running"""
+        from django.test import RequestFactory
+        from django.utils import timezone
+        from .idempotency import request_fingerprint
+        from .models import IdempotencyRecord
+
+        request = RequestFactory().post('/api/register/', data=self.image, content_type='image/jpeg',
+                                        HTTP_X_USERNAME='alice', HTTP_X_PASSWORD='pw')
+        IdempotencyRecord.objects.create(
+            key='key-5', endpoint='register', fingerprint=request_fingerprint(request, 'register'),
+            expires_at=timezone.now() + timezone.timedelta(hours=1),
+        )
+        with self.settings(IDEMPOTENCY_WAIT=0.05):
+            response = self.post('register', 'key-5')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class AdmissionControlTestCase(TestCase):
+    """Test cases for concurrency limits, the wait queue and per-client rates"""
+
+    def setUp(self):
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        reset_admission()
+        reset_ledger()
+
+    def tearDown(self):
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        reset_admission()
+        reset_ledger()
+
+    def test_queue_full_and_handoff(self):
+        """Test that waiters are served in order and overflow is rejected at once"""
+        import threading
+        from .admission import AdmissionError, Limiter
+
+        limiter = Limiter('test', limit=1, max_queue=1, queue_timeout=5)
+        holding, release, order = threading.Event(), threading.Event(), []
+
+        def hold():
+            with limiter.slot():
+                holding.set()
+                release.wait(5)
+                order.append('first')
+
+        def wait():
+            with limiter.slot():
+                order.append('second')
+
+        first = threading.Thread(target=hold)
+        first.start()
+        holding.wait(5)
+        second = threading.Thread(target=wait)
+        second.start()
+        while limiter.queued == 0:
+            pass
+
+        with self.assertRaises(AdmissionError) as ctx:
+            with limiter.slot():
+                pass
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertGreaterEqual(ctx.exception.retry_after, 1)
+
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_queue_timeout(self):
+        """Test that a waiter gives up after the queue timeout, sync and async"""
+        import asyncio
+        from .admission import AdmissionError, Limiter
+
+        limiter = Limiter('test', limit=1, max_queue=4, queue_timeout=0.05)
+
+        async def wait_async():
+            async with limiter.aslot():
+                pass
+
+        with limiter.slot():
+            with self.assertRaises(AdmissionError):
+                with limiter.slot():
+                    pass
+            with self.assertRaises(AdmissionError):
+                asyncio.run(wait_async())
+        self.assertEqual((limiter.in_flight, limiter.queued), (0, 0))
+        asyncio.run(wait_async())
+
+    def test_weighted_slots(self):
+        """Test that a multi-slot request waits for room and holds back later waiters in order"""
+        import threading
+        from .admission import Limiter
+
+        limiter = Limiter('test', limit=3, max_queue=4, queue_timeout=5)
+        entered, order = threading.Event(), []
+
+        def batch():
+            with limiter.slot(3):
+                order.append(('batch', limiter.in_flight))
+
+        def single():
+            with limiter.slot():
+                order.append(('single', limiter.in_flight))
+
+        with limiter.slot(2):
+            threads = [threading.Thread(target=batch), threading.Thread(target=single)]
+            threads[0].start()
+            while limiter.queued < 1:
+                pass
+            threads[1].start()
+            while limiter.queued < 2:
+                pass
+            self.assertEqual(limiter.in_flight, 2)  # one slot free, but the batch is first in line
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [('batch', 3), ('single', 1)])
+        self.assertEqual(limiter.in_flight, 0)
+
+        with limiter.slot(10):  # capped at the limit
+            self.assertEqual(limiter.in_flight, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_client_rate_cost(self):
+        """Test that a cost takes that many tokens and one above the burst leaves the bucket in debt"""
+        from .admission import AdmissionError, ClientRateLimiter
+
+        limiter = ClientRateLimiter(rate=1, burst=4)
+        limiter.check('a', cost=3)
+        with self.assertRaises(AdmissionError):
+            limiter.check('a', cost=2)
+        limiter.check('b', cost=10)
+        with self.assertRaises(AdmissionError) as ctx:
+            limiter.check('b')
+        self.assertGreaterEqual(ctx.exception.retry_after, 7)
+
+    def test_client_rate_limit(self):
+        """Test the per-client token bucket behind register"""
+        image = b"\xff\xd8\xff\xe0face"
+        with self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub',
+                           ADMISSION_CLIENT_RATE=0.01, ADMISSION_CLIENT_BURST=1):
+            def post(username, password='pw'):
+                return self.client.post(reverse('register'), data=image, content_type='image/jpeg',
+                                        HTTP_X_USERNAME=username, HTTP_X_PASSWORD=password)
+
+            self.assertEqual(post('alice').status_code, 200)
+            response = post('bob')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '100')
+            # Cheap validation still answers before admission
+            self.assertEqual(post('carol', password='').status_code, 400)
+
+
+class BatchVerifyTestCase(TestCase):
+    """Test cases for the bulk verify endpoint"""
+
+    def setUp(self):
+        from .admission import reset_admission
+        from .ledger import get_ledger, reset_ledger
+        reset_admission()
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub', FACE_ENCODE_WORKERS=1)
+        self.override.enable()
+        self.images = {name: f"\xff\xd8{name}-face".encode('latin-1') for name in ('alice', 'bob')}
+        for name, image in self.images.items():
+            response = self.client.post(reverse('register'), data=image, content_type='image/jpeg',
+                                        HTTP_X_USERNAME=name, HTTP_X_PASSWORD='pw')
+            self.assertEqual(response.status_code, 200, response.content)
+        self.ledger = get_ledger()
+
+    def tearDown(self):
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_admission()
+        reset_ledger()
+
+    def item(self, username, password='pw', image=None):
+        image = self.images.get(username, b"\xff\xd8unknown") if image is None else image
+        return {'username': username, 'password': password,
+                'face_image': base64.b64encode(image).decode('ascii')}
+
+    def post(self, items, **query):
+        url = reverse('verify_batch')
+        if query:
+            url += '?' + '&'.join(f'{k}={v}' for k, v in query.items())
+        return self.client.post(url, data=json.dumps({'items': items}), content_type='application/json')
+
+    def test_per_item_results(self):
+        """Test that each item gets its own outcome, in request order"""
+        from unittest import mock
+
+        items = [
+            self.item('alice'),
+            self.item('bob', password='wrong'),
+            self.item('carol'),
+            self.item('bob', image=self.images['alice']),
+            {'username': 'alice'},
+            self.item('bob'),
+        ]
+        with mock.patch.object(self.ledger, 'is_registered', wraps=self.ledger.is_registered) as single:
+            response = self.post(items, encoding='omit')
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual([r['status'] for r in body['results']], [200, 401, 404, 401, 400, 200])
+        self.assertEqual([r['index'] for r in body['results']], list(range(6)))
+        self.assertEqual((body['verified'], body['failed']), (2, 4))
+        self.assertIn('session_token', body['results'][0])
+        self.assertNotIn('face_encoding', body['results'][0])
+        single.assert_not_called()
+
+    def test_multipart_items(self):
+        """Test the multipart form with one face_image_<index> file per item"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post(reverse('verify_batch'), data={
+            'items': json.dumps([{'username': 'alice', 'password': 'pw'}, {'username': 'bob', 'password': 'pw'}]),
+            'face_image_0': SimpleUploadedFile('0.jpg', self.images['alice'], content_type='image/jpeg'),
+            'face_image_1': SimpleUploadedFile('1.jpg', self.images['bob'], content_type='image/jpeg'),
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['verified'], 2)
+
+    def test_limits(self):
+        """Test the item count limit and per-item image limits"""
+        with self.settings(VERIFY_BATCH_MAX_ITEMS=2):
+            self.assertEqual(self.post([self.item('alice')] * 3).status_code, 413)
+        self.assertEqual(self.post([]).status_code, 400)
+
+        with self.settings(MAX_FACE_IMAGE_BYTES=8):
+            response = self.post([self.item('alice')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['status'], 413)
+
+        # A body sent without Content-Length (chunked upload) is bounded while it is read
+        from django.test import RequestFactory
+        from .payloads import PayloadError, parse_batch_request
+        body = json.dumps({'items': [self.item('alice')] * 4})
+        request = RequestFactory().post(reverse('verify_batch'), data=body, content_type='application/json')
+        del request.META['CONTENT_LENGTH']
+        with self.settings(VERIFY_BATCH_MAX_BYTES=len(body) - 1), self.assertRaises(PayloadError) as raised:
+            parse_batch_request(request)
+        self.assertEqual(raised.exception.status, 413)
+
+    def test_admission_per_item(self):
+        """Test that a batch takes one rate token per item and one encode slot per busy worker"""
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from . import admission
+        from .admission import reset_admission
+
+        with self.settings(ADMISSION_CLIENT_RATE=0.01, ADMISSION_CLIENT_BURST=3):
+            reset_admission()
+            self.assertEqual(self.post([self.item('alice'), self.item('bob')]).status_code, 200)
+            self.assertEqual(self.post([self.item('alice'), self.item('bob')]).status_code, 429)
+        reset_admission()
+
+        with ThreadPoolExecutor(2) as pool, self.settings(FACE_ENCODE_WORKERS=4), \
+                mock.patch('authentication.views.get_encode_executor', return_value=pool), \
+                mock.patch('authentication.views.admission.slot', wraps=admission.slot) as slot:
+            response = self.post([self.item('alice'), self.item('bob'), self.item('ghost')])
+        self.assertEqual(response.json()['verified'], 2)
+        slot.assert_called_once_with('encode', 2)
+
+    def test_web3_ledger_batches_reads(self):
+        """Test that the web3 ledger fetches records in chunks of getUserHashes calls"""
+        from unittest import mock
+        from .ledger import Web3Ledger
+
+        def get_user_hashes(chunk):
+            call = mock.Mock()
+            call.call.return_value = (
+                [name != 'ghost' for name in chunk], [f'p-{name}' for name in chunk], [f'f-{name}' for name in chunk]
+            )
+            return call
+
+        chain = mock.Mock()
+        chain.contract.functions.getUserHashes.side_effect = get_user_hashes
+        ledger = Web3Ledger(chain)
+        ledger.hashes_per_call = 2
+        found = ledger.get_user_hashes(['a', 'b', 'ghost', 'a', 'c'])
+        self.assertEqual(found, {'a': ('p-a', 'f-a'), 'b': ('p-b', 'f-b'), 'c': ('p-c', 'f-c')})
+        self.assertEqual(chain.contract.functions.getUserHashes.call_count, 2)
+
+
+class MemoryReportTestCase(TestCase):
+    """Test cases for the /proc based memory report"""
+
+    def test_parse_smaps_rollup(self):
+        """Test that kB figures are converted and shared/private totals derived"""
+        from .memory import parse_smaps_rollup
+
+        usage = parse_smaps_rollup(
+            "55d0-7ffd ---p 00000000 00:00 0  [rollup]\n"
+            "Rss:              204800 kB\nPss:               51200 kB\n"
+            "Shared_Clean:     153600 kB\nShared_Dirty:       1024 kB\n"
+            "Private_Clean:      2048 kB\nPrivate_Dirty:     49152 kB\n"
+        )
+        self.assertEqual(usage['rss'], 200 * 1024 * 1024)
+        self.assertEqual(usage['shared'], 154624 * 1024)
+        self.assertEqual(usage['private'], 50 * 1024 * 1024)
+        self.assertEqual(usage['swap'], 0)
+
+    def test_report_process_tree(self):
+        """Test that --master lists the process and its descendants"""
+        import io
+        import os
+        from unittest import SkipTest
+        from django.core.management import call_command
+        from .memory import process_tree
+
+        if not os.path.exists(f'/proc/{os.getpid()}/smaps_rollup'):
+            raise SkipTest('needs Linux /proc/<pid>/smaps_rollup')
+        self.assertIn(os.getpid(), process_tree(os.getppid()))
+        out = io.StringIO()
+        call_command('memory_report', '--master', str(os.getpid()), stdout=out)
+        self.assertIn(str(os.getpid()), out.getvalue())
+        self.assertIn('Total RSS', out.getvalue())
+
+
+class AuditLogTestCase(TransactionTestCase):
+    """Test cases for the batched, month-partitioned audit log"""
+
+    def setUp(self):
+        from .admission import reset_admission
+        from .audit import reset_audit
+        from .ledger import reset_ledger
+        reset_admission()
+        reset_audit()
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub', ADMISSION_CLIENT_RATE=0)
+        self.override.enable()
+
+    def tearDown(self):
+        from .audit import drop_partition, partitions, reset_audit
+        from .ledger import reset_ledger
+        self.override.disable()
+        for month in partitions():
+            drop_partition(month)
+        reset_audit()
+        reset_ledger()
+
+    def post(self, name, username, password, image):
+        return self.client.post(reverse(name), data=image, content_type='image/jpeg',
+                                HTTP_X_USERNAME=username, HTTP_X_PASSWORD=password)
+
+    def test_attempts_are_recorded(self):
+        """Test that register/verify outcomes, distance and timings reach the log"""
+        from .audit import get_writer, partition_model, month_of, recent_failures
+        from django.utils import timezone
+
+        image = b"\xff\xd8\xff\xe0alice-face"
+        self.post('register', 'alice', 'pw', image)
+        self.post('verify', 'alice', 'wrong', image)
+        token = self.post('verify', 'alice', 'pw', image).json()['session_token']
+        self.assertEqual(get_writer().pending, 3)
+        get_writer().flush()
+
+        events = partition_model(month_of(timezone.now())).objects.order_by('id')
+        self.assertEqual([(e.endpoint, e.status) for e in events], [('register', 200), ('verify', 401), ('verify', 200)])
+        self.assertEqual(events[2].distance, 0.0)
+        self.assertIn('total', events[2].timings)
+        self.assertEqual(events[2].client_ip, '127.0.0.1')
+
+        failures = recent_failures('alice')
+        self.assertEqual([(f['status'], f['error']) for f in failures], [(401, 'Invalid password')])
+        response = self.client.get(reverse('audit_failures'), HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.json()['failures'][0]['status'], 401)
+
+    def test_bounded_queue_drops(self):
+        """Test that a full queue drops events and counts them instead of blocking"""
+        from .audit import AuditWriter
+        from .metrics import AUDIT_DROPPED
+
+        writer = AuditWriter(max_queue=2, batch_size=10, flush_interval=1)
+        before = AUDIT_DROPPED.value(reason='queue_full')
+        self.assertEqual([writer.put({}) for _ in range(3)], [True, True, False])
+        self.assertEqual(AUDIT_DROPPED.value(reason='queue_full'), before + 1)
+
+    def test_monthly_partitions(self):
+        """Test that events land in their month's table and old months are dropped whole"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from .audit import month_of, partitions, purge_months, write_events
+
+        now = timezone.now()
+        old = now - timedelta(days=400)
+        write_events([
+            {'created_at': when, 'endpoint': 'verify', 'username': 'bob', 'success': False, 'status': 401}
+            for when in (now, old, old)
+        ])
+        self.assertEqual(partitions(), sorted([month_of(old), month_of(now)]))
+        self.assertEqual(purge_months(12), [month_of(old)])
+        self.assertEqual(partitions(), [month_of(now)])
+
+
+class ProfilingTestCase(TestCase):
+    """Test cases for on-demand request profiling"""
+
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        from django.contrib.auth.models import User
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        reset_admission()
+        reset_ledger()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub', ADMISSION_CLIENT_RATE=0,
+                                      AUDIT_LOG_ENABLED=False, PROFILE_DIR=self.tmp.name, PROFILE_MAX_TRACES=2)
+        self.override.enable()
+        self.recheck = mock.patch('authentication.profiling.SAMPLING_CHECK_INTERVAL', 0)
+        self.recheck.start()
+        self.staff = User.objects.create_user('ops', password='ops-pw', is_staff=True)
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.recheck.stop()
+        self.override.disable()
+        self.tmp.cleanup()
+        reset_ledger()
+
+    def register(self, username, **headers):
+        return self.client.post(reverse('register'), data=b"\xff\xd8\xff\xe0" + username.encode(),
+                                content_type='image/jpeg', HTTP_X_USERNAME=username, HTTP_X_PASSWORD='pw', **headers)
+
+    def test_signed_header_profiles_request(self):
+        """Test that only a validly signed X-Profile header profiles a request"""
+        from .profiling import issue_profile_token
+
+        self.assertNotIn('X-Profile-Trace', self.register('alice'))
+        self.assertNotIn('X-Profile-Trace', self.register('bob', HTTP_X_PROFILE='forged'))
+        response = self.register('carol', HTTP_X_PROFILE=issue_profile_token())
+        self.assertEqual(response.status_code, 200)
+        name = response['X-Profile-Trace']
+
+        self.assertEqual(self.client.get(reverse('profiling_traces')).status_code, 302)  # admin login
+        self.client.force_login(self.staff)
+        traces = self.client.get(reverse('profiling_traces')).json()['traces']
+        self.assertEqual([(t['name'], t['path'], t['status'], t['trigger']) for t in traces],
+                         [(name, '/api/register/', 200, 'header')])
+
+        download = self.client.get(reverse('profiling_trace', args=[name]))
+        self.assertEqual(download.status_code, 200)
+        self.assertGreater(len(b''.join(download.streaming_content)), 0)
+        text = self.client.get(reverse('profiling_trace', args=[name]), {'format': 'text'}).content.decode()
+        self.assertIn('register', text)
+        self.assertEqual(self.client.get(reverse('profiling_trace', args=['..settings.json'])).status_code, 404)
+
+    def test_sampling_and_ring(self):
+        """Test that the sampling toggle applies and only the newest traces are kept"""
+        self.client.force_login(self.staff)
+        response = self.client.post(reverse('profiling_sampling'), data=json.dumps({'rate': 1}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['sampling']['rate'], 1)
+        names = [self.register(f'user{i}')['X-Profile-Trace'] for i in range(3)]
+        traces = self.client.get(reverse('profiling_traces')).json()['traces']
+        self.assertEqual([t['name'] for t in traces], names[:0:-1])
+        self.assertEqual(traces[0]['trigger'], 'sample')
+
+        self.client.post(reverse('profiling_sampling'), data=json.dumps({'rate': 0}), content_type='application/json')
+        self.assertNotIn('X-Profile-Trace', self.register('dave'))
+        response = self.client.post(reverse('profiling_sampling'), data=json.dumps({'rate': 2}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class MerkleRegistrationTestCase(TestCase):
+    """Test cases for Merkle-anchored batch registration"""
+
+    def setUp(self):
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        reset_admission()
+        reset_ledger()
+        self.override = self.settings(LEDGER_BACKEND='memory', REGISTRATION_MODE='merkle', FACE_ENCODER='stub',
+                                      ADMISSION_CLIENT_RATE=0, VERIFY_OVERLAP_ENCODE=False)
+        self.override.enable()
+        self.image = b"\xff\xd8\xff\xe0alice-face"
+
+    def tearDown(self):
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+
+    def post(self, name, username, password):
+        return self.client.post(reverse(name), data=self.image, content_type='image/jpeg',
+                                HTTP_X_USERNAME=username, HTTP_X_PASSWORD=password)
+
+    def test_proofs(self):
+        """Test that every leaf's proof leads to the root and altered leaves do not"""
+        from .merkle import build_levels, leaf_hash, merkle_proof, verify_proof
+
+        for count in (1, 2, 3, 7, 8, 13):
+            leaves = [leaf_hash(f'user{i}', 'p' * 64, 'f' * 64) for i in range(count)]
+            levels = build_levels(leaves)
+            root = levels[-1][0]
+            for index, leaf in enumerate(leaves):
+                self.assertTrue(verify_proof(leaf, merkle_proof(levels, index), root))
+            forged = leaf_hash('user0', 'x' * 64, 'f' * 64)
+            self.assertFalse(verify_proof(forged, merkle_proof(levels, 0), root))
+
+    def test_register_anchor_verify(self):
+        """Test that batch-registered users log in once their epoch is anchored"""
+        from io import StringIO
+        from django.core.management import call_command
+        from .ledger import get_ledger
+        from .models import MerkleEpoch, MerkleRegistration
+
+        ledger = get_ledger()
+        for username in ('alice', 'bob', 'carol'):
+            self.assertEqual(self.post('register', username, 'pw').status_code, 200)
+        self.assertEqual(self.post('register', 'alice', 'pw').status_code, 400)
+        self.assertFalse(ledger.base.is_registered('alice'))  # no transaction per user
+        response = self.post('verify', 'alice', 'pw')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('anchoring epoch', response.json()['error'])
+
+        out = StringIO()
+        call_command('anchor_registrations', stdout=out)
+        self.assertIn('Anchored 3 registrations as epoch 0', out.getvalue())
+        self.assertEqual(MerkleEpoch.objects.get().root, ledger.base.get_anchored_root(0))
+        self.assertEqual(len(MerkleRegistration.objects.get(username='carol').proof), 1)
+
+        self.assertEqual(self.post('verify', 'alice', 'pw').status_code, 200)
+        self.assertEqual(self.post('verify', 'bob', 'wrong').status_code, 401)
+        with mock.patch('authentication.async_views.get_encode_executor', return_value=None):
+            self.assertEqual(self.post('verify_async', 'carol', 'pw').status_code, 200)
+        self.assertEqual(set(ledger.get_user_hashes(['alice', 'dave'])), {'alice'})
+
+        # A local record altered after anchoring no longer matches the root
+        MerkleRegistration.objects.filter(username='bob').update(password_hash=hashlib.sha256(b'evil').hexdigest())
+        self.assertEqual(self.post('verify', 'bob', 'evil').status_code, 500)
+
+        # Direct registrations keep working, and count with the batch ones
+        ledger.base.register_user('dave', hashlib.sha256(b'pw').hexdigest(), 'f' * 64)
+        self.assertEqual(ledger.user_count(), 4)
+        self.assertEqual(ledger.get_users(0, 10), ['dave', 'alice', 'bob', 'carol'])
+        call_command('anchor_registrations', stdout=out)
+        self.assertIn('No pending registrations', out.getvalue())
+
+    def test_batch_verify_reports_each_user(self):
+        """Test that a pending or tampered user fails only their own batch item, with single verify's status"""
+        from .merkle import anchor_pending
+        from .models import MerkleRegistration
+
+        for username in ('alice', 'bob'):
+            self.assertEqual(self.post('register', username, 'pw').status_code, 200)
+        anchor_pending()
+        self.assertEqual(self.post('register', 'carol', 'pw').status_code, 200)
+        MerkleRegistration.objects.filter(username='bob').update(password_hash=hashlib.sha256(b'evil').hexdigest())
+
+        face_image = base64.b64encode(self.image).decode('ascii')
+        items = [{'username': username, 'password': password, 'face_image': face_image}
+                 for username, password in (('alice', 'pw'), ('bob', 'evil'), ('carol', 'pw'), ('dave', 'pw'))]
+        response = self.client.post(reverse('verify_batch') + '?encoding=omit',
+                                    data=json.dumps({'items': items}), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], [200, 500, 403, 404])
+        self.assertEqual(self.post('verify', 'carol', 'pw').status_code, 403)
+        self.assertIn('anchoring epoch', results[2]['error'])
+
+    def test_anchoring_claims_pending(self):
+        """Test that a run skips claimed records, and a failed or stale claim is taken over"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from .ledger import LedgerError, get_ledger
+        from .merkle import anchor_pending, claim_pending
+        from .models import MerkleEpoch, MerkleRegistration
+
+        ledger = get_ledger()
+        for username in ('alice', 'bob'):
+            self.assertEqual(self.post('register', username, 'pw').status_code, 200)
+
+        # A concurrent run holds the claim: nothing is left to anchor
+        token, claimed = claim_pending()
+        self.assertEqual([r.username for r in claimed], ['alice', 'bob'])
+        self.assertEqual(claim_pending()[1], [])
+        with mock.patch.object(ledger.base, 'anchor_root') as anchor_root:
+            self.assertIsNone(anchor_pending(ledger))
+        anchor_root.assert_not_called()
+
+        # Its worker died: the claim is taken over once stale
+        MerkleRegistration.objects.filter(claim_token=token).update(claimed_at=timezone.now() - timedelta(hours=1))
+        with mock.patch.object(ledger.base, 'anchor_root', side_effect=LedgerError('node down')):
+            with self.assertRaises(LedgerError):
+                anchor_pending(ledger)
+        self.assertFalse(MerkleRegistration.objects.exclude(claim_token='').exists())  # released on failure
+
+        anchored = anchor_pending(ledger)
+        self.assertEqual((anchored.epoch, anchored.leaf_count), (0, 2))
+        self.assertEqual(MerkleEpoch.objects.count(), 1)
+        self.assertFalse(MerkleRegistration.objects.filter(epoch__isnull=True).exists())
+        self.assertIsNone(anchor_pending(ledger))
+
+
+class LoginPrefetchTestCase(TestCase):
+    """Test cases for /api/prepare/ and verify's use of the prefetched entry"""
+
+    class InlineExecutor:
+        def submit(self, fn, *args):
+            fn(*args)
+
+    def setUp(self):
+        from django.core.cache import cache
+        from .admission import reset_admission
+        from .ledger import reset_ledger
+        from .prefetch import reset_prefetch
+        reset_ledger()
+        reset_prefetch()
+        reset_admission()
+        cache.clear()
+        self.override = self.settings(LEDGER_BACKEND='memory', FACE_ENCODER='stub', ADMISSION_CLIENT_RATE=0)
+        self.override.enable()
+        patcher = mock.patch('authentication.prefetch.get_prefetch_executor', return_value=self.InlineExecutor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.image = b"\xff\xd8\xff\xe0alice-face"
+
+    def tearDown(self):
+        from django.core.cache import cache
+        from .ledger import reset_ledger
+        self.override.disable()
+        reset_ledger()
+        cache.clear()
+
+    def post(self, name, username, password, image):
+        return self.client.post(reverse(name), data=image, content_type='image/jpeg',
+                                HTTP_X_USERNAME=username, HTTP_X_PASSWORD=password)
+
+    def prepare(self, username):
+        return self.client.post(reverse('prepare'), data=json.dumps({'username': username}),
+                                content_type='application/json')
+
+    def test_prepare_does_not_reveal_users(self):
+        """Test that prepare answers alike for known and unknown users and rejects bad input"""
+        from .prefetch import lookup
+
+        self.post('register', 'alice', 'pw', self.image)
+        for username in ('alice', 'bob'):
+            response = self.prepare(username)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json(), {'success': True})
+        self.assertIsNotNone(lookup('alice'))
+        self.assertIsNone(lookup('bob'))  # unknown users are not cached
+        self.assertEqual(self.prepare('').status_code, 400)
+        self.assertEqual(self.client.post(reverse('prepare'), data='{', content_type='application/json').status_code, 400)
+
+    def test_verify_uses_the_prefetched_entry(self):
+        """Test that a prefetched verify reads neither the ledger nor the database"""
+        from .ledger import get_ledger
+        from .metrics import PREFETCH
+
+        self.post('register', 'alice', 'pw', self.image)
+        self.prepare('alice')
+        hits = PREFETCH.value(result='hit')
+        ledger = get_ledger()
+        with mock.patch.object(ledger, 'get_user_hash', side_effect=AssertionError('ledger read')), \
+                mock.patch.object(ledger, 'is_registered', side_effect=AssertionError('ledger read')):
+            with self.assertNumQueries(0):
+                self.assertEqual(self.post('verify', 'alice', 'pw', self.image).status_code, 200)
+            self.assertEqual(self.post('verify', 'alice', 'wrong', self.image).status_code, 401)
+            self.assertEqual(self.post('verify', 'alice', 'pw', b"\xff\xd8other-face").status_code, 401)
+            self.assertEqual(self.post('verify_async', 'alice', 'pw', self.image).status_code, 200)
+        self.assertEqual(PREFETCH.value(result='hit'), hits + 4)
+
+    def test_changed_encoding_drops_the_entry(self):
+        """Test that saving or deleting a stored encoding invalidates the prefetched entry"""
+        from .models import UserFaceEncoding
+        from .prefetch import lookup
+
+        self.post('register', 'alice', 'pw', self.image)
+        self.prepare('alice')
+        stored = UserFaceEncoding.objects.get(username='alice')
+        stored.save()
+        self.assertIsNone(lookup('alice'))
+
+        self.prepare('alice')
+        UserFaceEncoding.objects.filter(username='alice').delete()
+        self.assertIsNone(lookup('alice'))
+
+    def test_prefetch_queueing(self):
+        """Test that prefetches are skipped when warm, pending, over the limit or disabled"""
+        from . import prefetch
+
+        self.post('register', 'alice', 'pw', self.image)
+        self.assertEqual(prefetch.start_prefetch('alice'), 'queued')
+        self.assertEqual(prefetch.start_prefetch('alice'), 'cached')
+        with mock.patch('authentication.prefetch.get_prefetch_executor', return_value=mock.Mock()):
+            self.assertEqual(prefetch.start_prefetch('bob'), 'queued')
+            self.assertEqual(prefetch.start_prefetch('bob'), 'pending')
+            with self.settings(PREFETCH_MAX_PENDING=1):
+                self.assertEqual(prefetch.start_prefetch('carol'), 'dropped')
+        with self.settings(PREFETCH_TTL=0):
+            self.assertEqual(prefetch.start_prefetch('alice'), 'disabled')
+            self.assertIsNone(prefetch.lookup('alice'))
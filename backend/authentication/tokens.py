@@ -0,0 +1,131 @@
+"""
+Stateless signed session tokens issued by verify.
+
+A token is ``django.core.signing.dumps({'u': username, 'a': auth_time})``:
+an HMAC-SHA256 (keyed by SECRET_KEY) over the payload and a timestamp. It
+is checked without a database or chain lookup, so authorizing a follow-up
+request costs microseconds instead of a face encode plus ledger RPCs.
+
+    SESSION_TOKEN_TTL       seconds a token is valid after it is issued
+    SESSION_MAX_AGE         seconds after the face verification (auth_time)
+                            after which refresh stops issuing tokens
+
+Clients send tokens as ``Authorization: Bearer <token>``. Tokens cannot be
+revoked individually; rotating SECRET_KEY invalidates all of them.
+"""
+import asyncio
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core import signing
+from django.http import JsonResponse
+
+SALT = 'faceauth.session'
+
+
+class TokenError(Exception):
+    """Missing, invalid or expired session token; carries the HTTP status to return"""
+
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.status = status
+
+
+def issue_token(username, auth_time=None):
+    """
+    Sign a session token for `username`
+
+    Args:
+        username: verified user
+        auth_time: when the face was verified (default: now); kept across refreshes
+
+    Returns:
+        dict: {'session_token', 'expires_in'} for the response body
+    """
+    payload = {'u': username, 'a': int(auth_time if auth_time is not None else time.time())}
+    return {
+        'session_token': signing.dumps(payload, salt=SALT, compress=False),
+        'expires_in': settings.SESSION_TOKEN_TTL,
+    }
+
+
+def read_token(token):
+    """
+    Validate a session token
+
+    Returns:
+        dict: payload with 'u' (username) and 'a' (auth time)
+
+    Raises:
+        TokenError: bad signature or expired
+    """
+    try:
+        payload = signing.loads(token, salt=SALT, max_age=settings.SESSION_TOKEN_TTL)
+    except signing.SignatureExpired:
+        raise TokenError('Session token expired')
+    except signing.BadSignature:
+        raise TokenError('Invalid session token')
+    if not isinstance(payload, dict) or 'u' not in payload or 'a' not in payload:
+        raise TokenError('Invalid session token')
+    return payload
+
+
+def bearer_token(request):
+    """Token from the Authorization header"""
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        raise TokenError('Missing session token')
+    return token.strip()
+
+
+def refresh_token(token):
+    """
+    Exchange a valid token for a new one with a fresh TTL
+
+    The original auth_time is kept, so a session cannot be extended past
+    SESSION_MAX_AGE without verifying the face again.
+    """
+    payload = read_token(token)
+    if time.time() - payload['a'] > settings.SESSION_MAX_AGE:
+        raise TokenError('Session expired, please verify again')
+    return issue_token(payload['u'], auth_time=payload['a'])
+
+
+def _unauthorized(error):
+    response = JsonResponse({'error': str(error)}, status=error.status)
+    response['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
+def require_session_token(view_func):
+    """
+    Decorator for sync or async views that need a verified user.
+
+    Sets ``request.session_username`` and ``request.session_auth_time`` from
+    the bearer token, or returns 401 without calling the view.
+    """
+    def authenticate(request):
+        payload = read_token(bearer_token(request))
+        request.session_username = payload['u']
+        request.session_auth_time = payload['a']
+
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            try:
+                authenticate(request)
+            except TokenError as e:
+                return _unauthorized(e)
+            return await view_func(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        try:
+            authenticate(request)
+        except TokenError as e:
+            return _unauthorized(e)
+        return view_func(request, *args, **kwargs)
+    return wrapper
@@ -1,8 +1,19 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path('register/', views.register, name='register'),
     path('verify/', views.verify, name='verify'),
+    path('verify/batch/', views.verify_batch, name='verify_batch'),
+    path('prepare/', views.prepare, name='prepare'),
+    path('async/register/', async_views.register, name='register_async'),
+    path('async/verify/', async_views.verify, name='verify_async'),
+    path('token/refresh/', views.token_refresh, name='token_refresh'),
+    path('session/', views.session, name='session'),
+    path('audit/failures/', views.audit_failures, name='audit_failures'),
+    path('config/', views.client_config, name='client_config'),
+    path('profiling/', views.profiling_traces, name='profiling_traces'),
+    path('profiling/sampling/', views.profiling_sampling, name='profiling_sampling'),
+    path('profiling/traces/<str:name>', views.profiling_trace, name='profiling_trace'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
-
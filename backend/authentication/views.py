@@ -1,156 +1,122 @@
+import io
 import json
 import hashlib
-import base64
-from django.http import JsonResponse
+import logging
+import pstats
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from web3 import Web3
 import sys
 import os
 
 # Add the face_module to the Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
-from face_module.face_utils import encode_face, hash_face_encoding, verify_face, compare_faces
+from face_module.face_utils import (
+    get_encoder, verify_face, get_face_distance, encode_faces_batch,
+)
+from face_module.face_keys import face_key
 from .models import UserFaceEncoding
+from .blockchain import get_chain
+from .ledger import LedgerError, get_ledger
+from .payloads import (
+    PayloadError, encoding_payload, get_encoding_mode, get_face_hint, parse_batch_request,
+    parse_face_request,
+)
+from . import admission, audit, face_index, prefetch, profiling
+from .async_views import get_encode_executor, start_encode
+from .admission import AdmissionError, admission_response, check_client_rate
+from .audit import audited, recent_failures
+from .idempotency import idempotent
+from .metrics import observe_stages, registry, stage, track_request
+from .tokens import TokenError, bearer_token, issue_token, refresh_token, require_session_token
 
-# Initialize Web3 connection to Ganache
-w3 = Web3(Web3.HTTPProvider('http://127.0.0.1:7545'))
-
-# Check Web3 connection
-try:
-    if w3.is_connected():
-        print("✅ Connected to Ganache blockchain")
-    else:
-        print("❌ Not connected to Ganache. Make sure Ganache is running on port 7545")
-except Exception as e:
-    print(f"❌ Error connecting to Ganache: {e}")
-
-# Contract ABI and address (will be set after deployment)
-CONTRACT_ABI = [
-    {
-        "inputs": [
-            {"internalType": "string", "name": "username", "type": "string"},
-            {"internalType": "string", "name": "passwordHash", "type": "string"},
-            {"internalType": "string", "name": "faceHash", "type": "string"}
-        ],
-        "name": "registerUser",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function"
-    },
-    {
-        "inputs": [{"internalType": "string", "name": "username", "type": "string"}],
-        "name": "getUserHash",
-        "outputs": [
-            {"internalType": "string", "name": "passwordHash", "type": "string"},
-            {"internalType": "string", "name": "faceHash", "type": "string"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [{"internalType": "string", "name": "username", "type": "string"}],
-        "name": "isRegistered",
-        "outputs": [{"internalType": "bool", "name": "", "type": "bool"}],
-        "stateMutability": "view",
-        "type": "function"
-    }
-]
-
-# Contract address (to be set after deployment)
-CONTRACT_ADDRESS = "0xe78A0F7E598Cc8b0Bb87894B0F60dD2a88d6a8Ab"
-contract = None
-
-def verify_contract_deployed(address):
+logger = logging.getLogger(__name__)
+
+
+def verify_contract_deployed(address=None):
     """Verify that a contract is actually deployed at the given address"""
-    try:
-        if not w3.is_connected():
-            return False, "Not connected to blockchain"
-        
-        # Check if address is valid
-        if not w3.is_address(address):
-            return False, "Invalid address format"
-        
-        # Check if contract has code (is deployed)
-        code = w3.eth.get_code(address)
-        if code == b'':
-            return False, "No contract code found at this address"
-        
-        return True, "Contract verified"
-    except Exception as e:
-        return False, f"Error verifying contract: {str(e)}"
+    return get_chain().verify_contract_deployed(address)
 
-# Initialize contract if address is set
-if CONTRACT_ADDRESS:
-    try:
-        # Verify contract is deployed
-        is_deployed, message = verify_contract_deployed(CONTRACT_ADDRESS)
-        if is_deployed:
-            contract = w3.eth.contract(address=CONTRACT_ADDRESS, abi=CONTRACT_ABI)
-            print(f"✅ Contract initialized and verified at address: {CONTRACT_ADDRESS}")
-        else:
-            print(f"❌ Contract not deployed: {message}")
-            print(f"   Address: {CONTRACT_ADDRESS}")
-            print(f"   Please deploy the contract using: cd blockchain && npx truffle migrate")
-    except Exception as e:
-        print(f"❌ Warning: Could not initialize contract: {e}")
 
 def set_contract_address(address):
     """Set the contract address after deployment"""
-    global CONTRACT_ADDRESS, contract
-    CONTRACT_ADDRESS = address
-    if CONTRACT_ADDRESS:
-        contract = w3.eth.contract(address=CONTRACT_ADDRESS, abi=CONTRACT_ABI)
+    get_chain().set_contract_address(address)
+
+
+def __getattr__(name):
+    """Lazy access to the former module-level `w3`, `contract` and `CONTRACT_ADDRESS`"""
+    if name == 'w3':
+        return get_chain().w3
+    if name == 'contract':
+        return get_chain().contract
+    if name == 'CONTRACT_ADDRESS':
+        return get_chain().address
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _encode_or_error(face_image_bytes, face_hint=None):
+    """Encode the face image; returns (face_encoding, error_response)"""
+    logger.debug("Encoding face, image size: %d bytes", len(face_image_bytes))
+    try:
+        timings = {}
+        face_encoding = get_encoder(settings.FACE_ENCODER)(
+            face_image_bytes, timings=timings, profile=settings.FACE_ENCODING_PROFILE,
+            face_hint=face_hint
+        )
+        observe_stages(timings)
+    except Exception as e:
+        logger.exception("Face encoding error: %s", e)
+        return None, JsonResponse({'error': f'Face encoding failed: {str(e)}'}, status=500)
+
+    if face_encoding is None:
+        logger.info("No face detected")
+        return None, JsonResponse({'error': 'No face detected in image. Please ensure your face is clearly visible.'}, status=400)
+    return face_encoding, None
+
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@track_request('register')
+@audited('register')
+@idempotent('register')
 def register(request):
     """
     Register a new user with username, password, and face image
     """
     try:
-        # Parse request data
+        # Parse request data (JSON, multipart or raw image body)
         try:
-            data = json.loads(request.body)
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {e}")
-            return JsonResponse({'error': f'Invalid JSON: {str(e)}'}, status=400)
+            data, face_image_bytes = parse_face_request(request)
+            face_hint = get_face_hint(request, data)
+        except PayloadError as e:
+            logger.info("Request parse error: %s", e)
+            return JsonResponse({'error': str(e)}, status=e.status)
         
         username = data.get('username')
         password = data.get('password')
-        face_image_data = data.get('face_image')  # Base64 encoded image
+        audit.annotate(username=username)
         
-        print(f"📝 Registration attempt for user: {username}")
+        logger.info("Registration attempt for user: %s", username)
         
-        if not all([username, password, face_image_data]):
+        if not all([username, password, face_image_bytes]):
             return JsonResponse({'error': 'Missing required fields'}, status=400)
         
-        # Check Web3 connection
-        if not w3.is_connected():
-            print("❌ Web3 not connected")
-            return JsonResponse({'error': 'Blockchain not connected. Is Ganache running?'}, status=500)
-        
-        # Check contract initialization
-        if not contract:
-            print("❌ Contract not initialized")
-            return JsonResponse({
-                'error': 'Contract not deployed. Please deploy the contract first using: cd blockchain && npx truffle migrate'
-            }, status=500)
+        check_client_rate(request)
         
-        # Verify contract is still deployed
-        is_deployed, message = verify_contract_deployed(CONTRACT_ADDRESS)
-        if not is_deployed:
-            print(f"❌ Contract verification failed: {message}")
-            return JsonResponse({
-                'error': f'Contract not found at address {CONTRACT_ADDRESS}. Please deploy the contract first.'
-            }, status=500)
+        # Check the ledger (blockchain connection and contract deployment)
+        ledger = get_ledger()
+        try:
+            ledger.check_ready()
+        except LedgerError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
         
         # Check if user already exists
         try:
-            if contract.functions.isRegistered(username).call():
+            if ledger.is_registered(username):
                 return JsonResponse({'error': 'User already exists'}, status=400)
         except Exception as e:
-            print(f"❌ Error checking user existence: {e}")
+            logger.error("Error checking user existence: %s", e)
             error_msg = str(e)
             if "contract" in error_msg.lower() and "deployed" in error_msg.lower():
                 return JsonResponse({
@@ -160,201 +126,71 @@ def register(request):
         
         # Hash password
         password_hash = hashlib.sha256(password.encode()).hexdigest()
-        print(f"✅ Password hashed")
-        
-        # Process face image
-        try:
-            face_image_bytes = base64.b64decode(face_image_data)
-            print(f"✅ Face image decoded, size: {len(face_image_bytes)} bytes")
-        except Exception as e:
-            print(f"❌ Base64 decode error: {e}")
-            return JsonResponse({'error': f'Invalid image data: {str(e)}'}, status=400)
         
         # Encode face and get hash
-        print("🔍 Encoding face...")
-        try:
-            face_encoding = encode_face(face_image_bytes)
-            if face_encoding is None:
-                print("❌ No face detected")
-                return JsonResponse({'error': 'No face detected in image. Please ensure your face is clearly visible.'}, status=400)
-            print(f"✅ Face encoded, shape: {face_encoding.shape}")
-        except Exception as e:
-            print(f"❌ Face encoding error: {e}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'error': f'Face encoding failed: {str(e)}'}, status=500)
+        with admission.slot(admission.ENCODE):
+            face_encoding, error = _encode_or_error(face_image_bytes, face_hint)
+        if error:
+            return error
         
-        face_hash = hash_face_encoding(face_encoding)
+        # Locality-sensitive face key: matches other captures of the same face
+        face_hash = face_key(face_encoding, settings.FACE_KEY_SEED)
         if not face_hash:
             return JsonResponse({'error': 'Face hashing failed'}, status=500)
-        print(f"✅ Face hashed: {face_hash[:16]}...")
         
         # Validate all inputs before sending to blockchain
         if not username or len(username.strip()) == 0:
             return JsonResponse({'error': 'Username cannot be empty'}, status=400)
         if not password_hash or len(password_hash) != 64:  # SHA-256 hex is 64 chars
             return JsonResponse({'error': 'Invalid password hash'}, status=400)
-        if not face_hash or len(face_hash) != 64:  # SHA-256 hex is 64 chars
+        if not face_hash or len(face_hash) != 64:  # 256-bit key, 64 hex chars like SHA-256
             return JsonResponse({'error': 'Invalid face hash'}, status=400)
         
-        print(f"📋 Registration data:")
-        print(f"   Username: '{username}' (length: {len(username)})")
-        print(f"   Password hash: {password_hash[:16]}... (length: {len(password_hash)})")
-        print(f"   Face hash: {face_hash[:16]}... (length: {len(face_hash)})")
+        # One account per face: bucket lookup, exact distance on the candidates
+        if settings.REGISTER_REJECT_DUPLICATE_FACES:
+            with stage('face_index'):
+                matches = face_index.find_matches(face_encoding, exclude=username)
+            if matches:
+                logger.info("Registration of %r refused: face matches %d existing user(s)", username, len(matches))
+                return JsonResponse({'error': 'This face is already registered to another account'}, status=409)
+        
+        logger.debug("Registration data: username=%r password_hash=%s... face_hash=%s...",
+                     username, password_hash[:16], face_hash[:16])
         
         # Register on blockchain FIRST (before storing locally)
         try:
-            # Get account for transaction
-            accounts = w3.eth.accounts
-            if not accounts:
-                return JsonResponse({'error': 'No accounts available'}, status=500)
-            
-            account = accounts[0]
-            print(f"📤 Registering on blockchain with account: {account}")
-            
-            # Check account balance
-            balance = w3.eth.get_balance(account)
-            print(f"💰 Account balance: {w3.from_wei(balance, 'ether')} ETH")
-            
-            if balance == 0:
-                return JsonResponse({'error': 'Account has no balance. Check Ganache accounts.'}, status=500)
-            
-            # Estimate gas first
-            try:
-                gas_estimate = contract.functions.registerUser(
-                    username.strip(), 
-                    password_hash, 
-                    face_hash
-                ).estimate_gas({'from': account})
-                print(f"⛽ Estimated gas: {gas_estimate}")
-                gas_limit = int(gas_estimate * 1.2)  # Add 20% buffer
-            except Exception as e:
-                print(f"⚠️ Gas estimation failed: {e}")
-                gas_limit = 300000  # Use default if estimation fails
-            
-            # Build transaction with validated inputs
-            tx = contract.functions.registerUser(
-                username.strip(),  # Ensure no leading/trailing spaces
-                password_hash,
-                face_hash
-            ).build_transaction({
-                'from': account,
-                'gas': gas_limit,
-                'gasPrice': w3.eth.gas_price,
-                'nonce': w3.eth.get_transaction_count(account)
-            })
-            
-            print(f"📝 Transaction details:")
-            print(f"   Gas limit: {gas_limit}")
-            print(f"   Gas price: {w3.eth.gas_price}")
-            print(f"   Nonce: {tx['nonce']}")
-            
-            # Send transaction
-            tx_hash = w3.eth.send_transaction(tx)
-            print(f"⏳ Waiting for transaction: {tx_hash.hex()}")
-            
-            receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-            
-            # Check transaction status (1 = success, 0 = failed)
-            if receipt.status != 1:
-                print(f"❌ Transaction failed with status: {receipt.status}")
-                print(f"   Transaction hash: {tx_hash.hex()}")
-                print(f"   Gas used: {receipt.gasUsed}")
-                print(f"   Block number: {receipt.blockNumber}")
-                
-                # Try to get revert reason using trace
-                try:
-                    # Try to call the function directly to see the error
-                    print("🔍 Attempting to call function directly to see error...")
-                    contract.functions.registerUser(username.strip(), password_hash, face_hash).call({'from': account})
-                except Exception as call_error:
-                    print(f"❌ Direct call error (this is the revert reason): {call_error}")
-                    error_msg = str(call_error)
-                    if "User already exists" in error_msg:
-                        return JsonResponse({'error': 'User already exists on blockchain'}, status=400)
-                    elif "cannot be empty" in error_msg:
-                        return JsonResponse({'error': f'Validation error: {error_msg}'}, status=400)
-                    else:
-                        return JsonResponse({
-                            'error': f'Transaction reverted: {error_msg}. Check Ganache logs for more details.'
-                        }, status=500)
-                
-                return JsonResponse({
-                    'error': f'Transaction failed on blockchain. Status: {receipt.status}. Check Ganache console for revert reason.'
-                }, status=500)
-            
-            print(f"✅ Transaction confirmed with status: {receipt.status}")
-            
-            # Check transaction logs for events
-            if receipt.logs:
-                print(f"✅ Transaction emitted {len(receipt.logs)} events")
-            else:
-                print(f"⚠️ No events emitted (might be normal)")
-            
-            # Small delay to ensure state is updated
-            import time
-            time.sleep(0.5)
-            
-            # Verify user is now registered on blockchain
-            try:
-                is_registered = contract.functions.isRegistered(username).call()
-                print(f"🔍 Verification check: isRegistered('{username}') = {is_registered}")
-                
-                if not is_registered:
-                    # Try to get user data directly to see what's stored
-                    try:
-                        user_data = contract.functions.getUserHash(username).call()
-                        print(f"⚠️ User data exists: {user_data}")
-                    except Exception as e:
-                        print(f"❌ Cannot get user data: {e}")
-                    
-                    # Additional debugging - check if it's a timing issue
-                    print(f"⚠️ Waiting a bit longer and retrying...")
-                    time.sleep(1)
-                    is_registered_retry = contract.functions.isRegistered(username).call()
-                    print(f"🔍 Retry check: isRegistered('{username}') = {is_registered_retry}")
-                    
-                    print("❌ User registration failed - not found on blockchain after transaction")
-                    return JsonResponse({
-                        'error': 'Registration transaction succeeded but user not found. This might be a contract issue. Check Ganache logs.'
-                    }, status=500)
-                
-                print(f"✅ User verified on blockchain")
-            except Exception as e:
-                print(f"❌ Error verifying user: {e}")
-                import traceback
-                traceback.print_exc()
-                return JsonResponse({
-                    'error': f'Error verifying registration: {str(e)}'
-                }, status=500)
-            
+            with admission.slot(admission.CHAIN):
+                ledger.register_user(username.strip(), password_hash, face_hash)
+        except AdmissionError:
+            raise
         except Exception as e:
-            print(f"❌ Blockchain registration error: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Blockchain registration error: %s", e)
             # Clean up: remove local data if it exists (from previous failed attempt)
             try:
                 UserFaceEncoding.objects.filter(username=username).delete()
             except:
                 pass
+            if isinstance(e, LedgerError):
+                return JsonResponse({'error': str(e)}, status=e.status)
             return JsonResponse({'error': f'Blockchain registration failed: {str(e)}'}, status=500)
         
         # Store face encoding locally AFTER blockchain registration succeeds
         # (Face encodings vary slightly, so we can't use exact hash matching)
         try:
-            face_encoding_obj, created = UserFaceEncoding.objects.get_or_create(
-                username=username,
-                defaults={'face_encoding': json.dumps(face_encoding.tolist())}
-            )
-            if not created:
-                # Update existing encoding
-                face_encoding_obj.set_encoding(face_encoding)
-                face_encoding_obj.save()
-            print(f"✅ Face encoding stored locally for similarity comparison")
+            with stage('db_write'):
+                face_encoding_obj, created = UserFaceEncoding.objects.get_or_create(
+                    username=username,
+                    defaults={'face_encoding': json.dumps(face_encoding.tolist())}
+                )
+                if not created:
+                    # Update existing encoding
+                    face_encoding_obj.set_encoding(face_encoding)
+                    face_encoding_obj.save()
         except Exception as e:
-            print(f"⚠️ Warning: Could not store face encoding locally: {e}")
-            # Continue anyway - we'll use hash comparison as fallback
+            logger.warning("Could not store face encoding locally: %s", e)
+            # Continue anyway - verify falls back to the ledger face key
         
+        logger.info("User registered: %s", username)
         return JsonResponse({
             'success': True,
             'message': 'User registered successfully',
@@ -363,194 +199,486 @@ def register(request):
             'face_hash': face_hash
         })
             
+    except AdmissionError as e:
+        logger.info("Register shed by admission control: %s", e)
+        return admission_response(e)
     except Exception as e:
-        print(f"❌ Unexpected error in register: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Unexpected error in register: %s", e)
         return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
 
+def _login_or_error(ledger, username, password, prefetched=None):
+    """
+    Ledger checks of a login; returns ((password_hash, stored_face_hash), error_response)
+    
+    With a `prefetched` entry (see prefetch.py) the ledger is not read again.
+    """
+    if prefetched is not None:
+        password_hash = hashlib.sha256(password.encode()).hexdigest()
+        if password_hash != prefetched.password_hash:
+            return None, JsonResponse({'error': 'Invalid password'}, status=401)
+        return (password_hash, prefetched.face_hash), None
+    
+    # Check the ledger (blockchain connection and contract deployment)
+    try:
+        ledger.check_ready()
+    except LedgerError as e:
+        return None, JsonResponse({'error': str(e)}, status=e.status)
+    
+    # Check if user exists
+    try:
+        is_registered = ledger.is_registered(username)
+        
+        if not is_registered:
+            # Also check if user exists in local database (orphaned data from failed registration)
+            with stage('db_lookup'):
+                local_user = UserFaceEncoding.objects.filter(username=username).first()
+            if local_user:
+                # Registration didn't complete successfully; clean up orphaned data
+                logger.warning("User %r exists locally but not on blockchain, cleaning up", username)
+                try:
+                    local_user.delete()
+                except Exception as e:
+                    logger.warning("Could not clean up: %s", e)
+                return None, JsonResponse({
+                    'error': 'User registration was incomplete. Please register again to complete the process.'
+                }, status=404)
+            else:
+                logger.info("User not found: %s", username)
+                return None, JsonResponse({
+                    'error': f'User "{username}" not found. Please register first.'
+                }, status=404)
+    except Exception as e:
+        logger.exception("Error checking user existence: %s", e)
+        error_msg = str(e)
+        if "contract" in error_msg.lower() and "deployed" in error_msg.lower():
+            return None, JsonResponse({
+                'error': 'Contract not deployed correctly. Please run: cd blockchain && npx truffle migrate --reset'
+            }, status=500)
+        return None, JsonResponse({
+            'error': f'Error checking user: {error_msg}'
+        }, status=500)
+    
+    # Get stored data from blockchain
+    try:
+        stored_password_hash, stored_face_hash = ledger.get_user_hash(username)
+    except LedgerError as e:
+        return None, JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        logger.exception("Error getting user data from blockchain: %s", e)
+        return None, JsonResponse({'error': f'Error retrieving user data: {str(e)}'}, status=500)
+    
+    # Verify password
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    if password_hash != stored_password_hash:
+        return None, JsonResponse({'error': 'Invalid password'}, status=401)
+    return (password_hash, stored_face_hash), None
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@track_request('verify')
+@audited('verify')
+@idempotent('verify')
 def verify(request):
     """
     Verify user login with username, password, and face image
     """
     try:
-        data = json.loads(request.body)
+        try:
+            data, face_image_bytes = parse_face_request(request)
+            face_hint = get_face_hint(request, data)
+            encoding_mode = get_encoding_mode(request, data)
+        except PayloadError as e:
+            logger.info("Request parse error: %s", e)
+            return JsonResponse({'error': str(e)}, status=e.status)
+        
         username = data.get('username')
         password = data.get('password')
-        face_image_data = data.get('face_image')  # Base64 encoded image
+        audit.annotate(username=username)
         
-        if not all([username, password, face_image_data]):
+        if not all([username, password, face_image_bytes]):
             return JsonResponse({'error': 'Missing required fields'}, status=400)
         
-        print(f"🔍 Login attempt for user: {username}")
+        logger.info("Login attempt for user: %s", username)
         
-        # Check Web3 connection
-        if not w3.is_connected():
-            print("❌ Web3 not connected")
-            return JsonResponse({'error': 'Blockchain not connected. Is Ganache running?'}, status=500)
+        check_client_rate(request)
         
-        # Check contract initialization
-        if not contract:
-            print("❌ Contract not initialized")
-            return JsonResponse({
-                'error': 'Contract not deployed. Please deploy the contract first using: cd blockchain && npx truffle migrate'
-            }, status=500)
-        
-        # Verify contract is still deployed
-        is_deployed, message = verify_contract_deployed(CONTRACT_ADDRESS)
-        if not is_deployed:
-            print(f"❌ Contract verification failed: {message}")
-            return JsonResponse({
-                'error': f'Contract not found at address {CONTRACT_ADDRESS}. Please deploy the contract first.'
-            }, status=500)
-        
-        # Check if user exists
-        print(f"🔍 Checking if user '{username}' exists on blockchain...")
-        try:
-            is_registered = contract.functions.isRegistered(username).call()
-            print(f"✅ isRegistered result: {is_registered}")
-            
-            if not is_registered:
-                # Also check if user exists in local database (orphaned data from failed registration)
-                local_user = UserFaceEncoding.objects.filter(username=username).first()
-                if local_user:
-                    print(f"⚠️ User exists in local database but not on blockchain!")
-                    print(f"   This means registration didn't complete successfully.")
-                    print(f"   Cleaning up orphaned local data...")
-                    # Clean up orphaned data
-                    try:
-                        local_user.delete()
-                        print(f"✅ Cleaned up orphaned local data")
-                    except Exception as e:
-                        print(f"⚠️ Could not clean up: {e}")
-                    return JsonResponse({
-                        'error': 'User registration was incomplete. Please register again to complete the process.'
-                    }, status=404)
-                else:
-                    print(f"❌ User not found in blockchain or local database")
-                    return JsonResponse({
-                        'error': f'User "{username}" not found. Please register first.'
-                    }, status=404)
-        except Exception as e:
-            print(f"❌ Error checking user existence: {e}")
-            import traceback
-            traceback.print_exc()
-            error_msg = str(e)
-            if "contract" in error_msg.lower() and "deployed" in error_msg.lower():
-                return JsonResponse({
-                    'error': 'Contract not deployed correctly. Please run: cd blockchain && npx truffle migrate --reset'
-                }, status=500)
-            return JsonResponse({
-                'error': f'Error checking user: {error_msg}'
-            }, status=500)
-        
-        # Get stored data from blockchain
-        print(f"🔍 Getting user data from blockchain...")
+        # Encode alongside the ledger and database lookups; cancelled if they fail
+        ledger = get_ledger()
+        encode_job = start_encode(request, face_image_bytes, face_hint)
         try:
-            stored_data = contract.functions.getUserHash(username).call()
-            print(f"✅ Retrieved user data from blockchain")
-            
-            # getUserHash returns a tuple (passwordHash, faceHash)
-            if isinstance(stored_data, tuple):
-                stored_password_hash, stored_face_hash = stored_data
-                print(f"✅ Parsed tuple: passwordHash length={len(stored_password_hash)}, faceHash length={len(stored_face_hash)}")
-            elif isinstance(stored_data, list):
-                # Handle list case (sometimes Web3 returns lists)
-                if len(stored_data) == 2:
-                    stored_password_hash, stored_face_hash = stored_data[0], stored_data[1]
-                    print(f"✅ Parsed list: passwordHash length={len(stored_password_hash)}, faceHash length={len(stored_face_hash)}")
-                else:
-                    return JsonResponse({'error': f'Invalid user data format from blockchain: {stored_data}'}, status=500)
-            elif isinstance(stored_data, str):
-                # Fallback if it returns a string (shouldn't happen with correct ABI)
-                if '|' in stored_data:
-                    stored_password_hash, stored_face_hash = stored_data.split('|')
-                    print(f"✅ Parsed string: passwordHash length={len(stored_password_hash)}, faceHash length={len(stored_face_hash)}")
-                else:
-                    return JsonResponse({'error': f'Invalid user data format from blockchain: {stored_data}'}, status=500)
+            # Record and encoding loaded by an earlier /api/prepare/, if any
+            prefetched = prefetch.lookup(username)
+            credentials, error = _login_or_error(ledger, username, password, prefetched)
+            if error:
+                return error
+            password_hash, stored_face_hash = credentials
+
+            stored_encoding = prefetched.encoding if prefetched is not None else None
+            if stored_encoding is None:
+                try:
+                    with stage('db_lookup'):
+                        stored_encoding_obj = UserFaceEncoding.objects.filter(username=username).first()
+                    stored_encoding = stored_encoding_obj.get_encoding() if stored_encoding_obj else None
+                except Exception as e:
+                    # Fail closed rather than fall back to the ledger face key
+                    logger.exception("Could not read the stored face encoding: %s", e)
+                    return JsonResponse({'error': 'Could not read the stored face encoding'}, status=500)
+
+            if encode_job is not None:
+                face_encoding, error = encode_job.result()
             else:
-                return JsonResponse({'error': f'Unexpected data type from blockchain: {type(stored_data)}'}, status=500)
-        except Exception as e:
-            print(f"❌ Error getting user data from blockchain: {e}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'error': f'Error retrieving user data: {str(e)}'}, status=500)
-        
-        # Verify password
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
-        if password_hash != stored_password_hash:
-            return JsonResponse({'error': 'Invalid password'}, status=401)
-        
-        # Process face image
-        print("🔍 Processing face image for verification...")
-        try:
-            face_image_bytes = base64.b64decode(face_image_data)
-            print(f"✅ Face image decoded, size: {len(face_image_bytes)} bytes")
-        except Exception as e:
-            print(f"❌ Base64 decode error: {e}")
-            return JsonResponse({'error': f'Invalid image data: {str(e)}'}, status=400)
-        
-        print("🔍 Encoding face...")
-        try:
-            face_encoding = encode_face(face_image_bytes)
-            if face_encoding is None:
-                print("❌ No face detected")
-                return JsonResponse({'error': 'No face detected in image. Please ensure your face is clearly visible.'}, status=400)
-            print(f"✅ Face encoded, shape: {face_encoding.shape}")
-        except Exception as e:
-            print(f"❌ Face encoding error: {e}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'error': f'Face encoding failed: {str(e)}'}, status=500)
+                with admission.slot(admission.ENCODE):
+                    face_encoding, error = _encode_or_error(face_image_bytes, face_hint)
+            if error:
+                return error
+        finally:
+            if encode_job is not None:
+                encode_job.cancel()
         
         # Verify face using similarity comparison (not exact hash match)
         # Face encodings vary slightly, so we need to compare similarity
-        print("🔍 Verifying face similarity...")
-        face_match = False
-        
         try:
-            # Try to get stored face encoding from local database
-            stored_encoding_obj = UserFaceEncoding.objects.filter(username=username).first()
-            if stored_encoding_obj:
-                stored_encoding = stored_encoding_obj.get_encoding()
-                # Use face_recognition's compare_faces for similarity
-                face_match = compare_faces(stored_encoding, face_encoding, tolerance=0.6)
-                print(f"✅ Face similarity check: {'MATCH' if face_match else 'NO MATCH'}")
+            if stored_encoding is not None:
+                # Similarity: face_recognition distance within the tolerance
+                distance = float(get_face_distance(stored_encoding, face_encoding))
+                audit.annotate(distance=distance)
+                face_match = distance <= settings.FACE_MATCH_TOLERANCE
             else:
-                # Fallback to hash comparison (less reliable)
-                print("⚠️ No stored encoding found, using hash comparison (less reliable)")
-                current_face_hash = hash_face_encoding(face_encoding)
-                face_match = (current_face_hash == stored_face_hash)
-                print(f"✅ Hash comparison: {'MATCH' if face_match else 'NO MATCH'}")
+                # Fallback to the ledger's face key (estimated distance)
+                logger.warning("No stored encoding for %r, using the ledger face key (less reliable)", username)
+                face_match = verify_face(face_encoding, stored_face_hash,
+                                         settings.FACE_MATCH_TOLERANCE, settings.FACE_KEY_SEED)
         except Exception as e:
-            print(f"❌ Face verification error: {e}")
-            import traceback
-            traceback.print_exc()
-            # Fallback to hash comparison
-            current_face_hash = hash_face_encoding(face_encoding)
-            face_match = (current_face_hash == stored_face_hash)
+            # Fail closed: an error must not switch login to the looser key match
+            logger.exception("Face verification error: %s", e)
+            return JsonResponse({'error': 'Face verification error'}, status=500)
         
         if not face_match:
-            print("❌ Face verification failed - faces don't match")
+            logger.info("Face verification failed for %r - faces don't match", username)
             return JsonResponse({
                 'error': 'Face verification failed. Please ensure you are using the same face as registration.'
             }, status=401)
         
-        print("✅ Face verification successful!")
+        logger.info("Face verification successful for %r", username)
         
-        # Return dashboard data
+        # Return dashboard data and a session token for follow-up requests
         return JsonResponse({
             'success': True,
             'message': 'Login successful',
+            **issue_token(username),
             'dashboard_data': {
                 'username': username,
                 'password_hash': password_hash,
-                'face_encoding': face_encoding.tolist(),  # Convert numpy array to list
-                'face_hash': hash_face_encoding(face_encoding)
+                **encoding_payload(face_encoding, encoding_mode),
+                'face_hash': face_key(face_encoding, settings.FACE_KEY_SEED)
             }
         })
         
+    except AdmissionError as e:
+        logger.info("Verify shed by admission control: %s", e)
+        return admission_response(e)
     except Exception as e:
+        logger.exception("Unexpected error in verify: %s", e)
         return JsonResponse({'error': str(e)}, status=500)
+
+
+def _batch_item_result(item, status, error=None, **fields):
+    result = {'index': item.index, 'username': item.username, 'success': status == 200, 'status': status}
+    if error:
+        result['error'] = error
+    result.update(fields)
+    return result
+
+
+def _batch_workers(count):
+    """Encode pool workers a batch of `count` images keeps busy"""
+    return max(1, min(settings.FACE_ENCODE_WORKERS, count))
+
+
+def _encode_batch(images):
+    """Encode `images` on the shared process pool; yields BatchResult in order"""
+    workers = _batch_workers(len(images))
+    executor = get_encode_executor() if workers > 1 else None
+    return encode_faces_batch(
+        images, workers=workers, encoder=settings.FACE_ENCODER,
+        profile=settings.FACE_ENCODING_PROFILE,
+        chunk_size=max(1, len(images) // (2 * workers)), executor=executor,
+    )
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@track_request('verify_batch')
+def verify_batch(request):
+    """
+    Verify many (username, password, face image) items in one request
+
+    The ledger readiness check runs once, chain records are fetched with
+    batched reads, images are encoded in parallel and stored encodings are
+    loaded with a single query. Each item gets its own status in `results`.
+    """
+    try:
+        try:
+            data, items = parse_batch_request(request)
+            encoding_mode = get_encoding_mode(request, data)
+        except PayloadError as e:
+            logger.info("Batch request parse error: %s", e)
+            return JsonResponse({'error': str(e)}, status=e.status)
+        
+        logger.info("Batch verify of %d items", len(items))
+        
+        # One rate token per item, as if each had been its own request
+        check_client_rate(request, cost=len(items))
+        
+        ledger = get_ledger()
+        try:
+            ledger.check_ready()
+        except LedgerError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        
+        results = [None] * len(items)
+        candidates = []
+        for item in items:
+            if item.error:
+                results[item.index] = _batch_item_result(item, item.error.status, str(item.error))
+            elif not (isinstance(item.username, str) and isinstance(item.password, str)
+                      and item.username and item.password and item.image):
+                results[item.index] = _batch_item_result(item, 400, 'Missing required fields')
+            else:
+                candidates.append(item)
+        
+        # Chain records for every distinct username, in batched reads
+        try:
+            with stage('ledger_lookup'):
+                stored = ledger.get_user_hashes({item.username for item in candidates})
+        except LedgerError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        except Exception as e:
+            logger.exception("Error getting user data from blockchain: %s", e)
+            return JsonResponse({'error': f'Error retrieving user data: {str(e)}'}, status=500)
+        
+        # Cheap checks before any image is encoded
+        pending = []
+        for item in candidates:
+            entry = stored.get(item.username)
+            if entry is None:
+                results[item.index] = _batch_item_result(
+                    item, 404, f'User "{item.username}" not found. Please register first.'
+                )
+            elif isinstance(entry, LedgerError):
+                results[item.index] = _batch_item_result(item, entry.status, str(entry))
+            elif hashlib.sha256(item.password.encode()).hexdigest() != stored[item.username][0]:
+                results[item.index] = _batch_item_result(item, 401, 'Invalid password')
+            else:
+                pending.append(item)
+        
+        distances, item_timings = {}, {}
+        if pending:
+            with stage('db_lookup'):
+                local_encodings = {
+                    row.username: row
+                    for row in UserFaceEncoding.objects.filter(username__in={item.username for item in pending})
+                }
+            
+            # One encode slot per pool worker the batch occupies
+            with admission.slot(admission.ENCODE, _batch_workers(len(pending))):
+                encoded = list(_encode_batch([item.image for item in pending]))
+            
+            for item, outcome in zip(pending, encoded):
+                observe_stages(outcome.timings)
+                item_timings[item.index] = outcome.timings
+                if not outcome.ok:
+                    status = 500 if outcome.error.code == 'encoding_failed' else 400
+                    results[item.index] = _batch_item_result(item, status, outcome.error.message)
+                    continue
+                
+                face_encoding = outcome.encoding
+                face_hash = face_key(face_encoding, settings.FACE_KEY_SEED)
+                stored_encoding_obj = local_encodings.get(item.username)
+                if stored_encoding_obj:
+                    distance = float(get_face_distance(stored_encoding_obj.get_encoding(), face_encoding))
+                    distances[item.index] = distance
+                    face_match = distance <= settings.FACE_MATCH_TOLERANCE
+                else:
+                    logger.warning("No stored encoding for %r, using the ledger face key (less reliable)",
+                                   item.username)
+                    face_match = verify_face(face_encoding, stored[item.username][1],
+                                             settings.FACE_MATCH_TOLERANCE, settings.FACE_KEY_SEED)
+                
+                if not face_match:
+                    results[item.index] = _batch_item_result(item, 401, 'Face verification failed')
+                    continue
+                results[item.index] = _batch_item_result(
+                    item, 200, **issue_token(item.username),
+                    face_hash=face_hash, **encoding_payload(face_encoding, encoding_mode)
+                )
+        
+        for result in results:
+            audit.record(
+                'verify_batch', request, result['status'], username=result['username'],
+                error=result.get('error'), distance=distances.get(result['index']),
+                timings=item_timings.get(result['index']),
+            )
+        verified = sum(1 for result in results if result['success'])
+        logger.info("Batch verify: %d of %d items verified", verified, len(results))
+        return JsonResponse({
+            'success': True,
+            'verified': verified,
+            'failed': len(results) - verified,
+            'results': results,
+        })
+        
+    except AdmissionError as e:
+        logger.info("Batch verify shed by admission control: %s", e)
+        return admission_response(e)
+    except Exception as e:
+        logger.exception("Unexpected error in verify_batch: %s", e)
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@track_request('prepare')
+def prepare(request):
+    """
+    Start loading a user's ledger record and stored encoding for a coming verify
+
+    Sent by the login form once the username is known, before the face is
+    captured. Returns 202 straight away, whether or not the user exists.
+    """
+    try:
+        data = json.loads(request.body or b'{}') if request.content_type == 'application/json' else request.POST
+        username = data.get('username')
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(username, str) or not username.strip() or len(username) > 100:
+        return JsonResponse({'error': 'Missing or invalid username'}, status=400)
+    
+    try:
+        check_client_rate(request)
+    except AdmissionError as e:
+        return admission_response(e)
+    prefetch.start_prefetch(username)
+    return JsonResponse({'success': True}, status=202)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@track_request('token_refresh')
+def token_refresh(request):
+    """
+    Exchange a valid session token (Authorization: Bearer) for a new one
+    """
+    try:
+        return JsonResponse({'success': True, **refresh_token(bearer_token(request))})
+    except TokenError as e:
+        response = JsonResponse({'error': str(e)}, status=e.status)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+
+
+@require_http_methods(["GET"])
+@track_request('session')
+@require_session_token
+def session(request):
+    """
+    The user a session token belongs to; checked from the token alone
+    """
+    return JsonResponse({
+        'username': request.session_username,
+        'auth_time': request.session_auth_time,
+    })
+
+
+@require_http_methods(["GET"])
+@track_request('audit_failures')
+@require_session_token
+def audit_failures(request):
+    """
+    The session user's recent failed register/verify attempts, newest first
+    """
+    return JsonResponse({
+        'username': request.session_username,
+        'failures': recent_failures(request.session_username),
+    })
+
+
+@require_http_methods(["GET"])
+def client_config(request):
+    """
+    Capture parameters and upload limits for the frontend
+
+    Clients crop around the face and scale the crop to capture.max_side
+    before JPEG-encoding it, which keeps uploads small and saves the server
+    decode and detection time. Images over limits.max_image_side are rejected.
+    """
+    response = JsonResponse({
+        'capture': {
+            'max_side': settings.CAPTURE_MAX_SIDE,
+            'jpeg_quality': settings.CAPTURE_JPEG_QUALITY,
+            'face_padding': settings.CAPTURE_FACE_PADDING,
+        },
+        'limits': {
+            'max_image_bytes': settings.MAX_FACE_IMAGE_BYTES,
+            'max_image_side': settings.MAX_FACE_IMAGE_SIDE,
+        },
+    })
+    response['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    Prometheus text exposition of request, stage and RPC latency histograms
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_http_methods(["GET"])
+@staff_member_required
+def profiling_traces(request):
+    """
+    Stored request profiles, newest first, and the current sampling rate (staff only)
+    """
+    return JsonResponse({
+        'sampling': profiling.read_sampling(),
+        'traces': profiling.list_traces(),
+    })
+
+
+@require_http_methods(["GET"])
+@staff_member_required
+def profiling_trace(request, name):
+    """
+    Download one profile as a pstats file, or ?format=text for the top
+    functions by cumulative time (staff only)
+    """
+    path = profiling.trace_path(name)
+    if path is None:
+        raise Http404("No such trace")
+    if request.GET.get('format') != 'text':
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=name,
+                            content_type='application/octet-stream')
+    try:
+        limit = int(request.GET.get('limit', 40))
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return HttpResponse(out.getvalue(), content_type='text/plain; charset=utf-8')
+
+
+@require_http_methods(["POST"])
+@staff_member_required
+def profiling_sampling(request):
+    """
+    Profile a fraction of requests: {"rate": 0.01, "duration": 600}; rate 0 switches sampling off (staff only)
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+        sampling = profiling.set_sampling(data.get('rate', 0), data.get('duration'))
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'error': f'Invalid sampling settings: {e}'}, status=400)
+    return JsonResponse({'sampling': sampling})
@@ -0,0 +1,16 @@
+"""
+ASGI config for faceauth_backend project.
+
+Run with an ASGI server so the async endpoints (``/api/async/...``) can keep
+many requests in flight while they wait on the blockchain, e.g.:
+
+    uvicorn faceauth_backend.asgi:application --port 8000
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'faceauth_backend.settings')
+
+application = get_asgi_application()
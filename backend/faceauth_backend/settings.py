@@ -2,12 +2,26 @@
 Django settings for faceauth_backend project.
 """
 
+import hashlib
+import hmac
 import os
 from pathlib import Path
 
-# Simple config function to replace decouple
+from django.core.exceptions import ImproperlyConfigured
+
+# Simple config function to replace decouple; cast=bool parses 1/true/yes/on and 0/false/no/off
 def config(key, default=None, cast=None):
-    return os.environ.get(key, default)
+    value = os.environ.get(key)
+    if value is None:
+        return default
+    if cast is bool:
+        flag = value.strip().lower()
+        if flag in ('1', 'true', 'yes', 'on'):
+            return True
+        if flag in ('0', 'false', 'no', 'off'):
+            return False
+        raise ImproperlyConfigured(f"{key}={value!r} is not a boolean: use true/false, yes/no, on/off or 1/0")
+    return cast(value) if cast else value
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -41,6 +55,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'authentication.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'faceauth_backend.urls'
@@ -62,6 +77,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'faceauth_backend.wsgi.application'
+ASGI_APPLICATION = 'faceauth_backend.asgi.application'
 
 # Database
 DATABASES = {
@@ -115,6 +131,188 @@ CORS_ALLOW_ALL_ORIGINS = DEBUG
 CORS_ALLOW_CREDENTIALS = True
 
 # Blockchain settings
+# GANACHE_URL may be http(s)://, ws(s):// or ipc:///path/to/node.ipc
 GANACHE_URL = config('GANACHE_URL', default='http://127.0.0.1:7545')
+GANACHE_CONNECT_TIMEOUT = float(config('GANACHE_CONNECT_TIMEOUT', default=3))
+GANACHE_READ_TIMEOUT = float(config('GANACHE_READ_TIMEOUT', default=30))
+GANACHE_POOL_SIZE = int(config('GANACHE_POOL_SIZE', default=20))
 CONTRACT_ADDRESS = config('CONTRACT_ADDRESS', default='')
 PRIVATE_KEY = config('PRIVATE_KEY', default='')
+
+# Ledger backend holding the user records:
+#   web3        FaceAuth contract on the node at GANACHE_URL (default)
+#   eth_tester  FaceAuth deployed on an in-process py-evm chain (pip install "web3[tester]")
+#   memory      pure-Python dict with the contract's semantics; per process, not persisted
+LEDGER_BACKEND = config('LEDGER_BACKEND', default='web3')
+# Compiled FaceAuth.json for eth_tester (default: blockchain/build/contracts/FaceAuth.json)
+CONTRACT_ARTIFACT = config('CONTRACT_ARTIFACT', default='')
+
+# How register records new users:
+#   direct  one registerUser transaction per user (default)
+#   merkle  users are stored locally as Merkle leaves; `manage.py
+#           anchor_registrations` anchors each epoch's root in one transaction
+#           and stores every user's inclusion proof, which verify checks
+REGISTRATION_MODE = config('REGISTRATION_MODE', default='direct')
+# An anchoring run claims the pending registrations before sending anchorRoot;
+# a claim older than MERKLE_CLAIM_TIMEOUT seconds (the run died) may be taken over
+MERKLE_CLAIM_TIMEOUT = int(config('MERKLE_CLAIM_TIMEOUT', default=600))
+
+# Face encoder: 'face_recognition' (dlib model) or 'stub' (deterministic,
+# model-free; for load tests that isolate framework and chain overhead)
+FACE_ENCODER = config('FACE_ENCODER', default='face_recognition')
+
+# Encoding profile (face_module/detectors.py): 'fast' (Haar proposals + HOG on
+# crops), 'default' (HOG) or 'accurate' (HOG, 68-point landmarks, 10 jitters).
+# Enroll and verify with the same profile; encodings from the small and large
+# landmark models are not interchangeable.
+FACE_ENCODING_PROFILE = config('FACE_ENCODING_PROFILE', default='default')
+
+# Verify accepts a face when its distance to the enrolled encoding is at most
+# this. Calibrate per profile with face_module/evaluate_tolerance.py.
+FACE_MATCH_TOLERANCE = float(config('FACE_MATCH_TOLERANCE', default=0.6))
+
+# Register stores a locality-sensitive face key (face_module/face_keys.py) on
+# the ledger as the face hash; verify falls back to it, by estimated distance,
+# when a user has no local encoding. The key is public on the chain and a
+# known seed would reveal the direction of each encoding, so the seed must be
+# private: unset, it is derived from SECRET_KEY. Keys made with another seed
+# never match; set FACE_KEY_SEED explicitly if SECRET_KEY may be rotated.
+FACE_KEY_SEED = config('FACE_KEY_SEED')
+FACE_KEY_SEED = int(FACE_KEY_SEED) if FACE_KEY_SEED else int.from_bytes(
+    hmac.new(SECRET_KEY.encode(), b'faceauth.face_key_seed', hashlib.sha256).digest()[:8], 'big'
+)
+
+# Face key buckets (authentication/face_index.py) shortlist stored encodings
+# that may match a face: FACE_INDEX_PROBES extra buckets per band are looked
+# up (more raise the hit rate and the candidates; see evaluate_face_keys.py).
+# With REGISTER_REJECT_DUPLICATE_FACES, register refuses a face within
+# FACE_MATCH_TOLERANCE of another user's stored encoding (409).
+FACE_INDEX_PROBES = int(config('FACE_INDEX_PROBES', default=1))
+REGISTER_REJECT_DUPLICATE_FACES = config('REGISTER_REJECT_DUPLICATE_FACES', default=False, cast=bool)
+
+# Async views: worker processes used for CPU-bound face encoding
+FACE_ENCODE_WORKERS = int(config('FACE_ENCODE_WORKERS', default=os.cpu_count() or 1))
+
+# Verify submits its face encode to that pool before its ledger lookups, when
+# an encode slot is free, and cancels it if the user or password is rejected.
+# Unset, this is on for requests served through ASGI and off under WSGI, where
+# the sync view would start a pool of FACE_ENCODE_WORKERS in every worker
+# process; True/False force it either way.
+VERIFY_OVERLAP_ENCODE = config('VERIFY_OVERLAP_ENCODE', default=None, cast=bool)
+
+# gunicorn (backend/gunicorn.conf.py): load and warm the face models in the
+# master before forking, so workers share them copy-on-write
+PRELOAD_FACE_MODELS = config('PRELOAD_FACE_MODELS', default=True, cast=bool)
+
+# Signed session tokens issued by verify (authentication/tokens.py): each
+# token is valid for SESSION_TOKEN_TTL seconds and can be refreshed until
+# SESSION_MAX_AGE seconds after the face was verified.
+SESSION_TOKEN_TTL = int(config('SESSION_TOKEN_TTL', default=15 * 60))
+SESSION_MAX_AGE = int(config('SESSION_MAX_AGE', default=12 * 60 * 60))
+
+# Idempotency-Key handling for register/verify (authentication/idempotency.py):
+# outcomes are kept IDEMPOTENCY_TTL seconds; a retry waits up to
+# IDEMPOTENCY_WAIT seconds for the original request; a pending claim older
+# than IDEMPOTENCY_LOCK_TIMEOUT seconds is treated as abandoned.
+IDEMPOTENCY_TTL = int(config('IDEMPOTENCY_TTL', default=24 * 60 * 60))
+IDEMPOTENCY_WAIT = float(config('IDEMPOTENCY_WAIT', default=30))
+IDEMPOTENCY_LOCK_TIMEOUT = int(config('IDEMPOTENCY_LOCK_TIMEOUT', default=120))
+
+# Login prefetch (authentication/prefetch.py): /api/prepare/ loads a user's
+# ledger record and stored encoding on PREFETCH_WORKERS threads into the
+# default cache for PREFETCH_TTL seconds (0 disables it); at most
+# PREFETCH_MAX_PENDING loads wait. The cache below is per process: with
+# several workers use a shared one so verify finds what prepare loaded.
+# Keep PREFETCH_TTL short: it only has to span the gap between the username
+# field and the face capture, and it bounds how long a record changed on the
+# chain behind this server's back (updateFaceHash) may still be used.
+PREFETCH_TTL = int(config('PREFETCH_TTL', default=30))
+PREFETCH_WORKERS = int(config('PREFETCH_WORKERS', default=4))
+PREFETCH_MAX_PENDING = int(config('PREFETCH_MAX_PENDING', default=64))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'faceauth',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Admission control (authentication/admission.py). At most
+# ADMISSION_ENCODE_CONCURRENCY face encodes and ADMISSION_CHAIN_CONCURRENCY
+# registerUser submissions run at once per process; up to ADMISSION_QUEUE_SIZE
+# requests wait (for at most ADMISSION_QUEUE_TIMEOUT seconds), the rest get
+# 503 + Retry-After. Each client IP may start ADMISSION_CLIENT_RATE requests
+# per second (bursts of ADMISSION_CLIENT_BURST) before getting 429; 0 disables.
+ADMISSION_ENCODE_CONCURRENCY = int(config('ADMISSION_ENCODE_CONCURRENCY', default=FACE_ENCODE_WORKERS))
+ADMISSION_CHAIN_CONCURRENCY = int(config('ADMISSION_CHAIN_CONCURRENCY', default=4))
+ADMISSION_QUEUE_SIZE = int(config('ADMISSION_QUEUE_SIZE', default=32))
+ADMISSION_QUEUE_TIMEOUT = float(config('ADMISSION_QUEUE_TIMEOUT', default=10))
+ADMISSION_CLIENT_RATE = float(config('ADMISSION_CLIENT_RATE', default=5))
+ADMISSION_CLIENT_BURST = float(config('ADMISSION_CLIENT_BURST', default=20))
+# Use the first X-Forwarded-For address as the client (only behind a trusted proxy)
+ADMISSION_TRUST_FORWARDED_FOR = config('ADMISSION_TRUST_FORWARDED_FOR', default=False, cast=bool)
+
+# Audit log of register/verify attempts (authentication/audit.py): events are
+# queued (at most AUDIT_QUEUE_SIZE, the rest are dropped and counted) and
+# written by a background thread in batches of AUDIT_BATCH_SIZE or every
+# AUDIT_FLUSH_INTERVAL seconds, into one table per month.
+# /api/audit/failures/ lists the last AUDIT_FAILURE_WINDOW seconds of failures.
+AUDIT_LOG_ENABLED = config('AUDIT_LOG_ENABLED', default=True, cast=bool)
+AUDIT_QUEUE_SIZE = int(config('AUDIT_QUEUE_SIZE', default=10000))
+AUDIT_BATCH_SIZE = int(config('AUDIT_BATCH_SIZE', default=500))
+AUDIT_FLUSH_INTERVAL = float(config('AUDIT_FLUSH_INTERVAL', default=1.0))
+AUDIT_FAILURE_WINDOW = int(config('AUDIT_FAILURE_WINDOW', default=24 * 60 * 60))
+
+# On-demand request profiling (authentication/profiling.py): requests to
+# PROFILE_PATHS are profiled when they carry a signed X-Profile token (valid
+# PROFILE_TOKEN_TTL seconds) or are sampled; the newest PROFILE_MAX_TRACES
+# traces are kept in PROFILE_DIR. PROFILING_ENABLED=False removes the middleware.
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=True, cast=bool)
+PROFILE_DIR = config('PROFILE_DIR', default=str(BASE_DIR / 'profiles'))
+PROFILE_MAX_TRACES = int(config('PROFILE_MAX_TRACES', default=50))
+PROFILE_TOKEN_TTL = int(config('PROFILE_TOKEN_TTL', default=60 * 60))
+PROFILE_PATHS = [path.strip() for path in config(
+    'PROFILE_PATHS', default='/api/register/,/api/verify/,/api/async/register/,/api/async/verify/',
+).split(',') if path.strip()]
+
+# Largest accepted face image upload (bytes), checked before the body is read
+MAX_FACE_IMAGE_BYTES = int(config('MAX_FACE_IMAGE_BYTES', default=2 * 1024 * 1024))
+# Largest accepted width or height (pixels), read from the image header
+MAX_FACE_IMAGE_SIDE = int(config('MAX_FACE_IMAGE_SIDE', default=1280))
+# request.body / request.POST refuse bodies over this; it must hold a base64
+# image of MAX_FACE_IMAGE_BYTES plus the other fields (payloads.FORM_OVERHEAD_BYTES)
+DATA_UPLOAD_MAX_MEMORY_SIZE = MAX_FACE_IMAGE_BYTES * 4 // 3 + 16 * 1024
+
+# Batch verify (/api/verify/batch/): most items per request and largest body (bytes)
+VERIFY_BATCH_MAX_ITEMS = int(config('VERIFY_BATCH_MAX_ITEMS', default=32))
+VERIFY_BATCH_MAX_BYTES = int(config('VERIFY_BATCH_MAX_BYTES', default=16 * 1024 * 1024))
+
+# Capture parameters published at /api/config/: the frontend crops around the
+# face and scales the crop so its long side is at most CAPTURE_MAX_SIDE.
+CAPTURE_MAX_SIDE = int(config('CAPTURE_MAX_SIDE', default=480))
+CAPTURE_JPEG_QUALITY = float(config('CAPTURE_JPEG_QUALITY', default=0.85))
+# Margin added around the detected face box on each side, as a fraction of its size
+CAPTURE_FACE_PADDING = float(config('CAPTURE_FACE_PADDING', default=0.6))
+
+# Logging; FACEAUTH_LOG_LEVEL=DEBUG shows per-request detail, OFF disables app logs
+FACEAUTH_LOG_LEVEL = config('FACEAUTH_LOG_LEVEL', default='INFO' if DEBUG else 'WARNING').upper()
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        name: {
+            'handlers': ['console'] if FACEAUTH_LOG_LEVEL != 'OFF' else [],
+            'level': FACEAUTH_LOG_LEVEL if FACEAUTH_LOG_LEVEL != 'OFF' else 'CRITICAL',
+            'propagate': False,
+        }
+        for name in ('authentication', 'face_module')
+    },
+}
@@ -0,0 +1,31 @@
+"""
+Gunicorn settings for the FaceAuth backend.
+
+    cd backend
+    gunicorn faceauth_backend.wsgi
+    gunicorn faceauth_backend.asgi -k uvicorn.workers.UvicornWorker
+
+The app is loaded once in the master (preload_app) and, with
+PRELOAD_FACE_MODELS on, the face models are loaded and warmed there before
+any worker is forked (authentication/preload.py). Workers, and replacements
+for workers restarted after max_requests, share the model pages
+copy-on-write. Check with ``python manage.py memory_report --master <pid>``.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', os.cpu_count() or 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+pidfile = os.environ.get('GUNICORN_PIDFILE', 'gunicorn.pid')
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded, before workers are forked
+    from django.conf import settings
+
+    if settings.PRELOAD_FACE_MODELS:
+        from authentication.preload import preload
+        server.log.info("Preloaded app and face models in %.2fs", preload())
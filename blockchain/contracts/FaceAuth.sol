@@ -21,15 +21,26 @@ contract FaceAuth {
     // Array to store all registered usernames
     string[] public registeredUsers;
     
+    // Merkle roots of batch registrations, one per epoch (index = epoch)
+    bytes32[] public anchoredRoots;
+    
+    // Account allowed to anchor roots (the deployer)
+    address public immutable anchorer;
+    
     // Events
     event UserRegistered(string indexed username, string passwordHash, string faceHash);
     event UserVerified(string indexed username, bool success);
+    event RootAnchored(uint256 indexed epoch, bytes32 root, uint256 leafCount);
+    
+    constructor() {
+        anchorer = msg.sender;
+    }
     
     /**
      * @dev Register a new user with username, password hash, and face hash
      * @param username The username of the user
      * @param passwordHash SHA-256 hash of the user's password
-     * @param faceHash SHA-256 hash of the user's face encoding
+     * @param faceHash Face key of the user's face encoding (a keyed locality-sensitive hash)
      */
     function registerUser(
         string memory username,
@@ -64,6 +75,101 @@ contract FaceAuth {
         return (users[username].passwordHash, users[username].faceHash);
     }
     
+    /**
+     * @dev Get the hashes of several users in one call
+     * @notice Unknown usernames do not revert; their `exists` entry is false
+     * @param usernames The usernames to query
+     * @return exists Whether each username is registered
+     * @return passwordHashes The password hash of each user ("" if unknown)
+     * @return faceHashes The face hash of each user ("" if unknown)
+     */
+    function getUserHashes(string[] memory usernames) public view returns (
+        bool[] memory exists,
+        string[] memory passwordHashes,
+        string[] memory faceHashes
+    ) {
+        uint256 count = usernames.length;
+        exists = new bool[](count);
+        passwordHashes = new string[](count);
+        faceHashes = new string[](count);
+        for (uint256 i = 0; i < count; i++) {
+            User storage user = users[usernames[i]];
+            exists[i] = user.exists;
+            passwordHashes[i] = user.passwordHash;
+            faceHashes[i] = user.faceHash;
+        }
+        return (exists, passwordHashes, faceHashes);
+    }
+    
+    /**
+     * @dev Anchor the Merkle root of a batch of registrations as a new epoch
+     * @notice Leaves are keccak256(bytes.concat(keccak256(abi.encode(username, passwordHash, faceHash))));
+     *         inner nodes hash their two children in ascending order
+     * @param root Root of the batch's Merkle tree
+     * @param leafCount Number of registrations in the batch
+     * @return epoch The epoch the root was stored under
+     */
+    function anchorRoot(bytes32 root, uint256 leafCount) public returns (uint256 epoch) {
+        require(msg.sender == anchorer, "Only the anchorer can anchor roots");
+        require(root != bytes32(0), "Root cannot be empty");
+        require(leafCount > 0, "Batch cannot be empty");
+        
+        epoch = anchoredRoots.length;
+        anchoredRoots.push(root);
+        
+        emit RootAnchored(epoch, root, leafCount);
+        return epoch;
+    }
+    
+    /**
+     * @dev Get the root anchored for an epoch
+     * @param epoch The epoch to query
+     * @return root The anchored root, or zero if the epoch does not exist
+     */
+    function getAnchoredRoot(uint256 epoch) public view returns (bytes32 root) {
+        if (epoch >= anchoredRoots.length) {
+            return bytes32(0);
+        }
+        return anchoredRoots[epoch];
+    }
+    
+    /**
+     * @dev Get the number of anchored epochs
+     * @return count The number of epochs
+     */
+    function getEpochCount() public view returns (uint256 count) {
+        return anchoredRoots.length;
+    }
+    
+    /**
+     * @dev Check that a batch-registered user's record is included in an epoch's root
+     * @param epoch The epoch the user was anchored in
+     * @param username The username of the user
+     * @param passwordHash The password hash of the user
+     * @param faceHash The face hash of the user
+     * @param proof Sibling hashes from the leaf up to the root
+     * @return included True if the proof leads to the anchored root
+     */
+    function verifyMerkleUser(
+        uint256 epoch,
+        string memory username,
+        string memory passwordHash,
+        string memory faceHash,
+        bytes32[] memory proof
+    ) public view returns (bool included) {
+        if (epoch >= anchoredRoots.length) {
+            return false;
+        }
+        bytes32 node = keccak256(bytes.concat(keccak256(abi.encode(username, passwordHash, faceHash))));
+        for (uint256 i = 0; i < proof.length; i++) {
+            bytes32 sibling = proof[i];
+            node = node < sibling
+                ? keccak256(abi.encodePacked(node, sibling))
+                : keccak256(abi.encodePacked(sibling, node));
+        }
+        return node == anchoredRoots[epoch];
+    }
+    
     /**
      * @dev Check if a user is registered
      * @param username The username to check
@@ -93,12 +199,35 @@ contract FaceAuth {
     
     /**
      * @dev Get all registered usernames
+     * @notice Unbounded; use getUsers(offset, limit) for large registries
      * @return usernames Array of all registered usernames
      */
     function getAllUsers() public view returns (string[] memory usernames) {
         return registeredUsers;
     }
     
+    /**
+     * @dev Get a page of registered usernames in registration order
+     * @param offset Index of the first username to return
+     * @param limit Maximum number of usernames to return
+     * @return usernames Up to `limit` usernames starting at `offset`
+     */
+    function getUsers(uint256 offset, uint256 limit) public view returns (string[] memory usernames) {
+        uint256 total = registeredUsers.length;
+        if (offset >= total) {
+            return new string[](0);
+        }
+        uint256 end = offset + limit;
+        if (end > total) {
+            end = total;
+        }
+        usernames = new string[](end - offset);
+        for (uint256 i = offset; i < end; i++) {
+            usernames[i - offset] = registeredUsers[i];
+        }
+        return usernames;
+    }
+    
     /**
      * @dev Verify user credentials
      * @param username The username to verify
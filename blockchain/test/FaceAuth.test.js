@@ -118,6 +118,25 @@ contract("FaceAuth", (accounts) => {
       const newCount = await faceAuth.getUserCount();
       assert.equal(newCount, 2);
     });
+
+    it("should page through usernames with getUsers", async () => {
+      await faceAuth.registerUser("user2", "hash2", "face2", { from: owner });
+      await faceAuth.registerUser("user3", "hash3", "face3", { from: owner });
+
+      assert.deepEqual(await faceAuth.getUsers(0, 2), ["testuser", "user2"]);
+      assert.deepEqual(await faceAuth.getUsers(2, 2), ["user3"]);
+      assert.deepEqual(await faceAuth.getUsers(3, 2), []);
+      assert.deepEqual(await faceAuth.getUsers(1, 100), ["user2", "user3"]);
+    });
+
+    it("should look up several users with getUserHashes", async () => {
+      await faceAuth.registerUser("user2", "hash2", "face2", { from: owner });
+
+      const result = await faceAuth.getUserHashes(["user2", "nonexistent", "user2"]);
+      assert.deepEqual(result.exists, [true, false, true]);
+      assert.deepEqual(result.passwordHashes, ["hash2", "", "hash2"]);
+      assert.deepEqual(result.faceHashes, ["face2", "", "face2"]);
+    });
   });
 
   describe("User Verification", () => {
@@ -198,5 +217,52 @@ contract("FaceAuth", (accounts) => {
       }
     });
   });
-});
 
+  describe("Merkle Anchoring", () => {
+    const leaf = (username, passwordHash, faceHash) =>
+      web3.utils.keccak256(web3.utils.keccak256(
+        web3.eth.abi.encodeParameters(["string", "string", "string"], [username, passwordHash, faceHash])
+      ));
+    const parent = (a, b) =>
+      web3.utils.toBN(a).lt(web3.utils.toBN(b))
+        ? web3.utils.soliditySha3({ t: "bytes32", v: a }, { t: "bytes32", v: b })
+        : web3.utils.soliditySha3({ t: "bytes32", v: b }, { t: "bytes32", v: a });
+
+    // Three leaves: root = parent(parent(a, b), c)
+    const a = leaf("alice", "pa", "fa");
+    const b = leaf("bob", "pb", "fb");
+    const c = leaf("carol", "pc", "fc");
+    const ab = parent(a, b);
+    const root = parent(ab, c);
+
+    it("should anchor roots as consecutive epochs", async () => {
+      const tx = await faceAuth.anchorRoot(root, 3, { from: owner });
+      assert.equal(tx.logs[0].event, "RootAnchored");
+      assert.equal(tx.logs[0].args.epoch.toNumber(), 0);
+      assert.equal(tx.logs[0].args.leafCount.toNumber(), 3);
+
+      await faceAuth.anchorRoot(ab, 2, { from: owner });
+      assert.equal((await faceAuth.getEpochCount()).toNumber(), 2);
+      assert.equal(await faceAuth.getAnchoredRoot(0), root);
+      assert.equal(await faceAuth.getAnchoredRoot(5), "0x" + "0".repeat(64));
+    });
+
+    it("should only let the anchorer anchor roots", async () => {
+      try {
+        await faceAuth.anchorRoot(root, 3, { from: user1 });
+        assert.fail("Expected revert");
+      } catch (error) {
+        assert.include(error.message, "Only the anchorer can anchor roots");
+      }
+    });
+
+    it("should verify inclusion proofs against the anchored root", async () => {
+      await faceAuth.anchorRoot(root, 3, { from: owner });
+
+      assert.equal(await faceAuth.verifyMerkleUser(0, "alice", "pa", "fa", [b, c]), true);
+      assert.equal(await faceAuth.verifyMerkleUser(0, "carol", "pc", "fc", [ab]), true);
+      assert.equal(await faceAuth.verifyMerkleUser(0, "alice", "wrong", "fa", [b, c]), false);
+      assert.equal(await faceAuth.verifyMerkleUser(1, "alice", "pa", "fa", [b, c]), false);
+    });
+  });
+});
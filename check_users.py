@@ -14,8 +14,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'faceauth_backend.settings')
 import django
 django.setup()
 
-from authentication.views import contract, w3, CONTRACT_ADDRESS, verify_contract_deployed
-from authentication.models import UserFaceEncoding
+from authentication.blockchain import get_chain
+from authentication.ledger import Web3Ledger
+from authentication.reconcile import reconcile
 
 def check_users():
     print("=" * 60)
@@ -23,6 +24,9 @@ def check_users():
     print("=" * 60)
     print()
     
+    chain = get_chain()
+    w3 = chain.w3
+    
     # Check Web3 connection
     print("1. Checking Web3 connection...")
     if w3.is_connected():
@@ -35,8 +39,8 @@ def check_users():
     
     # Check contract
     print("2. Checking contract...")
-    print(f"   Contract address: {CONTRACT_ADDRESS}")
-    is_deployed, message = verify_contract_deployed(CONTRACT_ADDRESS)
+    print(f"   Contract address: {chain.address}")
+    is_deployed, message = chain.verify_contract_deployed()
     if is_deployed:
         print(f"   ✅ Contract deployed: {message}")
     else:
@@ -45,32 +49,24 @@ def check_users():
         return
     print()
     
-    # Check local database
-    print("3. Checking local database...")
-    local_users = UserFaceEncoding.objects.all()
-    print(f"   Found {local_users.count()} users in local database:")
-    for user in local_users:
-        print(f"   - {user.username} (created: {user.created_at})")
-    print()
-    
-    # Check blockchain
-    print("4. Checking blockchain...")
-    if contract:
-        # Test with usernames from local database
-        if local_users.exists():
-            print("   Checking users from local database on blockchain:")
-            for user in local_users:
-                try:
-                    is_registered = contract.functions.isRegistered(user.username).call()
-                    status = "✅ Registered" if is_registered else "❌ Not registered"
-                    print(f"   - {user.username}: {status}")
-                except Exception as e:
-                    print(f"   - {user.username}: ❌ Error - {e}")
-        else:
-            print("   No users in local database to check")
-            print("   💡 Register a user first")
+    # Compare blockchain and local database
+    print("3. Comparing blockchain users with local database...")
+    try:
+        report = reconcile(Web3Ledger(chain))
+    except Exception as e:
+        print(f"   ❌ Could not read users from the contract: {e}")
+        print("   💡 Redeploy the contract (getUsers was added): cd blockchain && npx truffle migrate --reset")
+        return
+    print(f"   Blockchain users: {report.chain_count}")
+    print(f"   Local face encodings: {report.local_count}")
+    for username in report.chain_only:
+        print(f"   - {username}: ✅ Registered, ❌ no local face encoding")
+    for username in report.local_only:
+        print(f"   - {username}: ❌ Not registered (local data only)")
+    if not report.chain_only and not report.local_only:
+        print("   ✅ Blockchain and local database agree")
     else:
-        print("   ❌ Contract not initialized")
+        print("   💡 Full report / cleanup: cd backend && python manage.py reconcile_users --repair")
     print()
     
     # Instructions
@@ -0,0 +1,83 @@
+"""
+Benchmark encode_faces_batch throughput against worker count
+
+    python benchmark_batch.py --images ../faces
+    python benchmark_batch.py --images ../faces --workers 1 2 4 8 --chunk-size 4 --repeat 3
+    python benchmark_batch.py --synthetic 64     # noise images, no faces (detection cost only)
+
+Each row reports images per second, speed-up over one worker and how many
+images produced an encoding. Timed passes include starting the process pool,
+as a bulk job would; a short untimed pass per worker count runs first.
+"""
+import argparse
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from face_utils import encode_faces_batch
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def load_images(directory, limit=None):
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for name in names[:limit]:
+        with open(os.path.join(directory, name), 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+def synthetic_images(count, size=(640, 480)):
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(
+            buffer, format='JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def run(images, workers, chunk_size, encoder, profile):
+    start = time.perf_counter()
+    encoded = sum(1 for result in encode_faces_batch(
+        images, workers=workers, encoder=encoder, profile=profile, chunk_size=chunk_size) if result.ok)
+    return time.perf_counter() - start, encoded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="encode_faces_batch throughput by worker count")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help='directory of face photos')
+    source.add_argument('--synthetic', type=int, help='number of generated 640x480 noise images')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--chunk-size', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1, help='timed passes per worker count')
+    parser.add_argument('--encoder', default='face_recognition')
+    parser.add_argument('--profile')
+    args = parser.parse_args()
+
+    images = synthetic_images(args.synthetic) if args.synthetic else load_images(args.images, args.limit)
+    if not images:
+        parser.error("no images")
+    print(f"{len(images)} images, {os.cpu_count()} CPUs, chunk size {args.chunk_size}\n")
+    print(f"{'workers':>7}  {'images/s':>9}  {'speed-up':>8}  {'encoded':>7}")
+
+    baseline = None
+    for workers in sorted(set(args.workers)):
+        run(images[:max(1, workers * args.chunk_size)], workers, args.chunk_size, args.encoder, args.profile)
+        elapsed, encoded = min(
+            run(images, workers, args.chunk_size, args.encoder, args.profile) for _ in range(args.repeat)
+        )
+        rate = len(images) / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>7}  {rate:9.1f}  {rate / baseline:7.2f}x  {encoded:>7}")
+
+
+if __name__ == '__main__':
+    main()
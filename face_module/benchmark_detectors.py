@@ -0,0 +1,109 @@
+"""
+Benchmark face detector backends and encoding profiles
+
+Reports CPU time per image and detection rate (images with at least one
+face found) for every detector, and CPU time per image and encode rate for
+every encoding profile.
+
+    python benchmark_detectors.py --images ../faces
+    python benchmark_detectors.py --images ../faces --detectors hog haar cascade --repeat 3
+
+Detectors whose model files are missing (haar without the cascade XML or on
+OpenCV builds without CascadeClassifier, dnn without FACEAUTH_DNN_MODEL_DIR)
+are reported as unavailable.
+"""
+import argparse
+import io
+import os
+import time
+
+import face_recognition
+import numpy as np
+from PIL import Image
+
+from detectors import PROFILES, DetectorUnavailable, detector_names, get_detector
+from face_utils import encode_face
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def load_images(directory, limit=None):
+    """Return (name, image_bytes, rgb_array) for the images in `directory`"""
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for name in names[:limit]:
+        with open(os.path.join(directory, name), 'rb') as f:
+            data = f.read()
+        array = np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+        images.append((name, data, array))
+    return images
+
+
+def bench_detector(name, images, repeat):
+    """Returns (cpu_seconds_per_image, detection_rate)"""
+    detector = get_detector(name)
+    detector(images[0][2])  # load models outside the measurement
+
+    found = 0
+    start = time.process_time()
+    for _ in range(repeat):
+        found = sum(1 for _, _, array in images if detector(array))
+    cpu = (time.process_time() - start) / (repeat * len(images))
+    return cpu, found / len(images)
+
+
+def bench_profile(name, images, repeat):
+    """Returns (cpu_seconds_per_image, encode_rate); includes image decoding"""
+    encode_face(images[0][1], profile=name)
+
+    encoded = 0
+    start = time.process_time()
+    for _ in range(repeat):
+        encoded = sum(1 for _, data, _ in images if encode_face(data, profile=name) is not None)
+    cpu = (time.process_time() - start) / (repeat * len(images))
+    return cpu, encoded / len(images)
+
+
+def print_row(label, result):
+    if isinstance(result, str):
+        print(f"  {label:<12} {result}")
+    else:
+        cpu, rate = result
+        print(f"  {label:<12} {cpu * 1000:9.1f} ms CPU/image   {rate:6.1%} detected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face detectors and encoding profiles")
+    parser.add_argument('--images', required=True, help='directory of face photos')
+    parser.add_argument('--limit', type=int, help='use at most this many images')
+    parser.add_argument('--repeat', type=int, default=1, help='passes over the image set')
+    parser.add_argument('--detectors', nargs='*', default=[n for n in detector_names() if n != 'cnn'],
+                        help='detectors to run (cnn is skipped by default; it is very slow on CPU)')
+    parser.add_argument('--profiles', nargs='*', default=list(PROFILES))
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.limit)
+    if not images:
+        parser.error(f"no images in {args.images}")
+    sizes = [array.shape[1] * array.shape[0] for _, _, array in images]
+    print(f"{len(images)} images, {np.mean(sizes) / 1e6:.2f} MP average, "
+          f"face_recognition {face_recognition.__version__}\n")
+
+    print("Detectors")
+    for name in args.detectors:
+        try:
+            result = bench_detector(name, images, args.repeat)
+        except DetectorUnavailable as e:
+            result = f"unavailable: {e}"
+        print_row(name, result)
+
+    print("\nEncoding profiles (decode + detect + encode)")
+    for name in args.profiles:
+        options = PROFILES[name]
+        print_row(name, bench_profile(name, images, args.repeat))
+        print(f"  {'':<12} detector={options['detector']} model={options['model']} "
+              f"num_jitters={options['num_jitters']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Face detector backends and encoding profiles
+
+Every detector takes an RGB numpy array and returns face locations as
+(top, right, bottom, left) tuples, the convention used by face_recognition,
+so any of them can feed face_recognition.face_encodings().
+
+    hog       dlib HOG + linear SVM (face_recognition default)
+    cnn       dlib MMOD CNN; most accurate, very slow without a GPU
+    haar      OpenCV Haar cascade
+    dnn       OpenCV res10 SSD (Caffe); needs the model files, see DnnDetector
+    cascade   OpenCV proposals on a downscaled image, then HOG on padded crops
+
+An encoding profile names a detector together with the landmark model and
+num_jitters passed to face_recognition.face_encodings().
+"""
+import logging
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    import face_recognition
+    FACE_RECOGNITION_AVAILABLE = True
+except ImportError:
+    FACE_RECOGNITION_AVAILABLE = False
+
+# Encodings from different landmark models are not interchangeable: users
+# enrolled under one model should be verified with the same one.
+PROFILES = {
+    'fast': {'detector': 'cascade', 'model': 'small', 'num_jitters': 1},
+    'default': {'detector': 'hog', 'model': 'small', 'num_jitters': 1},
+    'accurate': {'detector': 'hog', 'model': 'large', 'num_jitters': 10},
+}
+
+DEFAULT_PROFILE = 'default'
+
+
+class DetectorUnavailable(RuntimeError):
+    """A detector's model files or OpenCV module are missing"""
+
+
+def get_profile(name):
+    """
+    Look up an encoding profile by name
+
+    Raises:
+        ValueError: unknown profile name
+    """
+    try:
+        return PROFILES[name or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError(f"Unknown encoding profile: {name}. Use one of: {', '.join(PROFILES)}")
+
+
+def detect_hog(image_array, upsample=1):
+    """dlib HOG detector"""
+    return face_recognition.face_locations(image_array, number_of_times_to_upsample=upsample, model='hog')
+
+
+def detect_cnn(image_array, upsample=1):
+    """dlib MMOD CNN detector"""
+    return face_recognition.face_locations(image_array, number_of_times_to_upsample=upsample, model='cnn')
+
+
+def _rects_to_locations(rects, scale=1.0):
+    """OpenCV (x, y, w, h) boxes -> (top, right, bottom, left) in full-image pixels"""
+    return [
+        (int(y / scale), int((x + w) / scale), int((y + h) / scale), int(x / scale))
+        for x, y, w, h in rects
+    ]
+
+
+class HaarDetector:
+    """
+    OpenCV Haar cascade detector
+
+    The cascade XML defaults to haarcascade_frontalface_default.xml from
+    cv2.data, or $FACEAUTH_HAAR_CASCADE. The classifier is loaded on first use.
+    """
+
+    def __init__(self, cascade_path=None, max_side=480, scale_factor=1.1, min_neighbors=5):
+        self.cascade_path = cascade_path
+        self.max_side = max_side
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self._classifier = None
+
+    def _load(self):
+        if self._classifier is None:
+            if not hasattr(cv2, 'CascadeClassifier'):
+                # OpenCV 5 moved Haar cascades out of the main package
+                raise DetectorUnavailable("this OpenCV build has no CascadeClassifier")
+            path = self.cascade_path or os.environ.get('FACEAUTH_HAAR_CASCADE') or _default_cascade_path()
+            classifier = cv2.CascadeClassifier(path)
+            if classifier.empty():
+                raise DetectorUnavailable(f"Haar cascade not found or invalid: {path}")
+            self._classifier = classifier
+        return self._classifier
+
+    def __call__(self, image_array):
+        classifier = self._load()
+        gray, scale = _downscaled_gray(image_array, self.max_side)
+        rects = classifier.detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors)
+        return _rects_to_locations(rects, scale)
+
+
+class DnnDetector:
+    """
+    OpenCV DNN detector using the res10 300x300 SSD face model
+
+    Expects deploy.prototxt and res10_300x300_ssd_iter_140000.caffemodel in
+    `model_dir` (default $FACEAUTH_DNN_MODEL_DIR). Both files ship with the
+    OpenCV samples (samples/dnn/face_detector).
+    """
+
+    PROTOTXT = 'deploy.prototxt'
+    WEIGHTS = 'res10_300x300_ssd_iter_140000.caffemodel'
+
+    def __init__(self, model_dir=None, confidence=0.6):
+        self.model_dir = model_dir
+        self.confidence = confidence
+        self._net = None
+
+    def _load(self):
+        if self._net is None:
+            model_dir = self.model_dir or os.environ.get('FACEAUTH_DNN_MODEL_DIR', '')
+            prototxt = os.path.join(model_dir, self.PROTOTXT)
+            weights = os.path.join(model_dir, self.WEIGHTS)
+            if not (os.path.exists(prototxt) and os.path.exists(weights)):
+                raise DetectorUnavailable(
+                    f"DNN face model not found in '{model_dir}'. Set FACEAUTH_DNN_MODEL_DIR to a directory "
+                    f"containing {self.PROTOTXT} and {self.WEIGHTS}"
+                )
+            self._net = cv2.dnn.readNetFromCaffe(prototxt, weights)
+        return self._net
+
+    def __call__(self, image_array):
+        net = self._load()
+        height, width = image_array.shape[:2]
+        blob = cv2.dnn.blobFromImage(
+            cv2.resize(cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR), (300, 300)),
+            1.0, (300, 300), (104.0, 177.0, 123.0)
+        )
+        net.setInput(blob)
+        detections = net.forward()[0, 0]
+
+        locations = []
+        for detection in detections:
+            if detection[2] < self.confidence:
+                continue
+            left, top, right, bottom = (detection[3:7] * [width, height, width, height]).astype(int)
+            left, top = max(0, left), max(0, top)
+            right, bottom = min(width, right), min(height, bottom)
+            if right > left and bottom > top:
+                locations.append((int(top), int(right), int(bottom), int(left)))
+        return locations
+
+
+class CascadeDetector:
+    """
+    Cheap OpenCV proposals, confirmed by HOG on a padded crop around each one
+
+    HOG cost grows with image area; running it on small crops instead of the
+    full frame keeps its precision at a fraction of the CPU time. If the
+    proposer finds nothing (or is unavailable), full-image HOG is used.
+    """
+
+    def __init__(self, proposer=None, padding=0.4):
+        self.proposer = proposer
+        self.padding = padding
+        self._proposer_unavailable = False
+
+    def _proposals(self, image_array):
+        if self._proposer_unavailable:
+            return []
+        proposer = self.proposer or get_detector('haar')
+        try:
+            return proposer(image_array)
+        except DetectorUnavailable as e:
+            logger.warning("Cascade proposer unavailable, using full-image HOG: %s", e)
+            self._proposer_unavailable = True
+            return []
+
+    def __call__(self, image_array):
+        locations = detect_in_regions(image_array, self._proposals(image_array), self.padding)
+        if locations:
+            return locations
+        return detect_hog(image_array)
+
+
+def detect_in_regions(image_array, regions, padding):
+    """
+    HOG on a padded crop around each region, mapped back to image coordinates
+
+    Args:
+        image_array: RGB image
+        regions: (top, right, bottom, left) boxes, e.g. proposals or a
+            client-supplied face box; parts outside the image are ignored
+        padding: margin added on each side, as a fraction of the box size
+
+    Returns:
+        list: face locations found inside the crops (empty if none)
+    """
+    height, width = image_array.shape[:2]
+    locations = []
+    for top, right, bottom, left in regions:
+        pad_y = int((bottom - top) * padding)
+        pad_x = int((right - left) * padding)
+        crop_top, crop_left = max(0, top - pad_y), max(0, left - pad_x)
+        crop_bottom, crop_right = min(height, bottom + pad_y), min(width, right + pad_x)
+        if crop_bottom <= crop_top or crop_right <= crop_left:
+            continue
+        crop = image_array[crop_top:crop_bottom, crop_left:crop_right]
+        for c_top, c_right, c_bottom, c_left in detect_hog(np.ascontiguousarray(crop)):
+            locations.append((c_top + crop_top, c_right + crop_left, c_bottom + crop_top, c_left + crop_left))
+    return locations
+
+
+def _default_cascade_path():
+    data_dir = cv2.data.haarcascades if hasattr(cv2, 'data') else ''
+    return os.path.join(data_dir, 'haarcascade_frontalface_default.xml')
+
+
+def _downscaled_gray(image_array, max_side):
+    """Grayscale copy with the long side at most `max_side`, and the scale used"""
+    gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+    height, width = gray.shape
+    scale = min(1.0, max_side / max(height, width))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+_DETECTOR_FACTORIES = {
+    'hog': lambda: detect_hog,
+    'cnn': lambda: detect_cnn,
+    'haar': HaarDetector,
+    'dnn': DnnDetector,
+    'cascade': CascadeDetector,
+}
+_detectors = {}
+
+
+def get_detector(name):
+    """
+    Return the (cached) detector callable for `name`
+
+    Raises:
+        ValueError: unknown detector name
+    """
+    if name not in _DETECTOR_FACTORIES:
+        raise ValueError(f"Unknown face detector: {name}. Use one of: {', '.join(_DETECTOR_FACTORIES)}")
+    if name not in _detectors:
+        _detectors[name] = _DETECTOR_FACTORIES[name]()
+    return _detectors[name]
+
+
+def detector_names():
+    return list(_DETECTOR_FACTORIES)
@@ -0,0 +1,184 @@
+"""
+Measure face key (face_keys.py) verify accuracy and bucket hit rates
+
+One encoding per identity is enrolled (its key indexed into buckets), every
+other encoding of that identity is a genuine probe. Reports, per number of
+multi-probe flips:
+
+  * hit rate: genuine probes whose identity is among the bucket candidates
+  * recall at tolerance: the same, counting only probes within `tolerance`
+    of the enrolled encoding (the ones an exact re-check would accept)
+  * candidates: mean candidates per probe, as a count and a fraction of
+    the enrolled identities (the exact distance re-checks left to do)
+
+and for verify against a stored key, FAR / FRR of key_distance <= tolerance
+next to those of the exact distance.
+
+    python evaluate_face_keys.py --synthetic 20000
+    python evaluate_face_keys.py --images ../faces_labeled --profile accurate
+
+--synthetic draws identities around a shared mean with per-capture noise,
+scaled so genuine distances are about 0.4 and impostor distances about 0.9
+(typical of dlib encodings); use --images for numbers on real faces.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from face_keys import BAND_BITS, BANDS, KEY_BITS, face_buckets, face_key, probe_buckets, project
+from evaluate_tolerance import ENCODING_DIM, load_or_encode
+
+
+def synthetic_encodings(identities, captures=3, seed=0, genuine=0.4, impostor=0.9):
+    """
+    `captures` noisy encodings of each of `identities` random faces
+
+    Returns:
+        (encodings, labels): (identities * captures, 128) float32 and (N,) int labels
+    """
+    rng = np.random.default_rng(seed)
+    mean = rng.normal(0, 0.06, ENCODING_DIM)
+    # E|a - b| ~ sigma * sqrt(2 * 128) for independent Gaussian offsets
+    centers = mean + rng.normal(0, impostor / np.sqrt(2 * ENCODING_DIM), (identities, ENCODING_DIM))
+    noise = rng.normal(0, genuine / np.sqrt(2 * ENCODING_DIM), (identities, captures, ENCODING_DIM))
+    encodings = (centers[:, None, :] + noise).reshape(-1, ENCODING_DIM).astype(np.float32)
+    return encodings, np.repeat(np.arange(identities), captures)
+
+
+def split_enrolled(labels):
+    """(enrolled, probes): the first encoding of each identity and the rest"""
+    _, first = np.unique(labels, return_index=True)
+    is_enrolled = np.zeros(len(labels), dtype=bool)
+    is_enrolled[first] = True
+    return np.nonzero(is_enrolled)[0], np.nonzero(~is_enrolled)[0]
+
+
+def build_index(encodings, seed=0):
+    """{bucket: [row, ...]} of the keys of `encodings`"""
+    index = {}
+    for row, encoding in enumerate(encodings):
+        for bucket in face_buckets(face_key(encoding, seed)):
+            index.setdefault(bucket, []).append(row)
+    return index
+
+
+def lookup_stats(encodings, labels, probes_list, tolerance, seed=0):
+    """
+    Bucket hit rates for each multi-probe setting in `probes_list`
+
+    Returns:
+        list of dicts: probes, hit_rate, recall, candidates, candidate_fraction, seconds
+    """
+    enrolled, probe_rows = split_enrolled(labels)
+    index = build_index(encodings[enrolled], seed)
+    enrolled_row = {label: row for row, label in enumerate(labels[enrolled].tolist())}
+
+    targets = np.array([enrolled_row[label] for label in labels[probe_rows].tolist()])
+    diff = encodings[probe_rows] - encodings[enrolled][targets]
+    within = np.sqrt(np.einsum('ij,ij->i', diff, diff)) <= tolerance
+
+    results = []
+    for probes in probes_list:
+        start = time.perf_counter()
+        hits = np.zeros(len(probe_rows), dtype=bool)
+        candidate_total = 0
+        for i, row in enumerate(probe_rows.tolist()):
+            candidates = set()
+            for bucket in probe_buckets(encodings[row], probes, seed):
+                candidates.update(index.get(bucket, ()))
+            hits[i] = targets[i] in candidates
+            candidate_total += len(candidates)
+        elapsed = time.perf_counter() - start
+        mean_candidates = candidate_total / max(len(probe_rows), 1)
+        results.append({
+            'probes': probes,
+            'hit_rate': float(hits.mean()) if len(hits) else 0.0,
+            'recall': float(hits[within].mean()) if within.any() else 0.0,
+            'candidates': mean_candidates,
+            'candidate_fraction': mean_candidates / max(len(enrolled), 1),
+            'seconds': elapsed,
+        })
+    return results
+
+
+def verify_rates(encodings, labels, tolerance, impostor_pairs=200_000, seed=0):
+    """
+    FAR / FRR of the exact distance and of the key estimate at `tolerance`
+
+    Genuine pairs are (enrolled, probe) of one identity; impostor pairs are
+    random (enrolled, probe) pairs of different identities.
+
+    Returns:
+        dict with exact_far, exact_frr, key_far, key_frr
+    """
+    enrolled, probe_rows = split_enrolled(labels)
+    enrolled_of = dict(zip(labels[enrolled].tolist(), enrolled.tolist()))
+    genuine_a = np.array([enrolled_of[label] for label in labels[probe_rows].tolist()], dtype=np.int64)
+    genuine_b = probe_rows
+
+    rng = np.random.default_rng(seed)
+    impostor_a = rng.choice(enrolled, impostor_pairs)
+    impostor_b = rng.choice(len(labels), impostor_pairs)
+    keep = labels[impostor_a] != labels[impostor_b]
+    impostor_a, impostor_b = impostor_a[keep], impostor_b[keep]
+
+    bits = project(encodings, seed) > 0
+    norms = np.linalg.norm(encodings.astype(np.float64), axis=1)
+
+    def rates(a, b):
+        diff = encodings[a] - encodings[b]
+        exact = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        angle = np.pi * np.count_nonzero(bits[a] != bits[b], axis=1) / KEY_BITS
+        estimate = 2 * norms[b] * np.sin(angle / 2)
+        return exact <= tolerance, estimate <= tolerance
+
+    genuine_exact, genuine_key = rates(genuine_a, genuine_b)
+    impostor_exact, impostor_key = rates(impostor_a, impostor_b)
+    return {
+        'exact_far': float(impostor_exact.mean()), 'exact_frr': 1 - float(genuine_exact.mean()),
+        'key_far': float(impostor_key.mean()), 'key_frr': 1 - float(genuine_key.mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face key verify accuracy and bucket hit rates")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help='directory with one sub-directory of photos per identity')
+    source.add_argument('--synthetic', type=int, metavar='IDENTITIES', help='use random synthetic identities')
+    parser.add_argument('--captures', type=int, default=3, help='synthetic encodings per identity')
+    parser.add_argument('--profile', help='encoding profile (see detectors.PROFILES)')
+    parser.add_argument('--cache', help='encoding cache file (default: face_eval_<profile>.npz)')
+    parser.add_argument('--workers', type=int, help='encoding processes (default: CPU count)')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--probes', type=int, nargs='*', default=[0, 1, 2, 4],
+                        help='multi-probe bit flips per band to evaluate')
+    parser.add_argument('--seed', type=int, default=0, help='projection and sampling seed')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        encodings, labels = synthetic_encodings(args.synthetic, args.captures, args.seed)
+    else:
+        cache_path = args.cache or f"face_eval_{args.profile or 'default'}.npz"
+        encodings, labels, _ = load_or_encode(args.images, cache_path, args.profile, args.workers)
+    identities = len(np.unique(labels))
+    print(f"{len(encodings)} encodings of {identities} identities; "
+          f"{KEY_BITS}-bit keys, {BANDS} bands of {BAND_BITS} bits\n")
+    if identities < 2 or len(encodings) == identities:
+        parser.error("need at least two identities and one with two encodings")
+
+    rates = verify_rates(encodings, labels, args.tolerance, seed=args.seed)
+    print(f"Verify at tolerance {args.tolerance}:")
+    print(f"  exact distance  FAR {rates['exact_far']:8.3%}  FRR {rates['exact_frr']:8.3%}")
+    print(f"  key estimate    FAR {rates['key_far']:8.3%}  FRR {rates['key_frr']:8.3%}\n")
+
+    print(f"{'probes':>6}  {'lookups':>7}  {'hit rate':>8}  {'recall':>8}  {'candidates':>10}  {'fraction':>8}  {'us/probe':>8}")
+    _, probe_rows = split_enrolled(labels)
+    for result in lookup_stats(encodings, labels, args.probes, args.tolerance, args.seed):
+        print(f"{result['probes']:6d}  {BANDS * (1 + result['probes']):7d}  {result['hit_rate']:8.2%}  "
+              f"{result['recall']:8.2%}  {result['candidates']:10.1f}  {result['candidate_fraction']:8.3%}  "
+              f"{result['seconds'] / len(probe_rows) * 1e6:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
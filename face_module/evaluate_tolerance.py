@@ -0,0 +1,327 @@
+"""
+Calibrate the verify tolerance on a labeled face set
+
+Encodes a labeled image directory once (one sub-directory per identity),
+caches the encodings, then computes genuine (same identity) and impostor
+(different identity) distance distributions and reports FAR / FRR across
+tolerances, the equal error rate and the tolerance for target FARs.
+
+    python evaluate_tolerance.py --images ../faces_labeled
+    python evaluate_tolerance.py --images ../faces_labeled --profile accurate --csv curve.csv
+    python evaluate_tolerance.py --images ../faces_labeled --impostor-pairs 0   # all pairs
+
+    faces_labeled/
+        alice/1.jpg
+        alice/2.jpg
+        bob/1.jpg
+        ...
+
+A match in verify is `distance <= tolerance`, so at tolerance t:
+
+    FAR(t) = impostor pairs with distance <= t / impostor pairs
+    FRR(t) = genuine pairs with distance > t  / genuine pairs
+
+Distances are accumulated into fixed-width histograms, so every tolerance is
+answered from cumulative sums. All genuine pairs are used. Impostor pairs
+grow with the square of the set size, so by default about 20 million are
+sampled (--impostor-pairs) as random row-block x row-block comparisons, one
+matrix product each; --impostor-pairs 0 compares all of them.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+ENCODING_DIM = 128
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Histogram resolution: face distances fall in [0, ~1.4) for unit-norm-ish
+# dlib encodings; anything above MAX_DISTANCE lands in the last bin.
+BIN_WIDTH = 0.001
+MAX_DISTANCE = 1.5
+
+
+def scan_labeled_images(directory):
+    """
+    List (relative_path, identity) for images in per-identity sub-directories
+
+    Identities with a single image still contribute impostor pairs.
+    """
+    items = []
+    for identity in sorted(os.listdir(directory)):
+        identity_dir = os.path.join(directory, identity)
+        if not os.path.isdir(identity_dir):
+            continue
+        for name in sorted(os.listdir(identity_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                items.append((os.path.join(identity, name), identity))
+    return items
+
+
+def _encode_file(path, profile):
+    from face_utils import encode_face
+    with open(path, 'rb') as f:
+        encoding = encode_face(f.read(), profile=profile)
+    return None if encoding is None else np.asarray(encoding, dtype=np.float32)
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def load_or_encode(directory, cache_path, profile=None, workers=None):
+    """
+    Encode every labeled image, reusing cached encodings of unchanged files
+
+    Returns:
+        (encodings, labels, paths): (N, 128) float32 array of images in
+        which a face was found, their identity labels and relative paths
+    """
+    items = scan_labeled_images(directory)
+    keys = [_file_key(os.path.join(directory, path)) for path, _ in items]
+
+    cached = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if str(cache['profile']) == str(profile or ''):
+                for path, key, row in zip(cache['paths'], cache['keys'], cache['encodings']):
+                    cached[(str(path), str(key))] = row
+
+    todo = [i for i, ((path, _), key) in enumerate(zip(items, keys)) if (path, key) not in cached]
+    if todo:
+        print(f"Encoding {len(todo)} of {len(items)} images ({len(items) - len(todo)} cached)...")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            paths = [os.path.join(directory, items[i][0]) for i in todo]
+            results = pool.map(_encode_file, paths, [profile] * len(paths), chunksize=8)
+            for i, encoding in zip(todo, results):
+                # NaN rows record "no face found" so the image is not re-encoded
+                cached[(items[i][0], keys[i])] = (
+                    encoding if encoding is not None else np.full(ENCODING_DIM, np.nan, np.float32)
+                )
+        print(f"  done in {time.perf_counter() - start:.1f}s")
+
+        all_rows = np.stack([cached[(path, key)] for (path, _), key in zip(items, keys)])
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, paths=np.array([p for p, _ in items]), keys=np.array(keys),
+                 encodings=all_rows, profile=np.array(profile or ''))
+        os.replace(tmp_path, cache_path)
+
+    rows = [cached[(path, key)] for (path, _), key in zip(items, keys)]
+    found = [i for i, row in enumerate(rows) if not np.isnan(row[0])]
+    missed = len(items) - len(found)
+    if missed:
+        print(f"No face found in {missed} images (excluded)")
+    encodings = np.stack([rows[i] for i in found]) if found else np.empty((0, ENCODING_DIM), np.float32)
+    labels = np.array([items[i][1] for i in found])
+    paths = [items[i][0] for i in found]
+    return encodings, labels, paths
+
+
+def _bin_count():
+    return int(round(MAX_DISTANCE / BIN_WIDTH))
+
+
+def distance_histogram(distances, out=None):
+    """Add `distances` to a fixed-width histogram (np.bincount is much faster than np.histogram)"""
+    bins = _bin_count()
+    if out is None:
+        out = np.zeros(bins, dtype=np.int64)
+    index = np.minimum((distances / BIN_WIDTH).astype(np.int64), bins - 1)
+    out += np.bincount(index, minlength=bins)
+    return out
+
+
+def _pair_distances(encodings, a, b, chunk_size=1_000_000):
+    """Euclidean distances for index pairs, computed in chunks to bound memory"""
+    out = np.empty(len(a), dtype=np.float32)
+    for start in range(0, len(a), chunk_size):
+        end = start + chunk_size
+        diff = encodings[a[start:end]] - encodings[b[start:end]]
+        out[start:end] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    return out
+
+
+def genuine_pairs(labels):
+    """
+    All index pairs (a, b), a < b, with the same label
+
+    Identities are grouped by image count, so pairs are generated with one
+    triu_indices per distinct group size rather than per identity.
+    """
+    order = np.argsort(labels, kind='stable')
+    _, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+
+    pairs_a, pairs_b = [], []
+    for size in np.unique(sizes):
+        if size < 2:
+            continue
+        offsets = starts[sizes == size]
+        upper_a, upper_b = np.triu_indices(size, k=1)
+        pairs_a.append(order[(offsets[:, None] + upper_a).ravel()])
+        pairs_b.append(order[(offsets[:, None] + upper_b).ravel()])
+    if not pairs_a:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def _block_histogram(left, right, left_codes, right_codes, histogram, upper_only=False):
+    """
+    Add distances between rows of `left` and `right` with different codes
+
+    Squared distances use |a|^2 + |b|^2 - 2 a.b: one matrix product per block.
+    """
+    dist2 = (left * np.float32(-2)) @ right.T
+    dist2 += np.einsum('ij,ij->i', left, left)[:, None]
+    dist2 += np.einsum('ij,ij->i', right, right)
+    mask = left_codes[:, None] != right_codes
+    if upper_only:
+        mask &= np.triu(np.ones(mask.shape, dtype=bool), k=1)
+    distance_histogram(np.sqrt(np.maximum(dist2[mask], 0)), histogram)
+
+
+def sample_impostor_histogram(encodings, codes, pairs, rng, block_size=4096):
+    """
+    Histogram of about `pairs` impostor distances
+
+    Each round compares a random set of rows with an independent random set
+    of rows, so every impostor pair is equally likely and the distances come
+    from one matrix product instead of per-pair row gathers.
+    """
+    histogram = np.zeros(_bin_count(), dtype=np.int64)
+    n = len(encodings)
+    size = min(block_size, n)
+    while histogram.sum() < pairs:
+        rows = rng.choice(n, size=size, replace=False)
+        cols = rng.choice(n, size=size, replace=False)
+        before = histogram.sum()
+        _block_histogram(encodings[rows], encodings[cols], codes[rows], codes[cols], histogram)
+        if histogram.sum() == before:
+            break  # a single identity: no impostor pairs exist
+    return histogram
+
+
+def all_impostor_histogram(encodings, codes, block_size=4096):
+    """Histogram of every impostor distance"""
+    histogram = np.zeros(_bin_count(), dtype=np.int64)
+    n = len(encodings)
+    for start in range(0, n, block_size):
+        left = encodings[start:start + block_size]
+        for other in range(start, n, block_size):
+            _block_histogram(
+                left, encodings[other:other + block_size],
+                codes[start:start + block_size], codes[other:other + block_size],
+                histogram, upper_only=other == start
+            )
+    return histogram
+
+
+def error_rates(genuine_histogram, impostor_histogram):
+    """
+    FAR and FRR at every bin edge
+
+    Returns:
+        (tolerances, far, frr): tolerance t covers distances in bins below t
+    """
+    tolerances = np.arange(1, len(genuine_histogram) + 1) * BIN_WIDTH
+    genuine_total = max(int(genuine_histogram.sum()), 1)
+    impostor_total = max(int(impostor_histogram.sum()), 1)
+    far = np.cumsum(impostor_histogram) / impostor_total
+    frr = 1.0 - np.cumsum(genuine_histogram) / genuine_total
+    return tolerances, far, frr
+
+
+def equal_error_rate(tolerances, far, frr):
+    """(eer, tolerance) at the bin where FAR and FRR are closest"""
+    i = int(np.argmin(np.abs(far - frr)))
+    return (far[i] + frr[i]) / 2, tolerances[i]
+
+
+def tolerance_for_far(tolerances, far, target):
+    """Largest tolerance whose FAR does not exceed `target` (None if none does)"""
+    ok = np.nonzero(far <= target)[0]
+    return tolerances[ok[-1]] if len(ok) else None
+
+
+def evaluate(encodings, labels, impostor_pairs=20_000_000, seed=0, block_size=4096):
+    """
+    Genuine and impostor distance histograms for a labeled encoding set
+
+    Args:
+        encodings: (N, 128) float32 array
+        labels: (N,) identity labels
+        impostor_pairs: sampled impostor pairs, 0 for all of them
+        seed: sampling seed
+
+    Returns:
+        (genuine_histogram, impostor_histogram)
+    """
+    encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+
+    a, b = genuine_pairs(codes)
+    genuine = distance_histogram(_pair_distances(encodings, a, b))
+
+    if impostor_pairs:
+        rng = np.random.default_rng(seed)
+        impostor = sample_impostor_histogram(encodings, codes, impostor_pairs, rng, block_size)
+    else:
+        impostor = all_impostor_histogram(encodings, codes, block_size)
+    return genuine, impostor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAR/FRR/EER of face verification across tolerances")
+    parser.add_argument('--images', required=True, help='directory with one sub-directory of photos per identity')
+    parser.add_argument('--profile', help='encoding profile (see detectors.PROFILES)')
+    parser.add_argument('--cache', help='encoding cache file (default: face_eval_<profile>.npz)')
+    parser.add_argument('--workers', type=int, help='encoding processes (default: CPU count)')
+    parser.add_argument('--impostor-pairs', type=int, default=20_000_000,
+                        help='impostor pairs to sample; 0 compares all of them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--far', type=float, nargs='*', default=[1e-2, 1e-3, 1e-4],
+                        help='target FARs to report a tolerance for')
+    parser.add_argument('--csv', help='write the full tolerance,far,frr curve to this file')
+    args = parser.parse_args()
+
+    cache_path = args.cache or f"face_eval_{args.profile or 'default'}.npz"
+    encodings, labels, _ = load_or_encode(args.images, cache_path, args.profile, args.workers)
+    identities = len(np.unique(labels))
+    print(f"{len(encodings)} encodings of {identities} identities")
+    if identities < 2:
+        parser.error("need at least two identities")
+
+    start = time.perf_counter()
+    genuine, impostor = evaluate(encodings, labels, args.impostor_pairs, args.seed)
+    print(f"{genuine.sum()} genuine and {impostor.sum()} impostor pairs "
+          f"in {time.perf_counter() - start:.1f}s\n")
+    if not genuine.sum():
+        parser.error("no identity has two images with a face; FRR is undefined")
+
+    tolerances, far, frr = error_rates(genuine, impostor)
+    print(f"{'tolerance':>9}  {'FAR':>9}  {'FRR':>9}")
+    for tolerance in np.arange(0.30, 0.801, 0.05):
+        i = int(round(tolerance / BIN_WIDTH)) - 1
+        print(f"{tolerance:9.2f}  {far[i]:9.3%}  {frr[i]:9.3%}")
+
+    eer, eer_tolerance = equal_error_rate(tolerances, far, frr)
+    print(f"\nEER {eer:.3%} at tolerance {eer_tolerance:.3f}")
+    for target in args.far:
+        tolerance = tolerance_for_far(tolerances, far, target)
+        if tolerance is None:
+            print(f"FAR <= {target:g}: not reachable")
+        else:
+            i = int(round(tolerance / BIN_WIDTH)) - 1
+            print(f"FAR <= {target:g}: tolerance {tolerance:.3f} (FRR {frr[i]:.3%})")
+
+    if args.csv:
+        np.savetxt(args.csv, np.column_stack([tolerances, far, frr]), delimiter=',',
+                   header='tolerance,far,frr', comments='', fmt=['%.3f', '%.8f', '%.8f'])
+        print(f"\nCurve written to {args.csv}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Locality-sensitive face keys (signed random projections)
+
+A SHA-256 of an encoding's float bytes changes with every capture, so it
+can only recognise the exact same encoding. A face key keeps the sign of
+the encoding's projection on KEY_BITS fixed random directions: two
+encodings at angle theta disagree on each bit with probability theta / pi,
+so captures of the same face give keys a few bits apart and the Hamming
+distance between keys estimates the distance between the encodings.
+
+    key = face_key(encoding)                        # 64 hex chars, like SHA-256
+    key_distance(encoding, key) <= tolerance        # verify against a stored key
+    face_buckets(key)                               # index a key
+    probe_buckets(encoding, probes=1)               # look candidates up
+
+For candidate lookups the key is cut into BANDS bands of BAND_BITS bits;
+each band value is a bucket ('03:a1f2'). Two encodings share a bucket when
+they agree on every bit of some band. Multi-probe lookups also try, in each
+band, the buckets reached by flipping the bits whose projections were
+closest to zero: those are the bits another capture is most likely to get
+wrong. evaluate_face_keys.py measures hit and candidate rates.
+
+The projections are drawn from a seeded generator. Keys made with
+different seeds are unrelated; use a private seed when keys are published
+(e.g. stored on a blockchain), since a key made with a known seed reveals
+the rough direction of the encoding.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+ENCODING_DIM = 128
+KEY_BITS = 256
+BAND_BITS = 16
+BANDS = KEY_BITS // BAND_BITS
+DEFAULT_SEED = 0
+
+
+@lru_cache(maxsize=8)
+def projections(seed=DEFAULT_SEED):
+    """(ENCODING_DIM, KEY_BITS) float64 matrix of Gaussian random directions for `seed`"""
+    matrix = np.random.default_rng(seed).standard_normal((ENCODING_DIM, KEY_BITS))
+    matrix.setflags(write=False)
+    return matrix
+
+
+def project(encoding, seed=DEFAULT_SEED):
+    """Projections of one encoding (KEY_BITS,) or of a (N, 128) array (N, KEY_BITS)"""
+    return np.asarray(encoding, dtype=np.float64) @ projections(seed)
+
+
+def _pack(bits):
+    return np.packbits(bits, axis=-1)
+
+
+def face_key(encoding, seed=DEFAULT_SEED):
+    """
+    Face key of an encoding
+
+    Returns:
+        str: KEY_BITS / 4 hex characters, or None for an invalid encoding
+    """
+    try:
+        values = project(encoding, seed)
+    except (TypeError, ValueError):
+        return None
+    if values.shape != (KEY_BITS,) or not np.isfinite(values).all():
+        return None
+    return _pack(values > 0).tobytes().hex()
+
+
+def key_bits(key):
+    """The KEY_BITS bits of a key as a bool array, or None if `key` is not a face key"""
+    if not isinstance(key, str) or len(key) != KEY_BITS // 4:
+        return None
+    try:
+        raw = bytes.fromhex(key)
+    except ValueError:
+        return None
+    return np.unpackbits(np.frombuffer(raw, dtype=np.uint8)).astype(bool)
+
+
+def key_angle(key_a, key_b):
+    """Estimated angle (radians) between the encodings behind two keys; None if either is invalid"""
+    bits_a, bits_b = key_bits(key_a), key_bits(key_b)
+    if bits_a is None or bits_b is None:
+        return None
+    return np.pi * np.count_nonzero(bits_a != bits_b) / KEY_BITS
+
+
+def key_distance(encoding, key, seed=DEFAULT_SEED):
+    """
+    Estimated face distance between `encoding` and the encoding behind `key`
+
+    The angle comes from the Hamming distance of the keys; both encodings
+    are taken to be as long as `encoding` (captures of one face differ
+    little in length), so distance = 2 |encoding| sin(angle / 2).
+
+    Returns:
+        float, or None if `key` is not a face key or `encoding` is invalid
+    """
+    current = face_key(encoding, seed)
+    angle = key_angle(current, key) if current is not None else None
+    if angle is None:
+        return None
+    return float(2 * np.linalg.norm(np.asarray(encoding, dtype=np.float64)) * np.sin(angle / 2))
+
+
+def _bucket(band, bits):
+    value = int.from_bytes(_pack(bits).tobytes(), 'big')
+    return f'{band:02d}:{value:0{BAND_BITS // 4}x}'
+
+
+def face_buckets(key):
+    """The BANDS bucket names of a key (empty if `key` is not a face key)"""
+    bits = key_bits(key)
+    if bits is None:
+        return []
+    return [_bucket(band, bits[band * BAND_BITS:(band + 1) * BAND_BITS]) for band in range(BANDS)]
+
+
+def probe_buckets(encoding, probes=0, seed=DEFAULT_SEED):
+    """
+    Buckets to look an encoding up in: its own BANDS buckets, plus for every
+    band the `probes` buckets one bit flip away, flipping the bits with the
+    smallest projection margins first
+
+    Returns:
+        list of bucket names, own buckets first; empty for an invalid encoding
+    """
+    key = face_key(encoding, seed)
+    if key is None:
+        return []
+    values = project(encoding, seed)
+    buckets = face_buckets(key)
+    probes = max(0, min(probes, BAND_BITS))
+    if not probes:
+        return buckets
+    for band in range(BANDS):
+        band_values = values[band * BAND_BITS:(band + 1) * BAND_BITS]
+        bits = band_values > 0
+        for bit in np.argsort(np.abs(band_values))[:probes]:
+            flipped = bits.copy()
+            flipped[bit] = not flipped[bit]
+            buckets.append(_bucket(band, flipped))
+    return buckets
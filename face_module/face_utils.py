@@ -1,62 +1,337 @@
 """
 Face recognition utilities for encoding, hashing, and verification
 """
+import logging
+
+logger = logging.getLogger(__name__)
+
 try:
     import face_recognition
     FACE_RECOGNITION_AVAILABLE = True
 except ImportError:
     FACE_RECOGNITION_AVAILABLE = False
-    print("Warning: face_recognition not installed. Install with: pip install face_recognition")
+    logger.warning("face_recognition not installed. Install with: pip install face_recognition")
 
 import numpy as np
 import hashlib
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import cv2
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
 
+try:
+    from .detectors import detect_in_regions, get_detector, get_profile
+    from .face_keys import DEFAULT_SEED, key_distance
+except ImportError:  # imported as a top-level module (face_module on sys.path)
+    from detectors import detect_in_regions, get_detector, get_profile
+    from face_keys import DEFAULT_SEED, key_distance
+
 
-def encode_face(image_bytes):
+# Margin around a client face hint searched for the face, as a fraction of its size
+FACE_HINT_PADDING = 0.3
+
+
+class FaceEncodingError(Exception):
     """
-    Encode a face from image bytes into a 128-dimensional face encoding
+    Why an image produced no encoding
+
+    code is 'invalid_image', 'no_face' or 'encoding_failed'
+    """
+
+    def __init__(self, code, message):
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def encode_face_or_raise(image_bytes, timings=None, profile=None, face_hint=None):
+    """
+    encode_face that raises FaceEncodingError instead of returning None
     
     Args:
         image_bytes: Raw image bytes
+        timings: Optional dict, filled with the seconds spent in the
+            'image_decode', 'hint_detection', 'detection' and 'encoding' stages
+        profile: Encoding profile name ('fast', 'default', 'accurate'),
+            selecting detector, landmark model and num_jitters
+        face_hint: Optional (top, right, bottom, left) face box from the
+            client; checked with HOG on a padded crop around it, and full
+            detection runs only if no face is found there
         
     Returns:
-        numpy array: 128-dimensional face encoding or None if no face found
+        numpy array: 128-dimensional face encoding
+    
+    Raises:
+        FaceEncodingError: undecodable image, no face, or model failure
+        ValueError: unknown profile
     """
     if not FACE_RECOGNITION_AVAILABLE:
-        print("Error: face_recognition not available")
-        return None
+        raise FaceEncodingError('encoding_failed', 'face_recognition not available')
     
+    if timings is None:
+        timings = {}
+    options = get_profile(profile)
+    
+    start = time.perf_counter()
     try:
-        # Convert bytes to PIL Image
+        # Convert bytes to PIL Image, RGB (face_recognition expects RGB)
         image = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert PIL to RGB (face_recognition expects RGB)
-        rgb_image = image.convert('RGB')
-        
-        # Convert to numpy array
-        image_array = np.array(rgb_image)
-        
-        # Find face locations
-        face_locations = face_recognition.face_locations(image_array)
+        image_array = np.array(image.convert('RGB'))
+    except UnidentifiedImageError:
+        raise FaceEncodingError('invalid_image', 'Cannot decode image: unknown or corrupt image format')
+    except Exception as e:
+        raise FaceEncodingError('invalid_image', f'Cannot decode image: {e}')
+    decoded = time.perf_counter()
+    timings['image_decode'] = decoded - start
+    
+    try:
+        # Find face locations: around the client's hint first, if any
+        face_locations = []
+        searched = decoded
+        if face_hint is not None:
+            face_locations = detect_in_regions(image_array, [face_hint], FACE_HINT_PADDING)
+            searched = time.perf_counter()
+            timings['hint_detection'] = searched - decoded
+        if not face_locations:
+            face_locations = get_detector(options['detector'])(image_array)
+            timings['detection'] = time.perf_counter() - searched
+        detected = time.perf_counter()
         
         if not face_locations:
-            return None
+            raise FaceEncodingError('no_face', 'No face detected in image')
         
         # Get face encodings (128-dimensional vectors)
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_encodings = face_recognition.face_encodings(
+            image_array, face_locations[:1],
+            num_jitters=options['num_jitters'], model=options['model']
+        )
+        timings['encoding'] = time.perf_counter() - detected
+    except FaceEncodingError:
+        raise
+    except Exception as e:
+        raise FaceEncodingError('encoding_failed', f'Face encoding failed: {e}')
+    
+    if not face_encodings:
+        raise FaceEncodingError('no_face', 'No face detected in image')
+    
+    # Return the first face encoding
+    return face_encodings[0]
+
+
+def encode_face(image_bytes, timings=None, profile=None, face_hint=None):
+    """
+    Encode a face from image bytes into a 128-dimensional face encoding
+    
+    Args:
+        image_bytes: Raw image bytes
+        timings: Optional dict, filled with the seconds spent in the
+            'image_decode', 'hint_detection', 'detection' and 'encoding' stages
+        profile: Encoding profile name ('fast', 'default', 'accurate'),
+            selecting detector, landmark model and num_jitters
+        face_hint: Optional (top, right, bottom, left) face box from the client
         
-        if not face_encodings:
-            return None
+    Returns:
+        numpy array: 128-dimensional face encoding or None if no face found
+    """
+    try:
+        return encode_face_or_raise(image_bytes, timings=timings, profile=profile, face_hint=face_hint)
+    except FaceEncodingError as e:
+        if e.code != 'no_face':
+            logger.error("Error encoding face: %s", e)
+        return None
+
+
+def preload_models(profile=None):
+    """
+    Load and warm up the models of an encoding profile in this process
+    
+    Meant for a server's master process before it forks workers: the dlib
+    models (loaded when face_recognition is imported) and the buffers dlib
+    allocates on first use then live in pages the workers share
+    copy-on-write, instead of every worker building its own copy. Runs the
+    profile's detector and one encoding on a synthetic image.
+    
+    Args:
+        profile: Encoding profile name (see detectors.PROFILES)
         
-        # Return the first face encoding
-        return face_encodings[0]
+    Returns:
+        dict: seconds spent in 'detection' and 'encoding', or None when
+        face_recognition is not installed
+    """
+    if not FACE_RECOGNITION_AVAILABLE:
+        logger.warning("face_recognition not available, nothing to preload")
+        return None
+    options = get_profile(profile)
+    
+    # Smooth gradient: decodes like a photo, contains no face
+    ramp = np.linspace(0, 255, 160)
+    gray = (np.add.outer(ramp, ramp) / 2).astype(np.uint8)
+    image_array = np.dstack([gray] * 3)
+    
+    timings = {}
+    start = time.perf_counter()
+    get_detector(options['detector'])(image_array)
+    detected = time.perf_counter()
+    timings['detection'] = detected - start
+    face_recognition.face_encodings(
+        image_array, [(16, 144, 144, 16)], num_jitters=1, model=options['model']
+    )
+    timings['encoding'] = time.perf_counter() - detected
+    return timings
+
+
+def stub_encode_face(image_bytes, timings=None, profile=None, face_hint=None):
+    """
+    Deterministic stand-in for encode_face, used to measure everything but
+    the face model under load. The same bytes always give the same encoding.
+    
+    Args:
+        image_bytes: Raw image bytes (not decoded)
+        timings, profile, face_hint: Accepted for signature compatibility, ignored
         
-    except Exception as e:
-        print(f"Error encoding face: {e}")
+    Returns:
+        numpy array: 128-dimensional pseudo encoding, or None for empty input
+    """
+    if not image_bytes:
         return None
+    seed = int.from_bytes(hashlib.sha256(image_bytes).digest()[:8], 'little')
+    return np.random.default_rng(seed).normal(0.0, 0.1, 128)
+
+
+ENCODERS = {
+    'face_recognition': encode_face,
+    'stub': stub_encode_face,
+}
+
+
+def get_encoder(name):
+    """
+    Look up an encoder function by name ('face_recognition' or 'stub')
+    
+    Raises:
+        ValueError: unknown encoder name
+    """
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown face encoder: {name}. Use one of: {', '.join(ENCODERS)}")
+
+
+def encode_face_timed(image_bytes, encoder='face_recognition', profile=None, face_hint=None):
+    """
+    encode_face for executors: returns (face_encoding, timings) so stage
+    timings measured in a worker process reach the caller
+    """
+    timings = {}
+    encoding = get_encoder(encoder)(image_bytes, timings=timings, profile=profile, face_hint=face_hint)
+    return encoding, timings
+
+
+def _stub_encode_or_raise(image_bytes, timings=None, profile=None, face_hint=None):
+    encoding = stub_encode_face(image_bytes, timings=timings, profile=profile)
+    if encoding is None:
+        raise FaceEncodingError('invalid_image', 'Empty image')
+    return encoding
+
+
+STRICT_ENCODERS = {
+    'face_recognition': encode_face_or_raise,
+    'stub': _stub_encode_or_raise,
+}
+
+
+class BatchResult(namedtuple('BatchResult', 'index encoding error timings')):
+    """
+    One encode_faces_batch result: `encoding` is None exactly when `error`
+    (a FaceEncodingError) is set; `timings` holds the stage seconds
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _encode_chunk(chunk, encoder, profile):
+    """Process-pool task: encode a list of (index, image_bytes)"""
+    encode = STRICT_ENCODERS[encoder]
+    results = []
+    for index, image_bytes in chunk:
+        timings = {}
+        try:
+            encoding = encode(image_bytes, timings=timings, profile=profile)
+            results.append(BatchResult(index, encoding, None, timings))
+        except FaceEncodingError as e:
+            results.append(BatchResult(index, None, e, timings))
+        except Exception as e:
+            results.append(BatchResult(index, None, FaceEncodingError('encoding_failed', str(e)), timings))
+    return results
+
+
+def _chunks(images, chunk_size):
+    chunk = []
+    for item in enumerate(images):
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_faces_batch(images, workers=None, encoder='face_recognition', profile=None,
+                       chunk_size=4, executor=None, window=None):
+    """
+    Encode many images on a process pool, streaming results in input order
+    
+    Images are dispatched in chunks of `chunk_size` (one pickling round trip
+    per chunk rather than per image). At most `window` chunks are in flight,
+    so `images` may be a lazy iterable of any length and memory stays bounded.
+    
+    Args:
+        images: iterable of raw image bytes
+        workers: pool size (default: CPU count); 1 encodes in this process
+        encoder: 'face_recognition' or 'stub'
+        profile: encoding profile name (see detectors.PROFILES)
+        chunk_size: images per pool task
+        executor: existing ProcessPoolExecutor to use instead of a new one
+        window: chunks in flight (default: 2 per worker)
+    
+    Yields:
+        BatchResult(index, encoding, error, timings) per image, in input order
+    """
+    get_encoder(encoder)
+    get_profile(profile)
+    chunks = _chunks(images, max(1, chunk_size))
+
+    if executor is None and workers == 1:
+        for chunk in chunks:
+            yield from _encode_chunk(chunk, encoder, profile)
+        return
+
+    owned = executor is None
+    if owned:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    window = window or 2 * (getattr(executor, '_max_workers', None) or workers or os.cpu_count() or 1)
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(_encode_chunk, chunk, encoder, profile))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned:
+            executor.shutdown(wait=True, cancel_futures=True)
 
 
 def hash_face_encoding(face_encoding):
@@ -78,33 +353,42 @@ def hash_face_encoding(face_encoding):
         return hash_object.hexdigest()
         
     except Exception as e:
-        print(f"Error hashing face encoding: {e}")
+        logger.error("Error hashing face encoding: %s", e)
         return None
 
 
-def verify_face(current_encoding, stored_hash):
+def verify_face(current_encoding, stored_hash, tolerance=0.6, seed=DEFAULT_SEED):
     """
     Verify if current face encoding matches stored hash
     
+    `stored_hash` is either a face key (face_keys.face_key), matched when the
+    estimated distance is within `tolerance`, or a SHA-256 from
+    hash_face_encoding, which only matches the very same encoding.
+    
     Args:
         current_encoding: numpy array of current face encoding
-        stored_hash: stored hash string
+        stored_hash: stored face key or hash string
+        tolerance: largest estimated face distance accepted for a face key
+        seed: projection seed the face key was made with
         
     Returns:
         bool: True if face matches, False otherwise
     """
     try:
-        # Hash the current encoding
+        # An exact hash match first (hashes stored before face keys)
         current_hash = hash_face_encoding(current_encoding)
         
         if current_hash is None:
             return False
+        if current_hash == stored_hash:
+            return True
         
-        # Compare hashes
-        return current_hash == stored_hash
+        # Compare face keys by estimated distance
+        distance = key_distance(current_encoding, stored_hash, seed)
+        return distance is not None and distance <= tolerance
         
     except Exception as e:
-        print(f"Error verifying face: {e}")
+        logger.error("Error verifying face: %s", e)
         return False
 
 
@@ -126,7 +410,7 @@ def compare_faces(encoding1, encoding2, tolerance=0.6):
         return results[0] if results else False
         
     except Exception as e:
-        print(f"Error comparing faces: {e}")
+        logger.error("Error comparing faces: %s", e)
         return False
 
 
@@ -147,7 +431,7 @@ def get_face_distance(encoding1, encoding2):
         return distances[0] if len(distances) > 0 else float('inf')
         
     except Exception as e:
-        print(f"Error calculating face distance: {e}")
+        logger.error("Error calculating face distance: %s", e)
         return float('inf')
 
 
@@ -172,7 +456,7 @@ def detect_faces_in_image(image_bytes):
         return face_locations
         
     except Exception as e:
-        print(f"Error detecting faces: {e}")
+        logger.error("Error detecting faces: %s", e)
         return []
 
 
@@ -203,5 +487,5 @@ def encode_all_faces(image_bytes):
         return face_encodings
         
     except Exception as e:
-        print(f"Error encoding all faces: {e}")
+        logger.error("Error encoding all faces: %s", e)
         return []
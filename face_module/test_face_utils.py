@@ -7,8 +7,15 @@ import hashlib
 from face_utils import (
     encode_face, hash_face_encoding, verify_face, 
     compare_faces, get_face_distance, detect_faces_in_image,
-    encode_all_faces
+    encode_all_faces, stub_encode_face, get_encoder, encode_faces_batch,
+    preload_models, FACE_RECOGNITION_AVAILABLE
 )
+from detectors import CascadeDetector, detect_hog, get_detector, get_profile
+from evaluate_tolerance import (
+    equal_error_rate, error_rates, evaluate, genuine_pairs, tolerance_for_far
+)
+from face_keys import BANDS, face_buckets, face_key, key_bits, key_distance, probe_buckets
+from evaluate_face_keys import lookup_stats, synthetic_encodings, verify_rates
 
 
 class TestFaceUtils(unittest.TestCase):
@@ -186,6 +193,224 @@ class TestFaceUtilsIntegration(unittest.TestCase):
         result = verify_face(different_encoding, face_hash)
         self.assertFalse(result)
 
+    
+    def test_encode_faces_batch(self):
+        """Test that batch results stream in input order with per-item errors"""
+        images = [b"image-%d" % i for i in range(11)] + [b""]
+        for workers in (1, 2):
+            results = list(encode_faces_batch(iter(images), workers=workers, encoder='stub', chunk_size=3))
+            self.assertEqual([r.index for r in results], list(range(12)))
+            np.testing.assert_array_equal(results[4].encoding, stub_encode_face(b"image-4"))
+            self.assertFalse(results[11].ok)
+            self.assertEqual(results[11].error.code, 'invalid_image')
+        
+        results = list(encode_faces_batch([b"not an image"], workers=1))
+        self.assertIsNone(results[0].encoding)
+        self.assertIn(results[0].error.code, ('invalid_image', 'encoding_failed'))
+    
+    def test_stub_encoder(self):
+        """Test that the load-test stub encoder is deterministic per image"""
+        first = stub_encode_face(b"dummy_image_data")
+        self.assertEqual(first.shape, (128,))
+        np.testing.assert_array_equal(first, stub_encode_face(b"dummy_image_data"))
+        self.assertFalse(compare_faces(first, stub_encode_face(b"other_image_data")))
+        self.assertIsNone(stub_encode_face(b""))
+        self.assertIs(get_encoder('stub'), stub_encode_face)
+        with self.assertRaises(ValueError):
+            get_encoder('unknown')
+
+
+
+class TestDetectors(unittest.TestCase):
+    """Test detector backends and encoding profiles"""
+
+    def test_profiles(self):
+        """Test profile lookup and that every profile names a known detector"""
+        self.assertEqual(get_profile(None), get_profile('default'))
+        self.assertEqual(get_profile('accurate')['model'], 'large')
+        for name in ('fast', 'default', 'accurate'):
+            self.assertTrue(callable(get_detector(get_profile(name)['detector'])))
+        with self.assertRaises(ValueError):
+            get_profile('unknown')
+        with self.assertRaises(ValueError):
+            get_detector('unknown')
+
+    def test_blank_image_has_no_face(self):
+        """Test that detectors find nothing in a blank image"""
+        blank = np.zeros((240, 320, 3), dtype=np.uint8)
+        self.assertEqual(detect_hog(blank), [])
+        self.assertEqual(CascadeDetector(proposer=lambda image: [])(blank), [])
+
+    def test_cascade_maps_crop_coordinates(self):
+        """Test that HOG results on a proposal crop are mapped back to the full image"""
+        import detectors
+        image = np.zeros((400, 400, 3), dtype=np.uint8)
+        seen = []
+
+        def fake_hog(crop):
+            seen.append(crop.shape)
+            return [(10, 90, 90, 10)]
+
+        original = detectors.detect_hog
+        detectors.detect_hog = fake_hog
+        try:
+            locations = CascadeDetector(proposer=lambda image: [(100, 200, 200, 100)], padding=0.5)(image)
+        finally:
+            detectors.detect_hog = original
+        # 100px proposal padded by 50px on each side -> crop starts at (50, 50)
+        self.assertEqual(seen, [(200, 200, 3)])
+        self.assertEqual(locations, [(60, 140, 140, 60)])
+
+    def test_encode_face_unknown_profile(self):
+        """Test that an unknown profile is rejected rather than silently defaulted"""
+        with self.assertRaises(ValueError):
+            encode_face(b"dummy_image_data", profile='unknown')
+
+    @unittest.skipUnless(FACE_RECOGNITION_AVAILABLE, "needs face_recognition")
+    def test_face_hint(self):
+        """Test that a confirmed hint skips full detection and a wrong one falls back"""
+        import io
+        import detectors
+        from PIL import Image
+        from face_utils import FaceEncodingError, encode_face_or_raise
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (320, 240), (90, 120, 150)).save(buffer, format='PNG')
+        image_bytes = buffer.getvalue()
+
+        original = detectors.detect_hog
+        detectors.detect_hog = lambda crop: [(10, 90, 90, 10)] if crop.shape[:2] != (240, 320) else []
+        try:
+            timings = {}
+            encoding = encode_face_or_raise(image_bytes, timings=timings, face_hint=(50, 150, 150, 50))
+        finally:
+            detectors.detect_hog = original
+        self.assertEqual(encoding.shape, (128,))
+        self.assertIn('hint_detection', timings)
+        self.assertNotIn('detection', timings)
+
+        # Nothing near the hint (or anywhere): full detection runs, then no_face
+        timings = {}
+        with self.assertRaises(FaceEncodingError) as ctx:
+            encode_face_or_raise(image_bytes, timings=timings, face_hint=(500, 600, 600, 500))
+        self.assertEqual(ctx.exception.code, 'no_face')
+        self.assertIn('hint_detection', timings)
+        self.assertIn('detection', timings)
+
+    @unittest.skipUnless(FACE_RECOGNITION_AVAILABLE, "needs face_recognition")
+    def test_preload_models(self):
+        """Test that preloading runs the profile's detector and encoder"""
+        timings = preload_models('default')
+        self.assertEqual(set(timings), {'detection', 'encoding'})
+        with self.assertRaises(ValueError):
+            preload_models('unknown')
+
+
+
+class TestEvaluateTolerance(unittest.TestCase):
+    """Test the vectorized FAR/FRR evaluation"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(0, 0.09, (200, 128))
+        self.encodings = (np.repeat(centers, 3, axis=0) + rng.normal(0, 0.02, (600, 128))).astype(np.float32)
+        self.labels = np.repeat([f"user{i}" for i in range(200)], 3)
+
+    def test_genuine_pairs(self):
+        """Test that genuine pairs are exactly the same-label pairs"""
+        labels = np.array(['b', 'a', 'b', 'c', 'a', 'b'])
+        a, b = genuine_pairs(labels)
+        pairs = {tuple(sorted(p)) for p in zip(a.tolist(), b.tolist())}
+        self.assertEqual(pairs, {(1, 4), (0, 2), (0, 5), (2, 5)})
+
+    def test_exhaustive_counts_and_rates(self):
+        """Test pair counts, FAR/FRR monotonicity and a separable EER"""
+        genuine, impostor = evaluate(self.encodings, self.labels, impostor_pairs=0, block_size=128)
+        self.assertEqual(genuine.sum(), 200 * 3)
+        self.assertEqual(impostor.sum(), 600 * 599 // 2 - 200 * 3)
+
+        tolerances, far, frr = error_rates(genuine, impostor)
+        self.assertTrue(np.all(np.diff(far) >= 0))
+        self.assertTrue(np.all(np.diff(frr) <= 0))
+        eer, tolerance = equal_error_rate(tolerances, far, frr)
+        self.assertEqual(eer, 0.0)
+        self.assertLessEqual(far[int(round(tolerance * 1000)) - 1], 0.0)
+        self.assertIsNotNone(tolerance_for_far(tolerances, far, 1e-3))
+
+    def test_sampled_matches_exhaustive(self):
+        """Test that sampled impostor distances follow the exhaustive distribution"""
+        _, exact = evaluate(self.encodings, self.labels, impostor_pairs=0)
+        _, sampled = evaluate(self.encodings, self.labels, impostor_pairs=100_000, block_size=256)
+        self.assertGreaterEqual(sampled.sum(), 100_000)
+        gap = np.abs(np.cumsum(exact) / exact.sum() - np.cumsum(sampled) / sampled.sum()).max()
+        self.assertLess(gap, 0.02)
+
+
+class TestFaceKeys(unittest.TestCase):
+    """Test locality-sensitive face keys and their buckets"""
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.encoding = rng.normal(0, 0.06, 128)
+        self.same_face = self.encoding + rng.normal(0, 0.015, 128)
+        self.other_face = rng.normal(0, 0.06, 128)
+
+    def test_face_key(self):
+        """Test that keys are stable, SHA-256 sized and depend on the seed"""
+        key = face_key(self.encoding)
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, face_key(self.encoding.copy()))
+        self.assertNotEqual(key, face_key(self.encoding, seed=1))
+        self.assertIsNone(face_key(None))
+        self.assertIsNone(face_key(np.zeros(64)))
+        self.assertIsNone(key_bits('not a key'))
+
+    def test_key_distance(self):
+        """Test that the key estimate tracks the exact distance"""
+        key = face_key(self.encoding)
+        self.assertEqual(key_distance(self.encoding, key), 0.0)
+        near = key_distance(self.same_face, key)
+        far = key_distance(self.other_face, key)
+        self.assertLess(near, 0.4)
+        self.assertGreater(far, 0.6)
+        self.assertIsNone(key_distance(self.encoding, hash_face_encoding(self.encoding)[:10]))
+
+    def test_verify_face_with_key(self):
+        """Test that verify_face accepts another capture against a stored key"""
+        key = face_key(self.encoding)
+        self.assertTrue(verify_face(self.same_face, key))
+        self.assertFalse(verify_face(self.other_face, key))
+        self.assertFalse(verify_face(self.same_face, key, tolerance=0.01))
+        self.assertFalse(verify_face(self.same_face, face_key(self.encoding, seed=1)))
+        # A SHA-256 hash still only matches the very same encoding
+        self.assertTrue(verify_face(self.encoding, hash_face_encoding(self.encoding)))
+        self.assertFalse(verify_face(self.same_face, hash_face_encoding(self.encoding)))
+
+    def test_buckets(self):
+        """Test bucket names and that probes start with the encoding's own buckets"""
+        buckets = face_buckets(face_key(self.encoding))
+        self.assertEqual(len(buckets), BANDS)
+        self.assertEqual(len(set(buckets)), BANDS)
+        self.assertEqual(face_buckets('0' * 10), [])
+        probes = probe_buckets(self.encoding, probes=2)
+        self.assertEqual(probes[:BANDS], buckets)
+        self.assertEqual(len(probes), BANDS * 3)
+        self.assertEqual(probe_buckets(self.encoding), buckets)
+        self.assertTrue(set(probe_buckets(self.same_face, probes=2)) & set(buckets))
+
+    def test_lookup_and_verify_rates(self):
+        """Test that multi-probe raises the hit rate on synthetic identities"""
+        encodings, labels = synthetic_encodings(300, captures=3)
+        no_probes, probes = lookup_stats(encodings, labels, [0, 2], tolerance=0.6)
+        self.assertGreater(no_probes['hit_rate'], 0.6)
+        self.assertGreaterEqual(probes['hit_rate'], no_probes['hit_rate'])
+        self.assertGreater(probes['hit_rate'], 0.9)
+        self.assertLess(probes['candidate_fraction'], 0.2)
+
+        rates = verify_rates(encodings, labels, 0.6, impostor_pairs=20_000)
+        self.assertLess(rates['key_far'], 0.01)
+        self.assertLess(rates['key_frr'], 0.05)
+
 
 if __name__ == '__main__':
     # Run the tests
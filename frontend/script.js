@@ -17,11 +17,98 @@ function defaultHeaders() {
   return headers;
 }
 
+// Headers for multipart bodies (the browser sets Content-Type with the boundary)
+function formHeaders() {
+  const headers = {};
+  const csrftoken = getCookie("csrftoken");
+  if (csrftoken) headers["X-CSRFToken"] = csrftoken;
+  return headers;
+}
+
+// Build a multipart body carrying the credentials and the JPEG as a binary part,
+// plus the face box (in pixels of that JPEG) when the browser found one
+function faceFormData(username, password, imageBlob, faceBox) {
+  const form = new FormData();
+  form.append("username", username);
+  form.append("password", password);
+  form.append("face_image", imageBlob, "face.jpg");
+  if (faceBox) {
+    form.append(
+      "face_box",
+      [faceBox.x, faceBox.y, faceBox.width, faceBox.height].map(Math.round).join(",")
+    );
+  }
+  return form;
+}
+
+// Decode a base64 little-endian float32 face encoding ("binary" response mode)
+function unpackEncoding(b64) {
+  const bytes = Uint8Array.from(atob(b64), (c) => c.charCodeAt(0));
+  return Array.from(new Float32Array(bytes.buffer));
+}
+
+// Capture parameters; replaced by the server's values from /api/config/
+const DEFAULT_CAPTURE_CONFIG = { max_side: 480, jpeg_quality: 0.85, face_padding: 0.6 };
+
+async function loadCaptureConfig() {
+  try {
+    const res = await fetch(`${API_URL}/config/`);
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    const config = await res.json();
+    return { ...DEFAULT_CAPTURE_CONFIG, ...(config.capture || {}) };
+  } catch (error) {
+    console.warn("Using default capture settings:", error);
+    return DEFAULT_CAPTURE_CONFIG;
+  }
+}
+
+// Face bounding box from the browser's Shape Detection API, where available
+async function detectFaceBox(source) {
+  if (!("FaceDetector" in window)) return null;
+  try {
+    const faces = await new window.FaceDetector({ fastMode: true, maxDetectedFaces: 1 }).detect(source);
+    return faces.length ? faces[0].boundingBox : null;
+  } catch (error) {
+    console.warn("Face detection unavailable:", error);
+    return null;
+  }
+}
+
+// Square region around the face box with `padding` margin on each side,
+// clamped to the frame; the whole frame when no face box is known
+function captureRegion(frameWidth, frameHeight, box, padding) {
+  if (!box) return { x: 0, y: 0, width: frameWidth, height: frameHeight };
+  const side = Math.min(
+    Math.max(box.width, box.height) * (1 + 2 * padding),
+    frameWidth,
+    frameHeight
+  );
+  const centerX = box.x + box.width / 2;
+  const centerY = box.y + box.height / 2;
+  const x = Math.min(Math.max(centerX - side / 2, 0), frameWidth - side);
+  const y = Math.min(Math.max(centerY - side / 2, 0), frameHeight - side);
+  return { x, y, width: side, height: side };
+}
+
+function canvasToJpeg(canvas, quality) {
+  return new Promise((resolve, reject) => {
+    canvas.toBlob(
+      (blob) => (blob ? resolve(blob) : reject(new Error("JPEG encoding failed"))),
+      "image/jpeg",
+      quality
+    );
+  });
+}
+
 class FaceAuthApp {
   constructor() {
     this.currentStream = null;
     this.capturedImage = null;
+    this.capturedFaceBox = null;
+    this.preparedUsername = null;
     this.isRegisterMode = true;
+    this.captureConfig = DEFAULT_CAPTURE_CONFIG;
+    loadCaptureConfig().then((config) => (this.captureConfig = config));
 
     this.initializeElements();
     this.attachEventListeners();
@@ -83,6 +170,9 @@ class FaceAuthApp {
       );
     if (this.loginSubmit)
       this.loginSubmit.addEventListener("click", () => this.submitLogin());
+    // Warm the server's cache for this user while the face is being captured
+    if (this.loginUsername)
+      this.loginUsername.addEventListener("blur", () => this.prepareLogin());
 
     // Tab switching - uses textContent of the tab element
     document.querySelectorAll(".tab").forEach((tab) => {
@@ -167,7 +257,7 @@ class FaceAuthApp {
     }
   }
 
-  captureImage(mode) {
+  async captureImage(mode) {
     try {
       const video = mode === "reg" ? this.regVideo : this.loginVideo;
       const canvas = mode === "reg" ? this.regCanvas : this.loginCanvas;
@@ -179,13 +269,36 @@ class FaceAuthApp {
         return;
       }
 
-      canvas.width = video.videoWidth || 640;
-      canvas.height = video.videoHeight || 480;
+      // Crop around the face and scale down to the server's preferred size:
+      // smaller uploads, and less for the server to decode and scan
+      const config = this.captureConfig;
+      const frameWidth = video.videoWidth || 640;
+      const frameHeight = video.videoHeight || 480;
+      const box = await detectFaceBox(video);
+      const region = captureRegion(frameWidth, frameHeight, box, config.face_padding);
+      const scale = Math.min(1, config.max_side / Math.max(region.width, region.height));
+
+      canvas.width = Math.round(region.width * scale);
+      canvas.height = Math.round(region.height * scale);
 
       const ctx = canvas.getContext("2d");
-      ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+      ctx.drawImage(
+        video,
+        region.x, region.y, region.width, region.height,
+        0, 0, canvas.width, canvas.height
+      );
 
-      this.capturedImage = canvas.toDataURL("image/jpeg", 0.8);
+      this.capturedImage = await canvasToJpeg(canvas, config.jpeg_quality);
+      // The face box in the uploaded image's pixels, so the server can skip
+      // scanning the whole image for the face
+      this.capturedFaceBox = box
+        ? {
+            x: (box.x - region.x) * scale,
+            y: (box.y - region.y) * scale,
+            width: box.width * scale,
+            height: box.height * scale,
+          }
+        : null;
 
       if (captureBtn) captureBtn.disabled = true;
       if (submitBtn) submitBtn.disabled = false;
@@ -206,18 +319,15 @@ class FaceAuthApp {
     this.hideStatus();
 
     try {
-      const payload = {
-        username: this.regUsername.value.trim(),
-        password: this.regPassword.value,
-        face_image: this.capturedImage
-          ? this.capturedImage.split(",")[1]
-          : null,
-      };
-
       const res = await fetch(`${API_URL}/register/`, {
         method: "POST",
-        headers: defaultHeaders(),
-        body: JSON.stringify(payload),
+        headers: formHeaders(),
+        body: faceFormData(
+          this.regUsername.value.trim(),
+          this.regPassword.value,
+          this.capturedImage,
+          this.capturedFaceBox
+        ),
       });
 
       if (!res.ok) {
@@ -257,24 +367,33 @@ class FaceAuthApp {
     }
   }
 
+  // Fire-and-forget: a failed or skipped prepare only makes verify do the lookups itself
+  prepareLogin() {
+    const username = this.loginUsername.value.trim();
+    if (!username || username === this.preparedUsername) return;
+    this.preparedUsername = username;
+    fetch(`${API_URL}/prepare/`, {
+      method: "POST",
+      headers: defaultHeaders(),
+      body: JSON.stringify({ username }),
+    }).catch((error) => console.warn("Login prepare failed:", error));
+  }
+
   async submitLogin() {
     if (!this.validateLoginForm()) return;
     this.setLoading("login", true);
     this.hideStatus();
 
     try {
-      const payload = {
-        username: this.loginUsername.value.trim(),
-        password: this.loginPassword.value,
-        face_image: this.capturedImage
-          ? this.capturedImage.split(",")[1]
-          : null,
-      };
-
-      const res = await fetch(`${API_URL}/verify/`, {
+      const res = await fetch(`${API_URL}/verify/?encoding=binary`, {
         method: "POST",
-        headers: defaultHeaders(),
-        body: JSON.stringify(payload),
+        headers: formHeaders(),
+        body: faceFormData(
+          this.loginUsername.value.trim(),
+          this.loginPassword.value,
+          this.capturedImage,
+          this.capturedFaceBox
+        ),
       });
 
       if (!res.ok) {
@@ -298,10 +417,20 @@ class FaceAuthApp {
       if (data.success) {
         // store dashboard payload and redirect
         const dashboardData = data.dashboard_data || {};
+        if (dashboardData.face_encoding_b64) {
+          dashboardData.face_encoding = unpackEncoding(
+            dashboardData.face_encoding_b64
+          );
+          delete dashboardData.face_encoding_b64;
+        }
         localStorage.setItem(
           "faceauth_dashboard_data",
           JSON.stringify(dashboardData)
         );
+        // Signed session token: later requests send it instead of a new face scan
+        if (data.session_token) {
+          localStorage.setItem("faceauth_session_token", data.session_token);
+        }
         const dashStr = encodeURIComponent(JSON.stringify(dashboardData));
         window.location.href = `dashboard.html?data=${dashStr}`;
       } else {
@@ -367,6 +496,7 @@ class FaceAuthApp {
     if (this.regUsername) this.regUsername.value = "";
     if (this.regPassword) this.regPassword.value = "";
     this.capturedImage = null;
+    this.capturedFaceBox = null;
     if (this.regCapture) this.regCapture.disabled = true;
     if (this.regSubmit) this.regSubmit.disabled = true;
     if (this.regStartCamera) this.regStartCamera.disabled = false;
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+End-to-end load generator for the FaceAuth API.
+
+Replays a mix of /api/register/ and /api/verify/ traffic and reports
+throughput, error rate and latency percentiles per endpoint:
+
+    python load_test.py --users 50 --requests 1000 --register-ratio 0.1 --concurrency 50
+    python load_test.py --rate 40 --duration 60 --images faces/       # open-loop, 40 req/s
+    python load_test.py --async-views --concurrency 200               # /api/async/...
+
+A run first registers --users users (one face image each), then sends the
+main mix: verify requests log in as one of those users with their own image,
+register requests sign up new users. Usernames carry a per-run prefix so
+repeated runs against the same chain do not collide.
+
+Face images come from --images (a directory of JPEG/PNG files, one per user,
+reused round-robin). Without it, synthetic JPEGs are generated; those contain
+no face, so start the server with FACE_ENCODER=stub to measure everything but
+the face model:
+
+    cd backend
+    FACE_ENCODER=stub python manage.py runserver
+
+With --rate, requests arrive as a Poisson process at that rate regardless of
+how fast the server answers (open loop); without it, --concurrency workers
+send back to back (closed loop).
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import time
+import uuid
+
+import aiohttp
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def synthetic_face_image(seed, size=160):
+    """
+    A small random JPEG, distinct per seed and identical for the same seed
+    (contains no real face)
+    """
+    from PIL import Image
+
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(str(seed).encode()).digest()[:8], 'little'))
+    noise = rng.normal(128, 64, (size, size, 3)).clip(0, 255).astype(np.uint8)
+    tint = rng.integers(0, 256, 3, dtype=np.uint8)
+    pixels = ((noise.astype(np.uint16) + tint) // 2).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def load_images(directory):
+    """Read every image file in `directory`, sorted by name"""
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))
+    if not names:
+        raise SystemExit(f"No {'/'.join(IMAGE_EXTENSIONS)} files in {directory}")
+    images = []
+    for name in names:
+        with open(os.path.join(directory, name), 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+class EndpointStats:
+    """Latency samples and status counts for one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def record(self, seconds, status):
+        self.latencies.append(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if not (isinstance(status, int) and 200 <= status < 300):
+            self.errors += 1
+
+    def report(self, name, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        if not count:
+            return f"{name:<9} no requests"
+        return (
+            f"{name:<9} n={count:<6} {count / elapsed:7.1f} req/s  "
+            f"errors={self.errors / count:6.1%}  "
+            f"p50={percentile(latencies, 50) * 1000:.0f}ms  "
+            f"p95={percentile(latencies, 95) * 1000:.0f}ms  "
+            f"p99={percentile(latencies, 99) * 1000:.0f}ms  "
+            f"max={latencies[-1] * 1000:.0f}ms  "
+            f"statuses={json.dumps({str(k): v for k, v in self.statuses.items()})}"
+        )
+
+
+class LoadHarness:
+    """Builds requests for a run and sends them through one aiohttp session"""
+
+    def __init__(self, base_url, images, body_format='multipart', async_views=False, password='loadtest'):
+        prefix = '/api/async/' if async_views else '/api/'
+        self.urls = {
+            'register': base_url.rstrip('/') + prefix + 'register/',
+            'verify': base_url.rstrip('/') + prefix + 'verify/',
+        }
+        self.images = images
+        self.body_format = body_format
+        self.password = password
+        self.run_id = uuid.uuid4().hex[:8]
+        self.registered = []
+        self.next_user = 0
+        self._synthetic = {}
+        self.stats = {'register': EndpointStats(), 'verify': EndpointStats()}
+
+    def image_for(self, index):
+        if self.images is None:
+            # Generated once per user: verify must send the registered bytes
+            image = self._synthetic.get(index)
+            if image is None:
+                image = self._synthetic[index] = synthetic_face_image(f"{self.run_id}-{index}")
+            return image
+        return self.images[index % len(self.images)]
+
+    def new_user(self):
+        index = self.next_user
+        self.next_user += 1
+        return index, f"lt{self.run_id}u{index}"
+
+    def request_kwargs(self, username, image):
+        """aiohttp.post() keyword arguments for the configured body format"""
+        if self.body_format == 'raw':
+            return {
+                'data': image,
+                'headers': {'Content-Type': 'image/jpeg', 'X-Username': username, 'X-Password': self.password},
+            }
+        if self.body_format == 'json':
+            return {'json': {
+                'username': username,
+                'password': self.password,
+                'face_image': base64.b64encode(image).decode('utf-8'),
+            }}
+        form = aiohttp.FormData()
+        form.add_field('username', username)
+        form.add_field('password', self.password)
+        form.add_field('face_image', image, filename='face.jpg', content_type='image/jpeg')
+        return {'data': form}
+
+    async def send(self, session, endpoint, username, image):
+        """POST one request and record it; returns the HTTP status or exception name"""
+        url = self.urls[endpoint]
+        if endpoint == 'verify':
+            url += '?encoding=omit'
+        start = time.perf_counter()
+        try:
+            async with session.post(url, **self.request_kwargs(username, image)) as response:
+                await response.read()
+                status = response.status
+        except Exception as e:
+            status = type(e).__name__
+        self.stats[endpoint].record(time.perf_counter() - start, status)
+        return status
+
+    async def register_one(self, session):
+        index, username = self.new_user()
+        status = await self.send(session, 'register', username, self.image_for(index))
+        if status == 200:
+            self.registered.append((index, username))
+
+    async def verify_one(self, session):
+        if not self.registered:
+            return await self.register_one(session)
+        index, username = random.choice(self.registered)
+        await self.send(session, 'verify', username, self.image_for(index))
+
+    async def smoke_check(self, session):
+        """Verify one registered user; returns the HTTP status (200 when the mix is meaningful)"""
+        index, username = self.registered[0]
+        status = await self.send(session, 'verify', username, self.image_for(index))
+        self.stats['verify'] = EndpointStats()
+        return status
+
+    async def one_request(self, session, register_ratio):
+        if random.random() < register_ratio:
+            await self.register_one(session)
+        else:
+            await self.verify_one(session)
+
+
+async def run_closed_loop(total, concurrency, task_factory):
+    """Run `total` tasks with `concurrency` workers sending back to back"""
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await task_factory()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_open_loop(rate, duration, max_in_flight, task_factory):
+    """Start tasks as a Poisson process at `rate`/s for `duration` seconds"""
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = []
+    deadline = time.perf_counter() + duration
+
+    async def guarded():
+        async with in_flight:
+            await task_factory()
+
+    next_start = time.perf_counter()
+    while next_start < deadline:
+        delay = next_start - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(guarded()))
+        next_start += random.expovariate(rate)
+    await asyncio.gather(*tasks)
+
+
+async def run(args, images):
+    harness = LoadHarness(args.base_url, images, body_format=args.format,
+                          async_views=args.async_views, password=args.password)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if args.users:
+            print(f"Registering {args.users} users (run {harness.run_id})...")
+            start = time.perf_counter()
+            await run_closed_loop(args.users, args.concurrency, lambda: harness.register_one(session))
+            print(f"  {len(harness.registered)}/{args.users} registered in {time.perf_counter() - start:.1f}s")
+            if not harness.registered:
+                print("  warning: no user registered; verify traffic will register instead")
+            else:
+                status = await harness.smoke_check(session)
+                if status != 200:
+                    raise SystemExit(
+                        f"Verify of registered user {harness.registered[0][1]} returned {status}, not 200; "
+                        "the run would only measure failed logins (synthetic images need FACE_ENCODER=stub)"
+                    )
+            harness.stats['register'] = EndpointStats()
+
+        def task():
+            return harness.one_request(session, args.register_ratio)
+
+        start = time.perf_counter()
+        if args.rate:
+            print(f"Open loop: {args.rate} req/s for {args.duration}s, register ratio {args.register_ratio}")
+            await run_open_loop(args.rate, args.duration, args.concurrency, task)
+        else:
+            print(f"Closed loop: {args.requests} requests, concurrency {args.concurrency}, "
+                  f"register ratio {args.register_ratio}")
+            await run_closed_loop(args.requests, args.concurrency, task)
+        elapsed = time.perf_counter() - start
+
+    total = sum(len(s.latencies) for s in harness.stats.values())
+    print(f"Elapsed:    {elapsed:.2f} s, {total / elapsed:.1f} req/s overall")
+    for name, stats in harness.stats.items():
+        print(stats.report(name, elapsed))
+    return harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FaceAuth API load generator")
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--async-views', action='store_true', help='use /api/async/ endpoints')
+    parser.add_argument('--images', help='directory of face images (default: synthetic images)')
+    parser.add_argument('--format', choices=('multipart', 'raw', 'json'), default='multipart',
+                        help='request body format')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--users', type=int, default=20, help='users registered before the main phase')
+    parser.add_argument('--register-ratio', type=float, default=0.1,
+                        help='fraction of main-phase requests that are registrations')
+    parser.add_argument('--requests', type=int, default=500, help='main-phase requests (closed loop)')
+    parser.add_argument('--concurrency', type=int, default=50, help='max requests in flight')
+    parser.add_argument('--rate', type=float, default=0, help='arrival rate in req/s (open loop)')
+    parser.add_argument('--duration', type=float, default=30, help='open-loop duration in seconds')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, help='random seed for the request mix')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    images = load_images(args.images) if args.images else None
+    asyncio.run(run(args, images))
+
+
+if __name__ == "__main__":
+    main()